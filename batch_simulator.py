@@ -0,0 +1,243 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2018, University of California, Berkeley
+# author: Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+# simulates many independent copies (lanes) of a circuit at once with NumPy
+# signals of up to 63 bits are int64 lanes, 64 bit and wider ones Python ints, see `narrow_width`
+
+import sys
+from firrtl_lower import Op, Program
+from compiled_simulator import compile_program, _mask, _normalize, _printf_format, _operands
+
+try:
+	import numpy as np
+except ImportError:
+	np = None
+
+# signals up to this width are int64 arrays, which holds UInt and SInt values alike,
+# so NumPy never has to promote mixed operands; wider signals are arrays of Python ints.
+# Not uint64 up to 64 bits: NumPy turns uint64 mixed with int64 into float64, and every
+# SInt operation would need its own two's complement code. A UInt<64> does not fit int64.
+narrow_width = 63
+
+def _is_narrow(prog: Program, value: int) -> bool:
+	return prog.width[value] <= narrow_width
+
+def _expression(prog: Program, ii: int, ref) -> str:
+	""" NumPy expression for instruction `ii`, `ref(value)` returns the name of an operand """
+	op, a, b, c = prog.op[ii], prog.a[ii], prog.b[ii], prog.c[ii]
+	width, signed = prog.width[ii], prog.signed[ii] == 1
+	mask = _mask(width)
+	operands = _operands(prog, ii)
+	ta = ref(a)
+	tb = ref(b) if len(operands) > 1 else None
+	def unsigned(value: int, name: str) -> str:
+		return f"({name} & {_mask(prog.width[value])})" if prog.signed[value] else name
+	def result(expr: str) -> str:
+		if signed:
+			return f"((({expr}) + {1 << (width - 1)}) & {mask}) - {1 << (width - 1)}"
+		return f"(({expr}) & {mask})"
+	if op == Op.ADD or op == Op.MUL:
+		return f"{ta} {'+' if op == Op.ADD else '*'} {tb}"
+	if op == Op.SUB:
+		return f"{ta} - {tb}" if signed else result(f"{ta} - {tb}")
+	if op == Op.DIV or op == Op.REM:
+		# division by zero is zero, like in the compiled simulator
+		safe = f"np.where({tb} == 0, 1, {tb})"
+		if signed:
+			sign = f"np.where(({ta} < 0) != ({tb} < 0), -1, 1)" if op == Op.DIV else f"np.where({ta} < 0, -1, 1)"
+			res = f"(np.abs({ta}) {'//' if op == Op.DIV else '%'} np.abs({safe})) * {sign}"
+		else:
+			res = f"{ta} {'//' if op == Op.DIV else '%'} {safe}"
+		return f"np.where({tb} == 0, 0, {res})"
+	if op in (Op.AND, Op.OR, Op.XOR):
+		sym = {Op.AND: '&', Op.OR: '|', Op.XOR: '^'}[op]
+		if prog.signed[a] or prog.signed[b]:
+			return result(f"{ta} {sym} {tb}")
+		return f"{ta} {sym} {tb}"
+	if op == Op.CAT:
+		return f"({unsigned(a, ta)} << {prog.width[b]}) | {unsigned(b, tb)}"
+	if Op.EQ <= op <= Op.GE:
+		sym = {Op.EQ: '==', Op.NE: '!=', Op.LT: '<', Op.GT: '>', Op.LE: '<=', Op.GE: '>='}[op]
+		return f"({ta} {sym} {tb}).astype(np.int64)"
+	if op == Op.DSHL:
+		return f"{ta} << {tb}"
+	if op == Op.DSHR:
+		# NumPy does not define shifts by the word size or more
+		return f"{ta} >> np.minimum({tb}, {narrow_width})" if _is_narrow(prog, ii) else f"{ta} >> {tb}"
+	if op == Op.AS_UINT or op == Op.AS_CLOCK:
+		return unsigned(a, ta)
+	if op == Op.AS_SINT:
+		return result(ta) if not prog.signed[a] else ta
+	if op == Op.CVT or op == Op.PAD:
+		return ta
+	if op == Op.NEG:
+		return f"-{ta}"
+	if op == Op.NOT:
+		return f"{unsigned(a, ta)} ^ {mask}"
+	if op == Op.SHL:
+		return f"{ta} << {b}"
+	if op == Op.SHR:
+		# like DSHR, the result of shifting out all bits is 0 or -1
+		return f"{ta} >> {min(b, narrow_width)}" if _is_narrow(prog, a) else f"{ta} >> {b}"
+	if op == Op.HEAD:
+		return f"{unsigned(a, ta)} >> {prog.width[a] - b}"
+	if op == Op.TAIL or op == Op.BITS:
+		shift = c if op == Op.BITS else 0
+		return f"({ta} >> {shift}) & {mask}" if shift > 0 else f"{ta} & {mask}"
+	if op == Op.MUX:
+		return f"np.where({ta}, {tb}, {ref(c)})"
+	if op == Op.VALIDIF:
+		return tb
+	raise NotImplementedError(f"compiling {Op(op).name}")
+
+def generate(prog: Program, slots: dict) -> str:
+	""" like `compiled_simulator.generate`, but every value is an array with one element
+	    per lane and printf/stop events carry the array of lanes in which they fire """
+	inputs = {value: ii for ii, value in enumerate(prog.inputs.values())}
+	registers = {reg[1]: ii for ii, reg in enumerate(prog.registers)}
+	lines = ["def evaluate(I, R, V, N, E):"]
+	# narrow values that were converted to Python ints for a wide operation
+	converted = set()
+	def wide_ref(value: int) -> str:
+		if not _is_narrow(prog, value):
+			return f"t{value}"
+		if value not in converted:
+			converted.add(value)
+			lines.append(f"\tw{value} = t{value}.astype(object)")
+		return f"w{value}"
+	for ii in range(len(prog)):
+		op = prog.op[ii]
+		if op == Op.INPUT:
+			expr = f"I[{inputs[ii]}]"
+		elif op == Op.REG:
+			expr = f"R[{registers[ii]}]"
+		elif op == Op.CONST:
+			expr = f"C[{ii}]"
+		else:
+			operands = _operands(prog, ii)
+			if _is_narrow(prog, ii) and all(_is_narrow(prog, oo) for oo in operands):
+				expr = _expression(prog, ii, lambda value: f"t{value}")
+			else:
+				# computed on Python ints, narrow results are converted back
+				expr = _expression(prog, ii, wide_ref)
+				if _is_narrow(prog, ii):
+					expr = f"np.asarray({expr}).astype(np.int64)"
+		lines.append(f"\tt{ii} = {expr}")
+	for value, slot in slots.items():
+		lines.append(f"\tV[{slot}] = t{value}")
+	for ii, (name, current, next, enable, init) in enumerate(prog.registers):
+		width, signed = prog.width[current], prog.signed[current] == 1
+		next_expr = f"t{next}"
+		if prog.width[next] > width:
+			next_expr = f"((t{next} + {1 << (width - 1)}) & {_mask(width)}) - {1 << (width - 1)}" if signed \
+				else f"t{next} & {_mask(width)}"
+			if _is_narrow(prog, current) and not _is_narrow(prog, next):
+				next_expr = f"np.asarray({next_expr}).astype(np.int64)"
+		if enable >= 0:
+			next_expr = f"np.where(t{enable}, t{init}, {next_expr})"
+		lines.append(f"\tN[{ii}] = {next_expr}")
+	for ii, (clock, condition, fmt, args) in enumerate(prog.printfs):
+		args = "".join(f"t{aa}, " for aa in args)
+		lines.append(f"\tif t{condition}.any(): E.append(({ii}, t{condition} != 0, ({args})))")
+	for ii, (clock, condition, exit_code) in enumerate(prog.stops):
+		lines.append(f"\tif t{condition}.any(): E.append((-1, t{condition} != 0, {exit_code}))")
+	lines.append("\treturn")
+	return "\n".join(lines) + "\n"
+
+class BatchSimulator:
+	""" Simulates `lanes` independent copies of a circuit. `poke` takes a scalar or one value
+	    per lane, `peek` returns an array with one value per lane. A lane in which a stop
+	    statement fired keeps its state, its exit code is in `exit_codes` (-1 while running). """
+	def __init__(self, lanes: int, out=None):
+		if np is None:
+			raise ImportError("BatchSimulator requires numpy")
+		self.lanes = lanes
+		self.out = sys.stdout if out is None else out
+		self.prog = None
+		self.source = None
+
+	def _zeros(self, value: int):
+		if _is_narrow(self.prog, value):
+			return np.zeros(self.lanes, dtype=np.int64)
+		return np.array([0] * self.lanes, dtype=object)
+
+	def load(self, ir):
+		""" `ir` is either FIRRTL text or a firrtl.Circuit """
+		self.prog = prog = compile_program(ir)
+		self.slots, slot_of_value = {}, {}
+		for name, value in prog.symbols.items():
+			if value not in slot_of_value:
+				slot_of_value[value] = len(slot_of_value)
+			self.slots[name] = slot_of_value[value]
+		self.source = generate(prog, slot_of_value)
+		constants = {}
+		for ii in range(len(prog)):
+			if prog.op[ii] == Op.CONST:
+				value = _normalize(prog.consts[prog.a[ii]], prog.width[ii], prog.signed[ii] == 1)
+				constants[ii] = self._zeros(ii) + value
+		namespace = {'np': np, 'C': constants}
+		exec(compile(self.source, f"<{prog.name}>", "exec"), namespace)
+		self._evaluate = namespace['evaluate']
+		input_of_value = {value: ii for ii, value in enumerate(prog.inputs.values())}
+		self.inputs = {name: input_of_value[value] for name, value in prog.symbols.items() if value in input_of_value}
+		self.input_values = list(prog.inputs.values())
+		self.formats = [_printf_format(fmt) for _, _, fmt, _ in prog.printfs]
+		self.I = [self._zeros(value) for value in self.input_values]
+		self.R = [self._zeros(reg[1]) for reg in prog.registers]
+		self.N = [self._zeros(reg[1]) for reg in prog.registers]
+		self.V = [None] * len(slot_of_value)
+		self.E = []
+		self.cycle = 0
+		self.exit_codes = np.full(self.lanes, -1, dtype=np.int64)
+		self._dirty = True
+
+	def _update(self):
+		if self._dirty:
+			self.E.clear()
+			self._evaluate(self.I, self.R, self.V, self.N, self.E)
+			self._dirty = False
+
+	def peek(self, signal: str):
+		self._update()
+		return np.array(np.broadcast_to(self.V[self.slots[signal]], (self.lanes,)))
+
+	def poke(self, signal: str, values):
+		ii = self.inputs[signal]
+		value = self.input_values[ii]
+		width, signed = self.prog.width[value], self.prog.signed[value] == 1
+		if _is_narrow(self.prog, value):
+			values = np.broadcast_to(np.asarray(values, dtype=np.int64), (self.lanes,)) & _mask(width)
+			if signed:
+				values = ((values + (1 << (width - 1))) & _mask(width)) - (1 << (width - 1))
+		else:
+			values = np.broadcast_to(np.asarray(values, dtype=object), (self.lanes,))
+			values = np.array([_normalize(int(vv), width, signed) for vv in values], dtype=object)
+		self.I[ii] = values
+		self._dirty = True
+
+	def step(self, count=1):
+		for _ in range(count):
+			running = self.exit_codes < 0
+			if not running.any():
+				return
+			self._update()
+			for kind, lanes, payload in self.E:
+				lanes = lanes & running
+				if kind < 0:
+					self.exit_codes[lanes] = payload
+					continue
+				for lane in np.flatnonzero(lanes):
+					args = [int(arg[lane]) if np.ndim(arg) > 0 else int(arg) for arg in payload]
+					self.out.write(f"[{lane}] " + self.formats[kind].format(*args))
+			if running.all():
+				self.R, self.N = self.N, self.R
+			else:
+				self.R = [np.where(running, nn, rr) for nn, rr in zip(self.N, self.R)]
+			self.cycle += 1
+			self._dirty = True
+
+	def stop(self):
+		pass
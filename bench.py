@@ -0,0 +1,740 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2018, University of California, Berkeley
+# author: Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+# micro benchmarks for the IR infrastructure
+# usage: python3 bench.py [benchmark ...]
+
+import sys, time
+import kast, firrtl
+
+def best_of(fun, repeat=3) -> float:
+	""" returns the fastest of `repeat` runs of `fun` in seconds """
+	times = []
+	for _ in range(repeat):
+		start = time.perf_counter()
+		fun()
+		times.append(time.perf_counter() - start)
+	return min(times)
+
+def report(name: str, seconds: float, count: int, unit="node"):
+	print(f"{name:<40} {seconds * 1e3:10.2f} ms {seconds / count * 1e9:10.1f} ns/{unit}")
+
+## Construction ##
+
+def _legacy_isinstance(obj, typ) -> bool:
+	""" the string based type check that kast used before compiling schemas """
+	typ_name = str(typ)
+	if not typ_name.startswith('typing.'):
+		return isinstance(obj, typ)
+	name = typ_name.split('.')[1].split('[')[0]
+	if name in {'Union', 'Optional'}:
+		return any(_legacy_isinstance(obj, aa) for aa in typ.__args__)
+	elif name == 'List':
+		(et,) = typ.__args__
+		return isinstance(obj, list) and all(_legacy_isinstance(ii, et) for ii in obj)
+	raise NotImplementedError(f"_legacy_isinstance({obj}, {typ})")
+
+def _legacy_get_fields(cls):
+	""" walks the base classes, as kast.get_fields used to do for every instance """
+	fields = kast.get_fields_of_class(cls)
+	while len(cls.__bases__) > 0 and cls.__bases__[0] not in [kast.Node, object]:
+		new_fields = [kast.get_fields_of_class(b) for b in cls.__bases__]
+		ii = [len(ff) > 0 for ff in new_fields].index(True) if any(len(ff) > 0 for ff in new_fields) else 0
+		cls = cls.__bases__[ii]
+		for name, value in new_fields[ii].items():
+			if name not in fields:
+				fields[name] = value
+	return fields
+
+def legacy_construct(cls, **kwargs):
+	""" per instance field lookup and type check, as kast.Node.__init__ used to do """
+	fields = _legacy_get_fields(cls)
+	for name, value in fields.items():
+		if not name in kwargs and not kast._is_optional(value):
+			raise TypeError("Missing value for field `{}`".format(name))
+	for name, value in kwargs.items():
+		if not _legacy_isinstance(value, fields[name]):
+			raise TypeError(name)
+	node = object.__new__(cls)
+	for name in fields.keys():
+		object.__setattr__(node, name, kwargs.get(name, None))
+	return node
+
+def construct(cls, **kwargs):
+	return cls(**kwargs)
+
+def binop_tree(depth: int, mk=construct):
+	""" balanced tree of `and` operations over 2**depth references """
+	if depth == 0:
+		return mk(firrtl.Ref, name="a")
+	return mk(firrtl.BinOp, op=firrtl.Bop.And, e1=binop_tree(depth - 1, mk), e2=binop_tree(depth - 1, mk))
+
+def bench_construct(depth=15):
+	count = 2 ** (depth + 1) - 1
+	report("construct (legacy per instance checks)", best_of(lambda: binop_tree(depth, legacy_construct)), count)
+	report("construct (compiled schema)", best_of(lambda: binop_tree(depth)), count)
+
+## Synthetic Designs ##
+
+def synthetic(n: int, T=None):
+	""" gaa module with `n` registers and `n` rules that each compare two neighbouring registers """
+	import gaa
+	T = gaa.UInt(32) if T is None else T
+	mod = gaa.Module(name=f"Synthetic{n}")
+	regs = [gaa.Reg(T, ii) for ii in range(n)]
+	for ii, reg in enumerate(regs):
+		setattr(mod, f"r{ii}", reg)
+	for ii in range(n):
+		a, b = regs[ii], regs[(ii + 1) % n]
+		with mod.rule(f"step{ii}").guard((a < b) & (b != T(0))) as r:
+			r.update(**{f"r{ii}": b - a})
+	return mod
+
+def synthetic_circuit(n: int) -> firrtl.Circuit:
+	import gaa
+	return gaa.elaborate(synthetic(n))
+
+def counters(n: int, depth=16) -> str:
+	""" FIRRTL text of `n` independent counters that only count while their `en_<i>` input is
+	    set, each followed by `depth` operations of combinational logic """
+	lines = [f"circuit Counters{n} :", f"  module Counters{n} :",
+		"    input clock : Clock", "    input reset : UInt<1>"]
+	lines += [f"    input en_{ii} : UInt<1>" for ii in range(n)]
+	lines += [f"    output out_{ii} : UInt<32>" for ii in range(n)]
+	for ii in range(n):
+		lines.append(f"    reg c_{ii} : UInt<32>, clock with: (reset => (reset, UInt<32>(0)))")
+		lines.append(f"    c_{ii} <= mux(en_{ii}, tail(add(c_{ii}, UInt<32>(1)), 1), c_{ii})")
+		prev = f"c_{ii}"
+		for dd in range(depth):
+			lines.append(f"    node x_{ii}_{dd} = xor(tail(add({prev}, shr({prev}, {dd % 5 + 1})), 1), UInt<32>({dd + 1}))")
+			prev = f"x_{ii}_{dd}"
+		lines.append(f"    out_{ii} <= {prev}")
+	return "\n".join(lines) + "\n"
+
+def unique_nodes(root) -> list:
+	""" every node reachable from `root`, shared nodes are only included once """
+	seen, todo, nodes = set(), [root], []
+	while len(todo) > 0:
+		node = todo.pop()
+		if isinstance(node, (list, tuple)):
+			todo += node
+		elif isinstance(node, kast.Node) and id(node) not in seen:
+			seen.add(id(node))
+			nodes.append(node)
+			todo += [value for _, value in kast.iter_fields(node)]
+	return nodes
+
+## Memory ##
+
+def bench_memory(n=256):
+	import tracemalloc
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	circuit = synthetic_circuit(n)
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	# the lists of a node are accounted for in the bytes of the node
+	count = len(unique_nodes(circuit))
+	print(f"synthetic circuit with {n} rules: {count} nodes")
+	print(f"{after - before} bytes traced, {(after - before) / count:.1f} bytes/node")
+	tracemalloc.start()
+	before = tracemalloc.get_traced_memory()[0]
+	tree = binop_tree(16)
+	after = tracemalloc.get_traced_memory()[0]
+	tracemalloc.stop()
+	count = 2 ** 17 - 1
+	print(f"binop tree: {count} nodes, {(after - before) / count:.1f} bytes/node")
+
+def bench_hash_consing(n=256):
+	for label, context in [("plain", None), ("hash consing", kast.HashConsing)]:
+		start = time.perf_counter()
+		if context is None:
+			circuit = synthetic_circuit(n)
+		else:
+			with context():
+				circuit = synthetic_circuit(n)
+		seconds = time.perf_counter() - start
+		print(f"{label:<20} {len(unique_nodes(circuit)):8} unique nodes {seconds * 1e3:10.2f} ms")
+
+## Transformations ##
+
+class CheckedTransformer(kast.NodeTransformer):
+	""" rebuilds every node through the type checking constructor """
+	def generic_visit(self, node):
+		if not isinstance(node, kast.Node):
+			return node
+		values = {}
+		for name, old in kast.iter_fields(node):
+			if old is None: continue
+			values[name] = [self.visit(vv) for vv in old] if isinstance(old, list) else self.visit(old)
+		return node.__class__(**values)
+
+class RenameRefs(kast.NodeTransformer):
+	""" prefixes every reference, so all nodes above a reference are rebuilt through the trusted map """
+	def visit_Ref(self, node):
+		return firrtl.Ref._trusted("_" + node.name)
+
+def bench_transform(n=128):
+	report("elaborate", best_of(lambda: synthetic_circuit(n)), n, unit="rule")
+	circuit = synthetic_circuit(n)
+	count = len(unique_nodes(circuit))
+	report("transform (checked constructor)", best_of(lambda: CheckedTransformer().visit(circuit)), count)
+	assert RenameRefs().visit(circuit) is not circuit
+	report("transform (trusted map)", best_of(lambda: RenameRefs().visit(circuit)), count)
+	report("validate", best_of(lambda: kast.validate(circuit)), count)
+
+def bench_dag_transform(n=128):
+	from gaa.elaboration import Elaboration, DeclareRegistersAndWires
+	with kast.HashConsing():
+		mod = Elaboration().run(synthetic(n)).modules[0]
+	print(f"input: {len(unique_nodes(mod))} unique nodes")
+	for memoize in [False, True]:
+		pass_ = DeclareRegistersAndWires()
+		pass_.memoize = memoize
+		seconds = best_of(lambda: pass_.run(mod, "reset", "clk"))
+		out = pass_.run(mod, "reset", "clk")
+		label = "memoized" if memoize else "per path"
+		print(f"declare registers ({label:<8}) {seconds * 1e3:10.2f} ms {len(unique_nodes(out)):8} unique nodes")
+
+## Serialization ##
+
+def check_round_trip(root):
+	""" the serialized format is canonical, so re-serializing the loaded tree has to yield the same bytes """
+	data = kast.dumps(root)
+	loaded = kast.loads(data)
+	assert kast.dumps(loaded) == data
+	assert len(unique_nodes(loaded)) == len(unique_nodes(root)), "sharing was not preserved"
+	if isinstance(root, firrtl.Circuit):
+		assert firrtl.ToString().visit(loaded) == firrtl.ToString().visit(root)
+	return loaded
+
+def bench_serialize(n=1500):
+	import pickle
+	# round trips of firrtl and gaa level trees, with and without shared nodes
+	check_round_trip(synthetic_circuit(16))
+	with kast.HashConsing():
+		check_round_trip(synthetic_circuit(16))
+	for rule in synthetic(4).rules:
+		check_round_trip(rule.guard_expr)
+	check_round_trip(firrtl.Literal(value=-(1 << 100), typ=firrtl.SInt(102)))
+
+	circuit = synthetic_circuit(n)
+	count = len(unique_nodes(circuit))
+	print(f"synthetic circuit with {n} rules: {count} nodes")
+	data = kast.dumps(circuit)
+	report(f"kast.dumps ({len(data) / count:.1f} bytes/node)", best_of(lambda: kast.dumps(circuit)), count)
+	report("kast.loads", best_of(lambda: kast.loads(data)), count)
+	# pickle recurses along deep expressions
+	sys.setrecursionlimit(max(sys.getrecursionlimit(), 100 * n))
+	data = pickle.dumps(circuit, protocol=pickle.HIGHEST_PROTOCOL)
+	report(f"pickle.dumps ({len(data) / count:.1f} bytes/node)",
+		best_of(lambda: pickle.dumps(circuit, protocol=pickle.HIGHEST_PROTOCOL)), count)
+	report("pickle.loads", best_of(lambda: pickle.loads(data)), count)
+
+## Emission ##
+
+def bench_emit(n=512):
+	import os, tracemalloc
+	circuit = synthetic_circuit(n)
+	def to_string():
+		with open(os.devnull, 'wb') as ff:
+			ff.write(firrtl.ToString().visit(circuit).encode('UTF-8'))
+	def stream():
+		with open(os.devnull, 'wb') as ff:
+			firrtl.emit(circuit, ff)
+	for label, fun in [("ToString + encode", to_string), ("streaming Emitter", stream)]:
+		tracemalloc.start()
+		fun()
+		peak = tracemalloc.get_traced_memory()[1]
+		tracemalloc.stop()
+		print(f"{label:<20} {best_of(fun) * 1e3:10.2f} ms {peak / 1e6:10.2f} MB peak")
+
+class RawFormats(kast.NodeTransformer):
+	""" adds a raw newline and quotes to every printf format, as `display` can write them """
+	def visit_PrintF(self, node):
+		return node.set(format_str=node.format_str + '\n"quoted"\n')
+
+def check_parse(circuit):
+	""" the emitted text parses back into a circuit that prints the same """
+	import io, firrtl_parser
+	out = io.BytesIO()
+	firrtl.emit(circuit, out)
+	parsed = firrtl_parser.parse(out.getvalue().decode('UTF-8'))
+	assert firrtl.ToString().visit(parsed) == firrtl.ToString().visit(circuit)
+
+def bench_parse(n=512):
+	import os, tempfile, firrtl_parser, gaa
+	from deep_thought import A_Testbench
+	check_parse(RawFormats().visit(gaa.elaborate(A_Testbench())))
+	for bad in ['UInt<4>("x12")', 'UInt<4>("h1g")', 'UInt<4>("")']:
+		try:
+			firrtl_parser.parse(f"circuit m :\n  module m :\n    output o : UInt<4>\n    o <= {bad}\n")
+			assert False, f"{bad} was accepted"
+		except firrtl_parser.ParseError as ee:
+			assert str(ee).startswith("line 4:"), ee
+	circuit = synthetic_circuit(n)
+	with tempfile.NamedTemporaryFile(suffix='.fir', delete=False) as ff:
+		firrtl.emit(circuit, ff)
+		fir_file = ff.name
+	try:
+		size = os.path.getsize(fir_file)
+		parsed = firrtl_parser.parse_file(fir_file)
+		assert firrtl.ToString().visit(parsed) == firrtl.ToString().visit(circuit)
+		seconds = best_of(lambda: firrtl_parser.parse_file(fir_file))
+		print(f"parse {size / 1e6:.2f} MB: {seconds * 1e3:10.2f} ms {size / 1e6 / seconds:8.2f} MB/s")
+	finally:
+		os.unlink(fir_file)
+
+## Analysis ##
+
+def bench_infer(n=512):
+	import firrtl_passes
+	for label, context in [("plain", None), ("hash consing", kast.HashConsing)]:
+		if context is None:
+			mod = synthetic_circuit(n).modules[0]
+		else:
+			with context():
+				mod = synthetic_circuit(n).modules[0]
+		count = len(unique_nodes(mod))
+		report(f"infer types ({label}, {count} nodes)", best_of(lambda: firrtl_passes.infer_types(mod)), count)
+
+def bench_fold(cycles=200):
+	import io, gaa, firrtl_passes
+	from gcd import Gcd
+	from deep_thought import A_Testbench
+	from compiled_simulator import CompiledSimulator, CompileCache
+	designs = [("gcd", lambda: gaa.elaborate(Gcd(gaa.UInt(32)))), ("deep_thought", lambda: gaa.elaborate(A_Testbench()))]
+	designs += [(f"synthetic{n}", lambda n=n: synthetic_circuit(n)) for n in [64, 256, 1024]]
+	for name, build in designs:
+		circuit = build()
+		mod = circuit.modules[0]
+		folded = firrtl_passes.constant_fold(mod)
+		before, after = len(unique_nodes(mod)), len(unique_nodes(folded))
+		text_before, text_after = len(firrtl.ToString().visit(mod)), len(firrtl.ToString().visit(folded))
+		seconds = best_of(lambda: firrtl_passes.constant_fold(mod), repeat=1)
+		print(f"fold {name:<16} {before:8} -> {after:8} nodes {text_before:9} -> {text_after:9} bytes "
+			f"{seconds * 1e3:10.2f} ms {seconds / before * 1e6:6.2f} us/node")
+		step = []
+		for fold in [False, True]:
+			sim = CompiledSimulator(out=io.StringIO(), cache=CompileCache(0), fold=fold)
+			sim.load(circuit)
+			sim.poke("reset", 1)
+			sim.step(1)
+			sim.poke("reset", 0)
+			step.append(best_of(lambda: sim.step(cycles)) / cycles)
+		print(f"     {'':<16} simulation {step[0] * 1e6:10.2f} -> {step[1] * 1e6:10.2f} us/cycle ({step[0] / step[1]:5.2f}x)")
+
+def bench_cone(n=1024):
+	import firrtl_passes
+	mod = synthetic_circuit(n).modules[0]
+	# the firing signals of one early and of the last rule
+	wires = [stmt.lhs.name for stmt in mod.statements if isinstance(stmt, firrtl.Connect)]
+	count = len(unique_nodes(mod))
+	for name in [wires[n + 2], wires[-1]]:
+		pruned = firrtl_passes.cone_of_influence(mod, [name])
+		print(f"observe {name}: {count} -> {len(unique_nodes(pruned))} nodes, "
+			f"{len(mod.statements)} -> {len(pruned.statements)} statements")
+		report("cone of influence", best_of(lambda: firrtl_passes.cone_of_influence(mod, [name])), count)
+
+def bench_share(sizes=(64, 256, 1024)):
+	import io, firrtl_parser
+	for n in sizes:
+		with kast.HashConsing():
+			circuit = synthetic_circuit(n)
+		for share in [False, True]:
+			out = io.BytesIO()
+			firrtl.emit(circuit, out, share=share)
+			seconds = best_of(lambda: firrtl.emit(circuit, io.BytesIO(), share=share), repeat=1)
+			parse = best_of(lambda: firrtl_parser.parse(out.getvalue()), repeat=1)
+			label = "node statements" if share else "trees"
+			print(f"{n:5} rules, {label:<16} {len(out.getvalue()) / 1e6:8.2f} MB "
+				f"emit {seconds * 1e3:10.2f} ms parse {parse * 1e3:10.2f} ms")
+
+def bench_lower(n=512):
+	import tracemalloc, firrtl_lower
+	for label, context in [("plain", None), ("hash consing", kast.HashConsing)]:
+		tracemalloc.start()
+		if context is None:
+			mod = synthetic_circuit(n).modules[0]
+		else:
+			with context():
+				mod = synthetic_circuit(n).modules[0]
+		tree_bytes = tracemalloc.get_traced_memory()[0]
+		before = tree_bytes
+		prog = firrtl_lower.lower(mod)
+		prog_bytes = tracemalloc.get_traced_memory()[0] - before
+		tracemalloc.stop()
+		count = len(unique_nodes(mod))
+		print(f"{label}: {count} nodes {tree_bytes / 1e6:.2f} MB -> {len(prog)} instructions {prog_bytes / 1e6:.2f} MB")
+		report(f"lower ({label})", best_of(lambda: firrtl_lower.lower(mod), repeat=1), count)
+
+def bench_lower_types(n=1024):
+	import firrtl_passes, firrtl_lower
+	req = firrtl.Bundle(fields=[firrtl.Field(name="addr", typ=firrtl.UInt(32)), firrtl.Field(name="data", typ=firrtl.UInt(64))])
+	io = firrtl.Port(name="io", typ=firrtl.Vector(elementtype=req, count=n), dir=firrtl.PortDir.Input)
+	out = firrtl.Port(name="sum", typ=firrtl.UInt(64), dir=firrtl.PortDir.Output)
+	total = firrtl.SubField(e=firrtl.SubIndex(e=firrtl.Ref(name="io"), n=0), name="data")
+	for ii in range(1, n):
+		elem = firrtl.SubField(e=firrtl.SubIndex(e=firrtl.Ref(name="io"), n=ii), name="data")
+		total = firrtl.Tail(e=firrtl.BinOp(op=firrtl.Bop.Add, e1=total, e2=elem), n=1)
+	mod = firrtl.Module(name="Sum", ports=[io, out], statements=[firrtl.Connect(lhs=firrtl.Ref(name="sum"), rhs=total)])
+	report("lower types", best_of(lambda: firrtl_passes.lower_types(mod)), 2 * n, unit="element")
+	lowered, paths = firrtl_passes.lower_types(mod)
+	prog = firrtl_lower.lower(lowered)
+	prog.add_paths(paths)
+	keys = [f"io[{ii}].addr" for ii in range(n)]
+	def munge():
+		for key in keys:
+			prog.symbols[key.replace('[', '_').replace('].', '_')]
+	def lookup():
+		for key in keys:
+			prog.symbols[key]
+	report("path lookup (string munging)", best_of(munge), n, unit="lookup")
+	report("path lookup (precomputed)", best_of(lookup), n, unit="lookup")
+
+## Simulation ##
+
+def bench_compiled(sizes=(64, 256)):
+	import io, gaa
+	from simulator import Simulator
+	from gcd import Gcd
+	designs = [("gcd", gaa.elaborate(Gcd(gaa.UInt(32))))]
+	for n in sizes:
+		with kast.HashConsing():
+			designs.append((f"synthetic{n}", synthetic_circuit(n)))
+	for name, circuit in designs:
+		sim = Simulator.start_compiled(out=io.StringIO())
+		start = time.perf_counter()
+		sim.load(circuit)
+		load = time.perf_counter() - start
+		sim.poke("reset", 1)
+		sim.step(1)
+		sim.poke("reset", 0)
+		cycles = 1000
+		seconds = best_of(lambda: sim.step(cycles))
+		print(f"{name:<16} {len(sim.prog):8} instructions load {load * 1e3:10.2f} ms "
+			f"{seconds / cycles * 1e6:10.2f} us/cycle")
+
+def bench_batch(n=64, lanes=4096):
+	import io
+	from compiled_simulator import CompiledSimulator
+	try:
+		from batch_simulator import BatchSimulator
+		BatchSimulator(1)
+	except ImportError:
+		print("numpy is not installed")
+		return
+	with kast.HashConsing():
+		circuit = synthetic_circuit(n)
+	scalar = CompiledSimulator(out=io.StringIO())
+	scalar.load(circuit)
+	cycles = 100
+	seconds = best_of(lambda: scalar.step(cycles))
+	print(f"compiled, 1 lane     {seconds / cycles * 1e6:10.2f} us/cycle {cycles / seconds:12.0f} lane cycles/s")
+	for count in [64, lanes]:
+		batch = BatchSimulator(count, out=io.StringIO())
+		batch.load(circuit)
+		batch.poke("reset", 1)
+		batch.step(1)
+		batch.poke("reset", 0)
+		seconds = best_of(lambda: batch.step(cycles))
+		print(f"batch, {count:5} lanes {seconds / cycles * 1e6:10.2f} us/cycle {count * cycles / seconds:12.0f} lane cycles/s")
+
+def bench_incremental(n=256, block_size=128):
+	import io
+	from compiled_simulator import CompiledSimulator, IncrementalSimulator
+	ir = counters(n)
+	cycles = 200
+	for active in [0, 1, n // 16, n]:
+		results = []
+		for sim in [CompiledSimulator(out=io.StringIO()), IncrementalSimulator(out=io.StringIO(), block_size=block_size)]:
+			sim.load(ir)
+			sim.poke("reset", 1)
+			sim.step(1)
+			sim.poke("reset", 0)
+			for ii in range(active):
+				sim.poke(f"en_{ii}", 1)
+			results.append(best_of(lambda: sim.step(cycles)) / cycles)
+		full, incremental = results
+		print(f"{active:4}/{n} counters active: full {full * 1e6:10.2f} us/cycle "
+			f"incremental {incremental * 1e6:10.2f} us/cycle ({full / incremental:5.2f}x)")
+
+def bench_fork(n=256, prefix=100):
+	import io, pickle
+	from compiled_simulator import CompiledSimulator, CompileCache
+	ir, cache = counters(n), CompileCache(1)
+	def run_prefix():
+		sim = CompiledSimulator(out=io.StringIO(), cache=cache)
+		sim.load(ir)
+		sim.poke("reset", 1)
+		sim.step(1)
+		sim.poke("reset", 0)
+		for ii in range(0, n, 2):
+			sim.poke(f"en_{ii}", 1)
+		sim.step(prefix)
+		return sim
+	sim = run_prefix()
+	snap = sim.snapshot()
+	report("load, reset and prefix", best_of(run_prefix), 1, unit="test")
+	report("snapshot", best_of(sim.snapshot), 1, unit="test")
+	report("restore", best_of(lambda: sim.restore(snap)), 1, unit="test")
+	report("fork", best_of(sim.fork), 1, unit="test")
+	report("pickle round trip of a snapshot", best_of(lambda: pickle.loads(pickle.dumps(snap))), 1, unit="test")
+	report("pickle round trip of a simulator", best_of(lambda: pickle.loads(pickle.dumps(sim))), 1, unit="test")
+
+def bench_cache(n=64, tests=10):
+	import io
+	from compiled_simulator import CompiledSimulator, CompileCache
+	ir = counters(n)
+	def load(cache_size):
+		cache = CompileCache(cache_size)
+		for _ in range(tests):
+			CompiledSimulator(out=io.StringIO(), cache=cache).load(ir)
+		return cache
+	report("load without cache", best_of(lambda: load(0)), tests, unit="load")
+	report("load with cache", best_of(lambda: load(1)), tests, unit="load")
+	sim = CompiledSimulator(out=io.StringIO(), cache=CompileCache(1))
+	sim.load(ir)
+	report("reload into the same simulator", best_of(lambda: sim.load(ir)), 1, unit="load")
+	print(load(1).stats)
+
+## Client/Server ##
+
+def local_server(treadle=None):
+	""" TreadleServer on a free local port backed by the compiled stand-in for treadle """
+	import threading
+	from simulator import TreadleServer
+	from treadle_repl import CompiledRepl
+	server = TreadleServer('127.0.0.1', 0, CompiledRepl() if treadle is None else treadle)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+	return server
+
+def server_process(*args):
+	""" runs `python3 args...` with "{port}" in `args` replaced by a free port, so the server
+	    does not compete with the benchmark for the GIL, returns the process and port """
+	import socket, subprocess
+	with socket.socket() as sock:
+		sock.bind(('127.0.0.1', 0))
+		port = sock.getsockname()[1]
+	args = [arg.format(port=port) for arg in args]
+	proc = subprocess.Popen([sys.executable, *args], stdout=subprocess.DEVNULL)
+	for _ in range(500):
+		try:
+			socket.create_connection(('127.0.0.1', port)).close()
+			return proc, port
+		except ConnectionRefusedError:
+			time.sleep(0.01)
+	proc.kill()
+	raise TimeoutError("server did not start")
+
+def bench_transaction(n=5, cycles=200):
+	from simulator import Simulator, TreadleClient, TreadleWrapper
+	server = local_server()
+	clients = [("tcp", lambda: TreadleClient.start(port=server.server_address[1])),
+		("pipe", lambda: TreadleWrapper(cmd=f"{sys.executable} treadle_repl.py").start())]
+	for name, start in clients:
+		sim = Simulator(start())
+		sim.load(counters(n))
+		def unbatched():
+			for cc in range(cycles):
+				for ii in range(n):
+					sim.poke(f"en_{ii}", cc & 1)
+				for ii in range(n):
+					sim.peek(f"out_{ii}")
+				sim.step(1)
+		def batched():
+			for cc in range(cycles):
+				with sim.batch() as bb:
+					for ii in range(n):
+						bb.poke(f"en_{ii}", cc & 1)
+					for ii in range(n):
+						bb.peek(f"out_{ii}")
+					bb.step(1)
+		report(f"{name}: {n} pokes, {n} peeks, step", best_of(unbatched), cycles, unit="cycle")
+		report(f"{name}: batched", best_of(batched), cycles, unit="cycle")
+		sim.stop()
+	server.shutdown()
+
+def bench_io(n=8, commands=2000):
+	from simulator import Simulator, TreadleWrapper
+	for engine in ['thread', 'select']:
+		sim = Simulator(TreadleWrapper(cmd=f"{sys.executable} treadle_repl.py", engine=engine).start())
+		sim.load(counters(n))
+		def peeks():
+			for ii in range(commands):
+				sim.peek(f"c_{ii % n}")
+		def pokes():
+			for ii in range(commands):
+				sim.poke(f"en_{ii % n}", ii & 1)
+			sim.peek("c_0")
+		def cycles():
+			for cc in range(commands // 4):
+				sim.poke("en_0", cc & 1)
+				sim.poke("en_1", 1)
+				sim.step(1)
+				sim.peek("c_0")
+		cmds = [(f"peek c_{ii % n}", 1) for ii in range(commands)]
+		report(f"{engine:<6} peek", best_of(peeks), commands, unit="command")
+		report(f"{engine:<6} poke", best_of(pokes), commands, unit="command")
+		report(f"{engine:<6} poke, poke, step, peek", best_of(cycles), commands, unit="command")
+		report(f"{engine:<6} batch of peeks", best_of(lambda: sim.treadle.execute_batch(cmds)), commands, unit="command")
+		sim.stop()
+
+def bench_protocol(n=64, cycles=100):
+	from simulator import Simulator, TreadleClient
+	proc, port = server_process("treadle_repl.py", "server", "{port}")
+	ir = counters(n, depth=1)
+	names = [f"out_{ii}" for ii in range(n)] * 64
+	for framed in [False, True]:
+		name = "framed" if framed else "text"
+		sim = Simulator(TreadleClient.start(port=port, framed=framed))
+		sim.load(ir)
+		sim.poke_many({f"en_{ii}": 1 for ii in range(n)})
+		report(f"{name}: peek", best_of(lambda: [sim.peek("out_0") for _ in range(cycles)]), cycles, unit="peek")
+		report(f"{name}: bulk peek of {len(names)} values", best_of(lambda: sim.peek_many(names)), len(names), unit="value")
+		report(f"{name}: trace of 16 signals", best_of(lambda: list(sim.trace(names[:16], cycles))), cycles, unit="cycle")
+		sim.stop()
+	proc.terminate()
+
+def bench_sessions(clients=4, cycles=200):
+	import threading
+	from simulator import Simulator, TreadleClient
+	ir = counters(16, depth=4)
+	def client(port: int, index: int, waits: list, errors: list):
+		start = time.perf_counter()
+		sim = Simulator(TreadleClient.start(port=port))
+		sim.load(ir)
+		waits.append(time.perf_counter() - start)
+		sim.poke("reset", 1)
+		sim.step(1)
+		sim.poke("reset", 0)
+		sim.poke(f"en_{index}", 1)
+		for cc in range(cycles):
+			if sim.peek(f"c_{index}") != cc:
+				errors.append(index)
+				break
+			sim.step(1)
+		sim.stop()
+	servers = [("one shared treadle", ("treadle_repl.py", "server", "{port}")),
+		(f"asyncio, {clients} processes", ("treadle_server.py", "{port}", str(clients), "--compiled"))]
+	for name, args in servers:
+		proc, port = server_process(*args)
+		# the second round runs on processes that are already started
+		for round in ["cold", "warm"]:
+			waits, errors = [], []
+			threads = [threading.Thread(target=client, args=(port, ii, waits, errors)) for ii in range(clients)]
+			start = time.perf_counter()
+			for tt in threads:
+				tt.start()
+			for tt in threads:
+				tt.join()
+			seconds = time.perf_counter() - start
+			print(f"{name + ', ' + round:<30} {clients} x {cycles} cycles {seconds * 1e3:9.2f} ms, "
+				f"longest load {max(waits) * 1e3:9.2f} ms, {len(set(errors))} clients saw wrong values")
+		proc.terminate()
+		proc.wait()
+
+def bench_server_cache(n=64, tests=10):
+	from simulator import Simulator, TreadleClient
+	# alternating between two circuits, a session only keeps the last one compiled
+	irs = [counters(n), counters(n + 1)]
+	for cache_size in [0, 4]:
+		proc, port = server_process("treadle_repl.py", "server", "{port}", "--cache", str(cache_size))
+		sim = Simulator(TreadleClient.start(port=port))
+		def load():
+			for ii in range(tests):
+				sim.load(irs[ii % 2])
+		report(f"load over tcp, cache of {cache_size}", best_of(load), tests, unit="load")
+		print(sim.cache_stats())
+		sim.stop()
+		proc.terminate()
+		proc.wait()
+
+def bench_pool(tests=10, cycles=20, size=2):
+	from simulator import Simulator, TreadleWrapper, TreadlePool
+	ir = counters(16, depth=4)
+	start_repl = lambda: TreadleWrapper(cmd=f"{sys.executable} treadle_repl.py").start()
+	def test(sim):
+		sim.poke("reset", 1)
+		sim.step(1)
+		sim.poke("reset", 0)
+		sim.poke("en_0", 1)
+		sim.step(cycles)
+		assert sim.peek("c_0") == cycles
+	def fresh():
+		for _ in range(tests):
+			sim = Simulator(start_repl())
+			sim.load(ir)
+			test(sim)
+			sim.stop()
+	report("new process per test", best_of(fresh, repeat=1), tests, unit="test")
+	with TreadlePool(size=size, factory=start_repl) as pool:
+		def pooled():
+			for _ in range(tests):
+				with pool.checkout(ir) as sim:
+					test(sim)
+		report(f"pool of {size}, first round", best_of(pooled, repeat=1), tests, unit="test")
+		report(f"pool of {size}", best_of(pooled), tests, unit="test")
+		print(pool.stats)
+
+## Traversal ##
+
+def and_chain(depth: int):
+	""" left nested chain of `and` operations, as built by `reduce` or `guard` """
+	e = firrtl.Ref("a")
+	for _ in range(depth):
+		e = firrtl.BinOp(op=firrtl.Bop.And, e1=e, e2=firrtl.Ref("b"))
+	return e
+
+class FindRefs(kast.NodeVisitor):
+	def run(self, node):
+		self.refs = set()
+		self.visit(node)
+		return self.refs
+	def visit_Ref(self, node):
+		self.refs.add(node.name)
+
+def bench_traverse(depth=100000):
+	chain = and_chain(depth)
+	count = 2 * depth + 1
+	report("visit deep chain", best_of(lambda: FindRefs().run(chain)), count)
+	report("transform deep chain", best_of(lambda: kast.NodeTransformer().visit(chain)), count)
+	report("to string deep chain", best_of(lambda: firrtl.ToString().visit(chain)), count)
+
+benchmarks = {
+	'construct': bench_construct,
+	'memory': bench_memory,
+	'hash_consing': bench_hash_consing,
+	'transform': bench_transform,
+	'dag_transform': bench_dag_transform,
+	'serialize': bench_serialize,
+	'emit': bench_emit,
+	'parse': bench_parse,
+	'infer': bench_infer,
+	'fold': bench_fold,
+	'cone': bench_cone,
+	'share': bench_share,
+	'lower': bench_lower,
+	'lower_types': bench_lower_types,
+	'compiled': bench_compiled,
+	'batch': bench_batch,
+	'incremental': bench_incremental,
+	'fork': bench_fork,
+	'cache': bench_cache,
+	'transaction': bench_transaction,
+	'io': bench_io,
+	'protocol': bench_protocol,
+	'sessions': bench_sessions,
+	'server_cache': bench_server_cache,
+	'pool': bench_pool,
+	'traverse': bench_traverse,
+}
+
+if __name__ == '__main__':
+	names = sys.argv[1:] if len(sys.argv) > 1 else list(benchmarks.keys())
+	for name in names:
+		print(f"## {name}")
+		benchmarks[name]()
@@ -0,0 +1,603 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2018, University of California, Berkeley
+# author: Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+# in-process simulator: circuits are compiled to straight line Python code
+
+import hashlib, sys, threading, time
+from collections import OrderedDict
+from firrtl_lower import Op, Program, lower
+from firrtl_passes import lower_types, constant_fold
+
+def _mask(width: int) -> int:
+	return (1 << width) - 1
+
+def _normalize(value: int, width: int, signed: bool) -> int:
+	""" UInt values are stored as non-negative ints, SInt values as signed ints """
+	value &= _mask(width)
+	if signed and width > 0 and value >> (width - 1):
+		value -= 1 << width
+	return value
+
+def _printf_format(fmt: str) -> str:
+	""" translates a FIRRTL printf format string into a `str.format` string """
+	out, ii = [], 0
+	escapes = {'n': '\n', 't': '\t', '\\': '\\', '"': '"', "'": "'"}
+	conversions = {'d': '{}', 'x': '{:x}', 'b': '{:b}', 'c': '{:c}', '%': '%'}
+	while ii < len(fmt):
+		cc = fmt[ii]
+		if cc in '\\%' and ii + 1 < len(fmt):
+			table = escapes if cc == '\\' else conversions
+			out.append(table.get(fmt[ii + 1], cc + fmt[ii + 1]))
+			ii += 2
+			continue
+		out.append({'{': '{{', '}': '}}'}.get(cc, cc))
+		ii += 1
+	return "".join(out)
+
+def _signed_of(prog: Program, value: int) -> bool:
+	return prog.signed[value] == 1
+
+def _operands(prog: Program, ii: int) -> list:
+	""" the values that instruction `ii` reads """
+	op = prog.op[ii]
+	if op in (Op.INPUT, Op.REG, Op.CONST):
+		return []
+	if op == Op.MUX:
+		return [prog.a[ii], prog.b[ii], prog.c[ii]]
+	if op in (Op.PAD, Op.SHL, Op.SHR, Op.HEAD, Op.TAIL, Op.BITS) or Op.AS_UINT <= op <= Op.NOT:
+		return [prog.a[ii]]
+	return [prog.a[ii], prog.b[ii]]
+
+def _expression(prog: Program, ii: int) -> str:
+	""" Python expression that computes instruction `ii` from the locals `t<operand>` """
+	op, a, b, c = prog.op[ii], prog.a[ii], prog.b[ii], prog.c[ii]
+	width, signed = prog.width[ii], prog.signed[ii] == 1
+	mask = _mask(width)
+	ta, tb, tc = f"t{a}", f"t{b}", f"t{c}"
+	def unsigned(value: int) -> str:
+		# the bit pattern of an operand
+		return f"(t{value} & {_mask(prog.width[value])})" if _signed_of(prog, value) else f"t{value}"
+	def result(expr: str) -> str:
+		# truncates to the result width, signed results are sign extended again
+		if signed:
+			return f"((({expr}) + {1 << (width - 1)}) & {mask}) - {1 << (width - 1)}"
+		return f"(({expr}) & {mask})"
+	if op == Op.ADD or op == Op.MUL:
+		return f"{ta} {'+' if op == Op.ADD else '*'} {tb}"
+	if op == Op.SUB:
+		return f"{ta} - {tb}" if signed else result(f"{ta} - {tb}")
+	if op == Op.DIV:
+		if signed:
+			return f"(0 if {tb} == 0 else (abs({ta}) // abs({tb})) * (1 if ({ta} < 0) == ({tb} < 0) else -1))"
+		return f"(0 if {tb} == 0 else {ta} // {tb})"
+	if op == Op.REM:
+		if signed:
+			return f"(0 if {tb} == 0 else (abs({ta}) % abs({tb})) * (-1 if {ta} < 0 else 1))"
+		return f"(0 if {tb} == 0 else {ta} % {tb})"
+	if op in (Op.AND, Op.OR, Op.XOR):
+		sym = {Op.AND: '&', Op.OR: '|', Op.XOR: '^'}[op]
+		if _signed_of(prog, a) or _signed_of(prog, b):
+			return result(f"{ta} {sym} {tb}")
+		return f"{ta} {sym} {tb}"
+	if op == Op.CAT:
+		return f"({unsigned(a)} << {prog.width[b]}) | {unsigned(b)}"
+	if Op.EQ <= op <= Op.GE:
+		sym = {Op.EQ: '==', Op.NE: '!=', Op.LT: '<', Op.GT: '>', Op.LE: '<=', Op.GE: '>='}[op]
+		return f"int({ta} {sym} {tb})"
+	if op == Op.DSHL:
+		return f"{ta} << {tb}"
+	if op == Op.DSHR:
+		return f"{ta} >> {tb}"
+	if op == Op.AS_UINT or op == Op.AS_CLOCK:
+		return unsigned(a)
+	if op == Op.AS_SINT:
+		return result(ta) if not _signed_of(prog, a) else ta
+	if op == Op.CVT or op == Op.PAD:
+		return ta
+	if op == Op.NEG:
+		return f"-{ta}"
+	if op == Op.NOT:
+		return f"{unsigned(a)} ^ {mask}"
+	if op == Op.SHL:
+		return f"{ta} << {b}"
+	if op == Op.SHR:
+		return f"{ta} >> {b}"
+	if op == Op.HEAD:
+		return f"{unsigned(a)} >> {prog.width[a] - b}"
+	if op == Op.TAIL or op == Op.BITS:
+		shift = c if op == Op.BITS else 0
+		return f"({ta} >> {shift}) & {mask}" if shift > 0 else f"{ta} & {mask}"
+	if op == Op.MUX:
+		return f"{tb} if {ta} else {tc}"
+	if op == Op.VALIDIF:
+		return tb
+	raise NotImplementedError(f"compiling {Op(op).name}")
+
+def generate(prog: Program, slots: dict) -> str:
+	""" Python source of `evaluate(I, R, V, N, E)`: reads the inputs `I` and registers `R`,
+	    writes the signals in `slots` to `V`, the next register values to `N` and appends
+	    the printf/stop events of this cycle to `E` """
+	inputs = {value: ii for ii, value in enumerate(prog.inputs.values())}
+	registers = {reg[1]: ii for ii, reg in enumerate(prog.registers)}
+	lines = ["def evaluate(I, R, V, N, E):"]
+	for ii in range(len(prog)):
+		op = prog.op[ii]
+		if op == Op.INPUT:
+			expr = f"I[{inputs[ii]}]"
+		elif op == Op.REG:
+			expr = f"R[{registers[ii]}]"
+		elif op == Op.CONST:
+			expr = str(_normalize(prog.consts[prog.a[ii]], prog.width[ii], prog.signed[ii] == 1))
+		else:
+			expr = _expression(prog, ii)
+		lines.append(f"\tt{ii} = {expr}")
+	for value, slot in slots.items():
+		lines.append(f"\tV[{slot}] = t{value}")
+	for ii, (name, current, next, enable, init) in enumerate(prog.registers):
+		width, signed = prog.width[current], prog.signed[current] == 1
+		if prog.width[next] > width:
+			next_expr = f"((t{next} + {1 << (width - 1)}) & {_mask(width)}) - {1 << (width - 1)}" if signed \
+				else f"t{next} & {_mask(width)}"
+		else:
+			next_expr = f"t{next}"
+		if enable >= 0:
+			next_expr = f"t{init} if t{enable} else {next_expr}"
+		lines.append(f"\tN[{ii}] = {next_expr}")
+	for ii, (clock, condition, fmt, args) in enumerate(prog.printfs):
+		args = "".join(f"t{aa}, " for aa in args)
+		lines.append(f"\tif t{condition}: E.append(({ii}, ({args})))")
+	for ii, (clock, condition, exit_code) in enumerate(prog.stops):
+		lines.append(f"\tif t{condition}: E.append((-1, {exit_code}))")
+	lines.append("\treturn")
+	return "\n".join(lines) + "\n"
+
+def compile_program(ir, fold: bool = True) -> Program:
+	""" lowers the main module of `ir`, which is either FIRRTL text or a firrtl.Circuit,
+	    `fold` runs firrtl_passes.constant_fold first """
+	if isinstance(ir, str):
+		import firrtl_parser
+		ir = firrtl_parser.parse(ir)
+	main = [mm for mm in ir.modules if mm.name == ir.name] or ir.modules[:1]
+	mod, paths = lower_types(main[0])
+	prog = lower(constant_fold(mod) if fold else mod)
+	prog.add_paths(paths)
+	return prog
+
+## Compile Cache ##
+
+class _Digest:
+	""" binary file-like object that only hashes what is written to it """
+	def __init__(self):
+		self.hash = hashlib.sha256()
+
+	def write(self, data: bytes):
+		self.hash.update(data)
+
+def ir_key(ir, options=()) -> str:
+	""" content address of FIRRTL text or a firrtl.Circuit, a circuit is hashed like its
+	    emitted text without building the text in memory """
+	digest = _Digest()
+	digest.write(repr(options).encode('UTF-8') + b'\n')
+	if isinstance(ir, str):
+		digest.write(ir.encode('UTF-8'))
+	else:
+		import firrtl
+		firrtl.emit(ir, digest)
+	return digest.hash.hexdigest()
+
+class CompileCache:
+	""" LRU of compiled circuits that holds at most `size` simulators in their initial state,
+	    without output stream, keyed by `ir_key`. `stats` counts hits and misses, the seconds spent compiling and
+	    the compile seconds that were saved by hits. """
+	def __init__(self, size=32):
+		self.size = size
+		self._entries = OrderedDict()
+		self._lock = threading.Lock()
+		self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'compile_time': 0.0, 'saved_time': 0.0}
+
+	def __len__(self):
+		return len(self._entries)
+
+	def get(self, key: str):
+		with self._lock:
+			sim = self._entries.get(key)
+			if sim is None:
+				self.stats['misses'] += 1
+				return None
+			self._entries.move_to_end(key)
+		self.reuse(sim)
+		return sim
+
+	def reuse(self, sim):
+		""" counts a hit for a simulator that still has the circuit compiled """
+		with self._lock:
+			self.stats['hits'] += 1
+			self.stats['saved_time'] += sim.compile_time
+
+	def put(self, key: str, sim):
+		with self._lock:
+			self.stats['compile_time'] += sim.compile_time
+			self._entries[key] = sim
+			self._entries.move_to_end(key)
+			while len(self._entries) > self.size:
+				self._entries.popitem(last=False)
+				self.stats['evictions'] += 1
+
+	def clear(self):
+		with self._lock:
+			self._entries.clear()
+
+# opt-in cache to share compiled circuits between simulators, `cache=compile_cache`
+compile_cache = CompileCache()
+
+class CompiledSimulator:
+	""" Simulates a circuit in process, with the same interface as `simulator.Simulator`.
+	    All registers are clocked by `step`, printf output is written to `out`.
+	    After a stop statement fired, `exit_code` is set and further steps are ignored.
+	    With `fold` False the circuit is simulated without constant folding.
+	    Without a `cache` only reloading the current circuit skips compilation. """
+	def __init__(self, out=None, cache=None, fold=True):
+		self.out = sys.stdout if out is None else out
+		self.cache = CompileCache(0) if cache is None else cache
+		self.fold = fold
+		self.prog = None
+		self.source = None
+		self.key = None
+
+	def load(self, ir):
+		""" `ir` is either FIRRTL text or a firrtl.Circuit. Loading the current circuit again
+		    only resets the state, circuits in `cache` are not compiled again. """
+		key = ir_key(ir, self.options())
+		if key == self.key:
+			self.cache.reuse(self)
+		else:
+			# a cache of size 0 is not used at all, neither looked up nor filled
+			cached = self.cache.size > 0
+			pristine = self.cache.get(key) if cached else None
+			if pristine is None:
+				self.key = None
+				start = time.perf_counter()
+				self._compile(ir)
+				self.key, self.compile_time = key, time.perf_counter() - start
+				self._reset()
+				if cached:
+					pristine = self.fork()
+					pristine.out = pristine.cache = None
+					self.cache.put(key, pristine)
+				return
+			out, cache = self.out, self.cache
+			self.__dict__.update(pristine.__dict__)
+			self.out, self.cache = out, cache
+		self._reset()
+
+	def options(self) -> tuple:
+		""" settings that change the compiled code, part of the compile cache key """
+		return (self.__class__.__name__, self.fold)
+
+	def _compile(self, ir):
+		prog = compile_program(ir, self.fold)
+		# every named value gets a slot in V, aliases share the slot
+		self.slots, slot_of_value = {}, {}
+		for name, value in prog.symbols.items():
+			if value not in slot_of_value:
+				slot_of_value[value] = len(slot_of_value)
+			self.slots[name] = slot_of_value[value]
+		self.source = generate(prog, slot_of_value)
+		self.prog = prog
+		self._link()
+		# name or path -> index in I
+		input_of_value = {value: ii for ii, value in enumerate(prog.inputs.values())}
+		self.inputs = {name: input_of_value[value] for name, value in prog.symbols.items() if value in input_of_value}
+		self.input_types = [(prog.width[value], prog.signed[value] == 1) for value in prog.inputs.values()]
+		self.formats = [_printf_format(fmt) for _, _, fmt, _ in prog.printfs]
+
+	def _reset(self):
+		prog = self.prog
+		self.I = [0] * len(prog.inputs)
+		self.R = [0] * len(prog.registers)
+		self.N = [0] * len(prog.registers)
+		self.V = [0] * len(set(self.slots.values()))
+		self.E = []
+		self.cycle = 0
+		self.exit_code = None
+		self._dirty = True
+
+	def _link(self):
+		namespace = {}
+		exec(compile(self.source, f"<{self.prog.name}>", "exec"), namespace)
+		self._evaluate = namespace['evaluate']
+
+	def _update(self):
+		if self._dirty:
+			self.E.clear()
+			self._evaluate(self.I, self.R, self.V, self.N, self.E)
+			self._dirty = False
+
+	def peek(self, signal: str) -> int:
+		self._update()
+		return int(self.V[self.slots[signal]])
+
+	def poke(self, signal: str, value: int):
+		ii = self.inputs[signal]
+		width, signed = self.input_types[ii]
+		self.I[ii] = _normalize(value, width, signed)
+		self._dirty = True
+
+	def step(self, count=1):
+		for _ in range(count):
+			if self.exit_code is not None:
+				return
+			self._update()
+			for kind, payload in self.E:
+				if kind < 0:
+					self.exit_code = payload
+				else:
+					self.out.write(self.formats[kind].format(*payload))
+			self.R, self.N = self.N, self.R
+			self.cycle += 1
+			self._dirty = True
+
+	def peek_many(self, signals: list) -> list:
+		return [self.peek(signal) for signal in signals]
+
+	def poke_many(self, values: dict):
+		for signal, value in values.items():
+			self.poke(signal, value)
+
+	def trace(self, signals: list, cycles: int):
+		""" yields the values of `signals` in each cycle, stepping after each one, all cycles
+		    are simulated even if the caller stops early, like with `simulator.Simulator` """
+		for done in range(1, cycles + 1):
+			values = self.peek_many(signals)
+			self.step()
+			try:
+				yield values
+			except GeneratorExit:
+				self.step(cycles - done)
+				raise
+
+	def batch(self):
+		from simulator import Batch
+		return Batch(self)
+
+	def _run_batch(self, commands: list) -> list:
+		from simulator import CommandError
+		results = []
+		for command in commands:
+			try:
+				results.append(getattr(self, command[0])(*command[1:]))
+			except (KeyError, ValueError) as ee:
+				results.append(CommandError(" ".join(str(arg) for arg in command), [f"{type(ee).__name__}: {ee}"]))
+		return results
+
+	def snapshot(self):
+		""" copies the inputs, registers, cycle count and exit code """
+		from simulator import Snapshot
+		return Snapshot(dict(zip(self.prog.inputs, self.I)),
+			{reg[0]: value for reg, value in zip(self.prog.registers, self.R)}, self.cycle, self.exit_code)
+
+	def restore(self, snap):
+		""" returns to the state of `snap`, which may come from another simulator of the same circuit """
+		self.I = [snap.inputs[name] for name in self.prog.inputs]
+		self.R = [snap.registers[reg[0]] for reg in self.prog.registers]
+		self.cycle, self.exit_code = snap.cycle, snap.exit_code
+		self._dirty = True
+
+	def _copy_state(self):
+		self.I, self.R, self.N = list(self.I), list(self.R), list(self.N)
+		self.V, self.E = list(self.V), list(self.E)
+
+	def fork(self, out=None):
+		""" independent simulator in the current state, the compiled code is shared """
+		# not copy.copy, which would go through __getstate__ and recompile
+		sim = self.__class__.__new__(self.__class__)
+		sim.__dict__.update(self.__dict__)
+		sim.out = self.out if out is None else out
+		sim._copy_state()
+		return sim
+
+	def __getstate__(self):
+		# the compiled functions are recreated from the source, output goes to stdout
+		state = dict(self.__dict__)
+		for name in ('out', 'cache', '_evaluate', '_blocks', '_commit'):
+			state.pop(name, None)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self.out, self.cache = sys.stdout, CompileCache(0)
+		if self.prog is not None:
+			self._link()
+
+	def cache_stats(self) -> dict:
+		return dict(self.cache.stats, entries=len(self.cache))
+
+	def stop(self):
+		pass
+
+## Incremental Evaluation ##
+
+class Partition:
+	""" Splits the instructions of a program into blocks of about `block_size` consecutive
+	    instructions. The instruction order is topological, so a block only reads values
+	    of sources and of earlier blocks. Values that leave their block are kept in `T`. """
+	def __init__(self, prog: Program, block_size: int):
+		self.blocks = [[]]
+		block_of = {}
+		for ii in range(len(prog)):
+			if prog.op[ii] in (Op.INPUT, Op.REG, Op.CONST):
+				continue
+			if len(self.blocks[-1]) >= block_size:
+				self.blocks.append([])
+			block_of[ii] = len(self.blocks) - 1
+			self.blocks[-1].append(ii)
+		if len(self.blocks[-1]) == 0:
+			self.blocks.pop()
+		# value -> blocks that read it, without the block that defines it
+		self.consumers = {}
+		for jj, block in enumerate(self.blocks):
+			for ii in block:
+				for value in _operands(prog, ii):
+					if block_of.get(value) != jj:
+						self.consumers.setdefault(value, set()).add(jj)
+		self.consumers = {value: sorted(blocks) for value, blocks in self.consumers.items()}
+		# values that are read after the evaluation: named signals, register updates and side effects
+		self.stored = set(prog.symbols.values())
+		for name, current, next, enable, init in prog.registers:
+			self.stored.update(vv for vv in (next, enable, init) if vv >= 0)
+		for clock, condition, fmt, args in prog.printfs:
+			self.stored.add(condition)
+			self.stored.update(args)
+		for clock, condition, exit_code in prog.stops:
+			self.stored.add(condition)
+
+def _mark(blocks: list) -> str:
+	return " = ".join(f"D[{jj}]" for jj in blocks) + " = True"
+
+def generate_incremental(prog: Program, part: Partition) -> str:
+	""" Python source of one function `b<j>(T, D)` per block and of `commit(T, D)`. All
+	    values live in `T`, a block that is marked in `D` recomputes its instructions and marks
+	    the blocks that read one of its values that changed. `commit` clocks the registers. """
+	lines = []
+	for jj, block in enumerate(part.blocks):
+		lines.append(f"def b{jj}(T, D):")
+		inside = set(block)
+		loaded = set()
+		for ii in block:
+			for value in _operands(prog, ii):
+				if value not in inside and value not in loaded:
+					loaded.add(value)
+					lines.append(f"\tt{value} = T[{value}]")
+		for ii in block:
+			lines.append(f"\tt{ii} = {_expression(prog, ii)}")
+		for ii in block:
+			if ii in part.consumers:
+				lines.append(f"\tif t{ii} != T[{ii}]:")
+				lines.append(f"\t\tT[{ii}] = t{ii}")
+				lines.append(f"\t\t{_mark(part.consumers[ii])}")
+			elif ii in part.stored:
+				lines.append(f"\tT[{ii}] = t{ii}")
+	lines.append("def commit(T, D):")
+	# all next values are computed before the first register changes
+	for ii, (name, current, next, enable, init) in enumerate(prog.registers):
+		width, signed = prog.width[current], prog.signed[current] == 1
+		next_expr = f"T[{next}]"
+		if prog.width[next] > width:
+			next_expr = f"((T[{next}] + {1 << (width - 1)}) & {_mask(width)}) - {1 << (width - 1)}" if signed \
+				else f"T[{next}] & {_mask(width)}"
+		if enable >= 0:
+			next_expr = f"T[{init}] if T[{enable}] else {next_expr}"
+		lines.append(f"\tn{ii} = {next_expr}")
+	for ii, (name, current, next, enable, init) in enumerate(prog.registers):
+		if current in part.consumers:
+			lines.append(f"\tif n{ii} != T[{current}]:")
+			lines.append(f"\t\tT[{current}] = n{ii}")
+			lines.append(f"\t\t{_mark(part.consumers[current])}")
+		else:
+			lines.append(f"\tT[{current}] = n{ii}")
+	lines.append("\treturn")
+	return "\n".join(lines) + "\n"
+
+class IncrementalSimulator(CompiledSimulator):
+	""" Activity driven variant of `CompiledSimulator`: the combinational logic is partitioned
+	    once into blocks and a step only re-evaluates the blocks downstream of the inputs and
+	    registers that changed, evaluation stops at blocks whose results did not change.
+	    Pays off when little of the design switches per cycle. """
+	def __init__(self, out=None, block_size=128, cache=None, fold=True):
+		super().__init__(out, cache, fold)
+		self.block_size = block_size
+
+	def options(self) -> tuple:
+		return (self.__class__.__name__, self.fold, self.block_size)
+
+	def _compile(self, ir):
+		prog = compile_program(ir, self.fold)
+		self.part = part = Partition(prog, self.block_size)
+		self.source = generate_incremental(prog, part)
+		self.prog = prog
+		self._link()
+		self.slots = prog.symbols
+		inputs = set(prog.inputs.values())
+		self.inputs = {name: value for name, value in prog.symbols.items() if value in inputs}
+		self.formats = [_printf_format(fmt) for _, _, fmt, _ in prog.printfs]
+
+	def _reset(self):
+		prog = self.prog
+		self.T = [0] * len(prog)
+		for ii in range(len(prog)):
+			if prog.op[ii] == Op.CONST:
+				self.T[ii] = _normalize(prog.consts[prog.a[ii]], prog.width[ii], prog.signed[ii] == 1)
+		# the first evaluation computes every block
+		self.D = [True] * len(self.part.blocks)
+		self.cycle = 0
+		self.exit_code = None
+
+	def _link(self):
+		namespace = {}
+		exec(compile(self.source, f"<{self.prog.name}>", "exec"), namespace)
+		self._blocks = [namespace[f"b{jj}"] for jj in range(len(self.part.blocks))]
+		self._commit = namespace['commit']
+
+	def _update(self):
+		T, D, blocks = self.T, self.D, self._blocks
+		jj = 0
+		try:
+			while True:
+				# blocks only mark later blocks, so one pass in order suffices
+				jj = D.index(True, jj)
+				D[jj] = False
+				blocks[jj](T, D)
+				jj += 1
+		except ValueError:
+			pass
+
+	def peek(self, signal: str) -> int:
+		self._update()
+		return int(self.T[self.slots[signal]])
+
+	def poke(self, signal: str, value: int):
+		ii = self.inputs[signal]
+		value = _normalize(value, self.prog.width[ii], self.prog.signed[ii] == 1)
+		if value != self.T[ii]:
+			self.T[ii] = value
+			for jj in self.part.consumers.get(ii, ()):
+				self.D[jj] = True
+
+	def step(self, count=1):
+		T, prog = self.T, self.prog
+		for _ in range(count):
+			if self.exit_code is not None:
+				return
+			self._update()
+			for kind, (clock, condition, fmt, args) in enumerate(prog.printfs):
+				if T[condition]:
+					self.out.write(self.formats[kind].format(*(T[aa] for aa in args)))
+			for clock, condition, exit_code in prog.stops:
+				if T[condition]:
+					self.exit_code = exit_code
+			self._commit(T, self.D)
+			self.cycle += 1
+
+	def snapshot(self):
+		from simulator import Snapshot
+		T = self.T
+		return Snapshot({name: T[value] for name, value in self.prog.inputs.items()},
+			{reg[0]: T[reg[1]] for reg in self.prog.registers}, self.cycle, self.exit_code)
+
+	def restore(self, snap):
+		# only the logic downstream of values that differ is marked
+		T, D, consumers = self.T, self.D, self.part.consumers
+		sources = [(value, snap.inputs[name]) for name, value in self.prog.inputs.items()]
+		sources += [(reg[1], snap.registers[reg[0]]) for reg in self.prog.registers]
+		for value, new in sources:
+			if T[value] != new:
+				T[value] = new
+				for jj in consumers.get(value, ()):
+					D[jj] = True
+		self.cycle, self.exit_code = snap.cycle, snap.exit_code
+
+	def _copy_state(self):
+		self.T, self.D = list(self.T), list(self.D)
@@ -5,7 +5,7 @@
 # author: Kevin Laeufer <laeufer@cs.berkeley.edu>
 
 
-import kast
+import kast, re
 from typing import List, Optional, Union
 from enum import Enum
 
@@ -46,6 +46,16 @@ class Expr(Node):
 class Ref(Expr):
 	name = str
 
+class SubField(Expr):
+	""" field `name` of a bundle """
+	e = Expr
+	name = str
+
+class SubIndex(Expr):
+	""" element `n` of a vector """
+	e = Expr
+	n = int
+
 class Mux(Expr):
 	sel = Expr
 	a = Expr
@@ -134,7 +144,8 @@ class Statement(Node):
 
 
 class Connect(Statement):
-	lhs = Ref
+	""" the lhs is a Ref, or a SubField/SubIndex of one before LowerTypes """
+	lhs = Expr
 	rhs = Expr
 
 class Reset(Node):
@@ -162,6 +173,11 @@ class WireDeclaration(Statement):
 	name = str
 	typ = Type
 
+class NodeDeclaration(Statement):
+	""" names the value of an expression, e.g. to emit a shared expression only once """
+	name = str
+	value = Expr
+
 ## Modules ##
 
 class PortDir(Enum):
@@ -187,13 +203,38 @@ class Circuit(Node):
 def camelCase(name) -> str:
 	return name[:1].lower() + name[1:]
 
-class ToString:
+# format strings hold FIRRTL escapes, raw quotes and newlines would end the string token
+_format_escape_re = re.compile(r'\\.|["\n]')
+_format_escapes = {'"': '\\"', '\n': '\\n'}
+
+def _escape_format(fmt: str) -> str:
+	return _format_escape_re.sub(lambda mm: _format_escapes.get(mm.group(0), mm.group(0)), fmt)
+
+def _text(parts) -> str:
+	""" joins the nested tuples of strings that the visit methods of `ToString` return,
+	    without recursion, so deep expressions are joined in linear time """
+	if type(parts) is str:
+		return parts
+	out, todo = [], [iter(parts)]
+	append, push, pop = out.append, todo.append, todo.pop
+	while len(todo) > 0:
+		for pp in todo[-1]:
+			if type(pp) is str:
+				append(pp)
+			else:
+				push(iter(pp))
+				break
+		else:
+			pop()
+	return "".join(out)
+
+class ToString(kast.NodeVisitor):
+	""" visit methods yield child nodes to obtain their string, see kast.NodeVisitor.
+	    Statements and expressions return nested tuples of strings instead of building
+	    the text at every level, `visit` joins them once. """
 
 	def visit(self, node):
-		"""Visit a node."""
-		method = 'visit_' + node.__class__.__name__
-		visitor = getattr(self, method, self.generic_visit)
-		return visitor(node)
+		return _text(super().visit(node))
 
 	def generic_visit(self, node):
 		raise NotImplementedError(f"TODO: visit({node.__class__.__name__})")
@@ -203,7 +244,8 @@ class ToString:
 
 	# Types
 	def visit_Field(self, node):
-		return f"{node.name}: {self.visit(node.typ)}"
+		typ = yield node.typ
+		return f"{node.name}: {typ}"
 	def visit_UInt(self, node):
 		if node.n is None: return "UInt"
 		else: return f"UInt<{node.n}>"
@@ -212,79 +254,159 @@ class ToString:
 		else: return f"SInt<{node.n}>"
 	def visit_Clock(self, _node: Clock):
 		return "Clock"
+	def visit_Vector(self, node):
+		return f"{(yield node.elementtype)}[{node.count}]"
+	def visit_Bundle(self, node):
+		fields = []
+		for ff in node.fields:
+			fields.append((yield ff))
+		return "{" + ", ".join(fields) + "}"
 
 	def visit_Circuit(self, node):
-		return f"circuit {node.name} :\n" + "\n".join(self.visit(mod) for mod in node.modules)
+		mods = []
+		for mod in node.modules:
+			mods.append((yield mod))
+		return f"circuit {node.name} :\n" + "\n".join(mods)
 
 	def visit_Port(self, node):
-		return f"{node.dir.name.lower()} {node.name} : {self.visit(node.typ)}"
+		typ = yield node.typ
+		return f"{node.dir.name.lower()} {node.name} : {typ}"
 	def visit_Module(self, node):
 		ir  = [f"  module {node.name} :"]
-		ir += [f"    {self.visit(ii)}" for ii in node.ports]
-		ir += [f"    {self.visit(stmt)}" for stmt in node.statements]
+		for ii in node.ports:
+			ir.append(f"    {(yield ii)}")
+		for stmt in node.statements:
+			ir.append("    " + _text((yield stmt)))
 		return "\n".join(ir)
 
 	def visit_Connect(self, node):
-		return f"{self.visit(node.lhs)} <= {self.visit(node.rhs)}"
+		lhs, rhs = (yield node.lhs), (yield node.rhs)
+		return (lhs, " <= ", rhs)
 	def visit_Reset(self, node):
-		enable, value = self.visit(node.enable), self.visit(node.value)
-		return f" with: (reset => ({enable}, {value}))"
+		enable, value = (yield node.enable), (yield node.value)
+		return (" with: (reset => (", enable, ", ", value, "))")
 	def visit_Register(self, node):
-		typ, clock, reset = self.visit(node.typ), self.visit(node.clock), self.visit(node.reset)
-		return f"reg {node.name} : {typ}, {clock}{reset}"
+		typ, clock, reset = (yield node.typ), (yield node.clock), (yield node.reset)
+		return (f"reg {node.name} : {typ}, ", clock, reset)
 	def visit_WireDeclaration(self, node):
-		return f"wire {node.name}: {self.visit(node.typ)}"
+		typ = yield node.typ
+		return f"wire {node.name}: {typ}"
+	def visit_NodeDeclaration(self, node):
+		return (f"node {node.name} = ", (yield node.value))
 	def visit_PrintF(self, node):
-		clk, cond = self.visit(node.clock), self.visit(node.condition)
-		vargs = ", " + ", ".join(node.vargs) if len(node.vargs) > 0 else ""
-		return f"printf({clk}, {cond}, \"{node.format_str}\"{vargs})"
+		clk, cond = (yield node.clock), (yield node.condition)
+		vargs = []
+		for arg in node.vargs:
+			vargs += [", ", (yield arg)]
+		return ("printf(", clk, ", ", cond, f", \"{_escape_format(node.format_str)}\"", tuple(vargs), ")")
 	def visit_Stop(self, node):
-		clk, cond = self.visit(node.clock), self.visit(node.condition)
-		return f"stop({clk}, {cond}, {node.exit_code})"
+		clk, cond = (yield node.clock), (yield node.condition)
+		return ("stop(", clk, ", ", cond, f", {node.exit_code})")
 
 
 	# Expressions
 	def visit_Ref(self, node):
 		return node.name
+	def visit_SubField(self, node):
+		return ((yield node.e), ".", node.name)
+	def visit_SubIndex(self, node):
+		return ((yield node.e), f"[{node.n}]")
 	def visit_BinOp(self, node):
-		e1, e2 = self.visit(node.e1), self.visit(node.e2)
-		return f"{node.op.name.lower()}({e1}, {e2})"
+		e1, e2 = (yield node.e1), (yield node.e2)
+		return (node.op.name.lower(), "(", e1, ", ", e2, ")")
 	def visit_Cmp(self, node):
-		e1, e2 = self.visit(node.e1), self.visit(node.e2)
+		e1, e2 = (yield node.e1), (yield node.e2)
 		op = {'NE': 'neq', 'LE': 'leq', 'GE': 'geq'}.get(node.op.name, node.op.name.lower())
-		return f"{op}({e1}, {e2})"
+		return (op, "(", e1, ", ", e2, ")")
 	def visit_UnOp(self, node):
-		op = {'ArithmeticToSigned': 'cvt'}.get(node.op, camelCase(node.op.name))
-		return f"{op}({self.visit(node.e)})"
+		op = {'ArithmeticToSigned': 'cvt'}.get(node.op.name, camelCase(node.op.name))
+		return (op, "(", (yield node.e), ")")
 	def visit_Pad(self, node):
 		assert node.n >= 0
-		return f"pad({self.visit(node.e)}, {node.n})"
+		return ("pad(", (yield node.e), f", {node.n})")
 	def visit_ShiftLeft(self, node):
-		e = self.visit(node.e)
+		e = yield node.e
 		if isinstance(node.n, int):
 			assert node.n >= 0
-			return f"shl({e}, {node.n})"
+			return ("shl(", e, f", {node.n})")
 		else:
-			return f"dshl({e}, {self.visit(node.n)})"
+			return ("dshl(", e, ", ", (yield node.n), ")")
 	def visit_ShiftRight(self, node):
-		e = self.visit(node.e)
+		e = yield node.e
 		if isinstance(node.n, int):
 			assert node.n >= 0
-			return f"shr({e}, {node.n})"
+			return ("shr(", e, f", {node.n})")
 		else:
-			return f"dshr({e}, {self.visit(node.n)})"
+			return ("dshr(", e, ", ", (yield node.n), ")")
 	def visit_Extract(self, node):
 		assert node.lo >= 0
 		assert node.hi >= node.lo
-		return f"bits({self.visit(node.e)}, {node.hi}, {node.lo})"
+		return ("bits(", (yield node.e), f", {node.hi}, {node.lo})")
 	def visit_Mux(self, node):
-		sel, a, b = self.visit(node.sel), self.visit(node.a), self.visit(node.b)
-		return f"mux({sel}, {a}, {b})"
+		sel, a, b = (yield node.sel), (yield node.a), (yield node.b)
+		return ("mux(", sel, ", ", a, ", ", b, ")")
+	def visit_ValidIf(self, node):
+		valid, a = (yield node.valid), (yield node.a)
+		return ("validif(", valid, ", ", a, ")")
 	def visit_Head(self, node):
 		assert node.n >= 0
-		return f"head({self.visit(node.e)}, {node.n})"
+		return ("head(", (yield node.e), f", {node.n})")
 	def visit_Tail(self, node):
 		assert node.n >= 0
-		return f"tail({self.visit(node.e)}, {node.n})"
+		return ("tail(", (yield node.e), f", {node.n})")
 	def visit_Literal(self, node):
-		return f"{self.visit(node.typ)}({node.value})"
\ No newline at end of file
+		return f"{(yield node.typ)}({node.value})"
+
+
+class Emitter(ToString):
+	""" Writes the same text as `ToString` to a binary file-like object.
+	    Circuits and modules are written one port or statement at a time,
+	    so only the text of a single statement is built in memory. """
+	def __init__(self, out, buffer_size: int = 1 << 16):
+		self.out = out
+		self.buffer_size = buffer_size
+		self._chunks = []
+		self._buffered = 0
+
+	def emit(self, node):
+		res = self.visit(node)
+		if len(res) > 0:
+			self.write(res)
+		self.flush()
+
+	def write(self, text: str):
+		self._chunks.append(text)
+		self._buffered += len(text)
+		if self._buffered >= self.buffer_size:
+			self.flush()
+
+	def flush(self):
+		if len(self._chunks) > 0:
+			self.out.write("".join(self._chunks).encode('UTF-8'))
+		self._chunks, self._buffered = [], 0
+
+	def visit_Circuit(self, node):
+		self.write(f"circuit {node.name} :\n")
+		for ii, mod in enumerate(node.modules):
+			if ii > 0: self.write("\n")
+			yield mod
+		return ""
+
+	def visit_Module(self, node):
+		self.write(f"  module {node.name} :")
+		for ii in node.ports:
+			self.write(f"\n    {(yield ii)}")
+		for stmt in node.statements:
+			self.write("\n    " + _text((yield stmt)))
+		return ""
+
+def emit(node: Node, out, share: bool = False):
+	""" streams the FIRRTL text of `node` into the binary file-like object `out`;
+	    with `share`, expressions that are used more than once are emitted once as `node` """
+	if share:
+		from firrtl_passes import share_expressions
+		if isinstance(node, Circuit):
+			node = node.set(modules=[share_expressions(mm) for mm in node.modules])
+		elif isinstance(node, Module):
+			node = share_expressions(node)
+	Emitter(out).emit(node)
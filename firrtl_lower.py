@@ -0,0 +1,274 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2018, University of California, Berkeley
+# author: Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+# lowering of firrtl.Module to a flat list of single operation instructions
+
+from array import array
+from enum import IntEnum
+from firrtl import *
+from firrtl_passes import infer_types
+
+class Op(IntEnum):
+	# sources: `a` is the index of the constant for CONST
+	INPUT = 0
+	REG = 1
+	CONST = 2
+	# binary operations on `a` and `b`
+	ADD = 3
+	SUB = 4
+	MUL = 5
+	DIV = 6
+	REM = 7
+	AND = 8
+	OR = 9
+	XOR = 10
+	CAT = 11
+	EQ = 12
+	NE = 13
+	LT = 14
+	GT = 15
+	LE = 16
+	GE = 17
+	DSHL = 18
+	DSHR = 19
+	# unary operations on `a`
+	AS_UINT = 20
+	AS_SINT = 21
+	AS_CLOCK = 22
+	CVT = 23
+	NEG = 24
+	NOT = 25
+	# `a` and the constant `b`, BITS: `a`, hi = `b`, lo = `c`
+	PAD = 26
+	SHL = 27
+	SHR = 28
+	HEAD = 29
+	TAIL = 30
+	BITS = 31
+	# MUX: select `a`, `b` or `c`, VALIDIF: valid `a`, value `b`
+	MUX = 32
+	VALIDIF = 33
+
+_bops = {Bop.Add: Op.ADD, Bop.Sub: Op.SUB, Bop.Mul: Op.MUL, Bop.Div: Op.DIV, Bop.Rem: Op.REM,
+		 Bop.And: Op.AND, Bop.Or: Op.OR, Bop.Xor: Op.XOR, Bop.Cat: Op.CAT}
+_cops = {Cop.EQ: Op.EQ, Cop.NE: Op.NE, Cop.LT: Op.LT, Cop.GT: Op.GT, Cop.LE: Op.LE, Cop.GE: Op.GE}
+_uops = {Uop.AsUInt: Op.AS_UINT, Uop.AsSInt: Op.AS_SINT, Uop.AsClock: Op.AS_CLOCK,
+		 Uop.ArithmeticToSigned: Op.CVT, Uop.Neg: Op.NEG, Uop.Not: Op.NOT}
+
+class CombinationalLoop(Exception):
+	pass
+
+class Program:
+	""" Flat form of a module. Instruction `ii` defines value `ii` and only reads values
+	    of earlier instructions, so the instruction order is a topological order of
+	    the combinational logic. Instructions are stored column wise in arrays. """
+	def __init__(self, name: str):
+		self.name = name
+		self.op = array('B')
+		self.a, self.b, self.c = array('i'), array('i'), array('i')
+		self.width = array('I')
+		self.signed = array('B')
+		self.consts = []
+		# name -> value of every port, wire, register and node
+		self.symbols = {}
+		self.inputs, self.outputs = {}, {}
+		# (name, value, next value, reset enable or -1, reset value or -1)
+		self.registers = []
+		# (clock, condition, format string, [argument values])
+		self.printfs = []
+		# (clock, condition, exit code)
+		self.stops = []
+
+	def __len__(self):
+		return len(self.op)
+
+	def add_paths(self, paths: dict):
+		""" makes the ground signals from `lower_types` accessible by their aggregate path """
+		for path, name in paths.items():
+			self.symbols[path] = self.symbols[name]
+
+	def append(self, op: Op, a: int, b: int, c: int, width: int, signed: bool) -> int:
+		self.op.append(op)
+		self.a.append(a)
+		self.b.append(b)
+		self.c.append(c)
+		self.width.append(width)
+		self.signed.append(signed)
+		return len(self.op) - 1
+
+	def __str__(self):
+		names = {value: name for name, value in self.symbols.items()}
+		lines = []
+		for ii in range(len(self.op)):
+			op = Op(self.op[ii])
+			if op == Op.CONST:
+				args = str(self.consts[self.a[ii]])
+			else:
+				args = ", ".join(str(aa) for aa in (self.a[ii], self.b[ii], self.c[ii]) if aa >= 0)
+			typ = f"{'SInt' if self.signed[ii] else 'UInt'}<{self.width[ii]}>"
+			name = f" ; {names[ii]}" if ii in names else ""
+			lines.append(f"%{ii} = {op.name.lower()} {args} : {typ}{name}")
+		return "\n".join(lines)
+
+class Lowering:
+	""" Lowers a module with a depth first traversal of the signal graph: every expression
+	    node and every signal is lowered once, so the pass is linear in the size of the DAG.
+	    Signals without a driver are zero. """
+	def __init__(self, mod: Module):
+		self.mod = mod
+		self.types = infer_types(mod)
+		self.prog = Program(mod.name)
+		# id(expr) -> value
+		self.values = {}
+		# name -> expression that drives a wire, output or node (last connect wins)
+		self.drivers = {}
+		# name -> declared type of a combinational signal
+		self.declared = {}
+		# names that are being lowered, in the order of the current path
+		self.active = {}
+		# (value, width, signed) -> value, equal constants are only defined once
+		self.constants = {}
+
+	def run(self) -> Program:
+		prog, mod = self.prog, self.mod
+		registers, connects = [], {}
+		for pp in mod.ports:
+			if pp.dir == PortDir.Input:
+				prog.inputs[pp.name] = prog.symbols[pp.name] = self._source(Op.INPUT, pp.typ)
+			else:
+				self.declared[pp.name] = pp.typ
+		for stmt in mod.statements:
+			if isinstance(stmt, Register):
+				registers.append(stmt)
+				prog.symbols[stmt.name] = self._source(Op.REG, stmt.typ)
+			elif isinstance(stmt, WireDeclaration):
+				self.declared[stmt.name] = stmt.typ
+			elif isinstance(stmt, NodeDeclaration):
+				self.declared[stmt.name] = self.types[stmt.value]
+				self.drivers[stmt.name] = stmt.value
+			elif isinstance(stmt, Connect):
+				if not isinstance(stmt.lhs, Ref):
+					raise TypeError(f"{mod.name} has aggregate types, run firrtl_passes.lower_types first")
+				connects[stmt.lhs.name] = stmt.rhs
+		for name, expr in connects.items():
+			if name in self.declared:
+				self.drivers[name] = expr
+		# registers, outputs and side effects are the roots of the signal graph
+		for reg in registers:
+			current = prog.symbols[reg.name]
+			next = self.lower(connects[reg.name]) if reg.name in connects else current
+			next = self._extend(next, reg.typ)
+			enable, init = -1, -1
+			if reg.reset is not None:
+				enable, init = self.lower(reg.reset.enable), self._extend(self.lower(reg.reset.value), reg.typ)
+			prog.registers.append((reg.name, current, next, enable, init))
+		for pp in mod.ports:
+			if pp.dir == PortDir.Output:
+				prog.outputs[pp.name] = self.lower(pp.name)
+		for name in self.declared:
+			self.lower(name)
+		for stmt in mod.statements:
+			if isinstance(stmt, PrintF):
+				args = [self.lower(arg) for arg in stmt.vargs]
+				prog.printfs.append((self.lower(stmt.clock), self.lower(stmt.condition), stmt.format_str, args))
+			elif isinstance(stmt, Stop):
+				prog.stops.append((self.lower(stmt.clock), self.lower(stmt.condition), stmt.exit_code))
+		return prog
+
+	def _source(self, op: Op, typ: Type) -> int:
+		width = 1 if isinstance(typ, Clock) else typ.n
+		return self.prog.append(op, -1, -1, -1, width, isinstance(typ, SInt))
+
+	def _extend(self, value: int, typ: Type) -> int:
+		""" pads `value` to the width of the signal that it is connected to """
+		width = 1 if isinstance(typ, Clock) else typ.n
+		if self.prog.width[value] >= width:
+			return value
+		return self.prog.append(Op.PAD, value, width, -1, width, isinstance(typ, SInt))
+
+	def lower(self, root) -> int:
+		""" returns the value of an expression or of a signal name """
+		values, symbols, drivers = self.values, self.prog.symbols, self.drivers
+		# (expression or signal name, children were pushed)
+		stack = [(root, False)]
+		while len(stack) > 0:
+			item, expanded = stack.pop()
+			if item.__class__ is str:
+				if item in symbols:
+					continue
+				if expanded:
+					del self.active[item]
+					symbols[item] = self._extend(values[id(drivers[item])], self.declared[item])
+				elif item in self.active:
+					path = list(self.active)
+					path = path[path.index(item):] + [item]
+					raise CombinationalLoop(f"combinational loop in {self.mod.name}: {' -> '.join(path)}")
+				elif item in drivers:
+					self.active[item] = True
+					stack.append((item, True))
+					stack.append((drivers[item], False))
+				elif item in self.declared:
+					# undriven wires and outputs
+					typ = self.declared[item]
+					symbols[item] = self._constant(0, 1 if isinstance(typ, Clock) else typ.n, isinstance(typ, SInt))
+				else:
+					raise ValueError(f"undeclared signal `{item}` in {self.mod.name}")
+			elif id(item) in values:
+				continue
+			elif isinstance(item, Ref):
+				if item.name in symbols or expanded:
+					values[id(item)] = symbols[item.name]
+				else:
+					stack.append((item, True))
+					stack.append((item.name, False))
+			elif expanded:
+				values[id(item)] = self._instruction(item)
+			else:
+				stack.append((item, True))
+				for name in item._fields:
+					child = getattr(item, name)
+					if isinstance(child, Expr):
+						stack.append((child, False))
+		return symbols[root] if root.__class__ is str else values[id(root)]
+
+	def _constant(self, value: int, width: int, signed: bool) -> int:
+		key = (value, width, signed)
+		if key not in self.constants:
+			self.prog.consts.append(value)
+			self.constants[key] = self.prog.append(Op.CONST, len(self.prog.consts) - 1, -1, -1, width, signed)
+		return self.constants[key]
+
+	def _instruction(self, expr: Expr) -> int:
+		typ = self.types[expr]
+		width, signed = 1 if isinstance(typ, Clock) else typ.n, isinstance(typ, SInt)
+		values, append = self.values, self.prog.append
+		cls = expr.__class__
+		if cls is BinOp:
+			return append(_bops[expr.op], values[id(expr.e1)], values[id(expr.e2)], -1, width, signed)
+		if cls is Cmp:
+			return append(_cops[expr.op], values[id(expr.e1)], values[id(expr.e2)], -1, width, signed)
+		if cls is UnOp:
+			return append(_uops[expr.op], values[id(expr.e)], -1, -1, width, signed)
+		if cls is Literal:
+			return self._constant(expr.value, width, signed)
+		if cls is Pad:
+			return append(Op.PAD, values[id(expr.e)], expr.n, -1, width, signed)
+		if cls is ShiftLeft or cls is ShiftRight:
+			if isinstance(expr.n, int):
+				return append(Op.SHL if cls is ShiftLeft else Op.SHR, values[id(expr.e)], expr.n, -1, width, signed)
+			return append(Op.DSHL if cls is ShiftLeft else Op.DSHR, values[id(expr.e)], values[id(expr.n)], -1, width, signed)
+		if cls is Extract:
+			return append(Op.BITS, values[id(expr.e)], expr.hi, expr.lo, width, signed)
+		if cls is Head or cls is Tail:
+			return append(Op.HEAD if cls is Head else Op.TAIL, values[id(expr.e)], expr.n, -1, width, signed)
+		if cls is Mux:
+			return append(Op.MUX, values[id(expr.sel)], values[id(expr.a)], values[id(expr.b)], width, signed)
+		if cls is ValidIf:
+			return append(Op.VALIDIF, values[id(expr.valid)], values[id(expr.a)], -1, width, signed)
+		raise NotImplementedError(f"lowering of {cls.__name__}")
+
+def lower(mod: Module) -> Program:
+	return Lowering(mod).run()
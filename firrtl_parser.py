@@ -0,0 +1,369 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2018, University of California, Berkeley
+# author: Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+# parser for the subset of FIRRTL that can be represented with the nodes in firrtl.py
+
+import re, mmap, os
+from firrtl import *
+
+# whitespace, comments and source locators are skipped, any other character becomes
+# a token of its own, which the parser then rejects
+_token_re = re.compile(r"""
+	(?:[ \t\r\n]+|;[^\n]*|@\[[^\]]*\])*
+	([A-Za-z_][A-Za-z0-9_$]*|-?[0-9]+|"(?:[^"\\\n]|\\.)*"|<=|=>|[^ \t\r\n])
+	""", re.VERBOSE)
+_id_start = frozenset('ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz_')
+_int_start = frozenset('-0123456789')
+# the input is tokenized in chunks of about this many bytes, which end at a newline
+_chunk_size = 1 << 20
+
+class ParseError(Exception):
+	pass
+
+# operation name -> (node class, op enum or None, number of expression args, number of int args)
+_ops = {op.name.lower(): (BinOp, op, 2, 0) for op in Bop}
+_ops.update({name: (Cmp, op, 2, 0) for name, op in
+	[('eq', Cop.EQ), ('neq', Cop.NE), ('lt', Cop.LT), ('gt', Cop.GT), ('leq', Cop.LE), ('geq', Cop.GE)]})
+_ops.update({'cvt' if op == Uop.ArithmeticToSigned else camelCase(op.name): (UnOp, op, 1, 0) for op in Uop})
+_ops.update({
+	'pad': (Pad, None, 1, 1), 'head': (Head, None, 1, 1), 'tail': (Tail, None, 1, 1),
+	'shl': (ShiftLeft, None, 1, 1), 'shr': (ShiftRight, None, 1, 1),
+	'dshl': (ShiftLeft, None, 2, 0), 'dshr': (ShiftRight, None, 2, 0),
+	'bits': (Extract, None, 1, 2), 'mux': (Mux, None, 3, 0), 'validif': (ValidIf, None, 2, 0),
+})
+
+def _build_op(name: str, args: list):
+	""" builds a primitive operation, mux or validif from its parsed arguments """
+	spec = _ops.get(name)
+	if spec is None:
+		raise ParseError(f"unsupported operation `{name}`")
+	cls, op, n_exprs, n_ints = spec
+	# arguments are either expressions or integers
+	ok = len(args) == n_exprs + n_ints
+	for ii in range(n_exprs, len(args) if ok else 0):
+		ok = ok and isinstance(args[ii], int)
+	for ii in range(n_exprs if ok else 0):
+		ok = ok and isinstance(args[ii], Expr)
+	if not ok:
+		raise ParseError(f"`{name}` expects {n_exprs} expression(s) followed by {n_ints} integer(s)")
+	if op is None:
+		return cls._trusted(*args)
+	return cls._trusted(op, *args)
+
+def _parse_int(text: str) -> int:
+	""" decimal or FIRRTL style "h1f", "o17", "b101" literal value """
+	if text.startswith('"'):
+		text = text[1:-1]
+		base = {'h': 16, 'o': 8, 'b': 2}.get(text[:1])
+		if base is None:
+			raise ValueError(f"unknown base `{text[:1]}`, expected h, o or b")
+		return int(text[1:], base)
+	return int(text)
+
+class Parser:
+	""" Recursive descent over statements, expressions are parsed with an explicit stack.
+	    Tokens are plain strings, the empty string marks the end of the input. """
+	def __init__(self, data):
+		self.data = data
+		self.offset = 0
+		self.chunk, self.chunk_start = "", 0
+		self.toks, self.ii = [], 0
+		self.refs = {}
+
+	def _refill(self):
+		self.toks, self.ii = [], 0
+		while len(self.toks) == 0:
+			if self.offset >= len(self.data):
+				self.toks = ['']
+				self.chunk = ""
+				return
+			end = self.data.find(b'\n', self.offset + _chunk_size)
+			end = len(self.data) if end < 0 else end + 1
+			self.chunk = self.data[self.offset:end].decode('UTF-8')
+			self.chunk_start, self.offset = self.offset, end
+			self.toks = _token_re.findall(self.chunk)
+
+	def error(self, msg: str):
+		# find the line of the last token that was read
+		if self.chunk == "": # end of input
+			lines = self.data[:].rstrip().count(b'\n')
+			return ParseError(f"line {lines + 1}: {msg}")
+		lines = self.data[:self.chunk_start].count(b'\n')
+		for ii, mm in enumerate(_token_re.finditer(self.chunk)):
+			if ii + 1 >= self.ii:
+				lines += self.chunk[:mm.start(1)].count('\n')
+				break
+		return ParseError(f"line {lines + 1}: {msg}")
+
+	def peek(self) -> str:
+		if self.ii >= len(self.toks):
+			self._refill()
+		return self.toks[self.ii]
+
+	def next(self) -> str:
+		if self.ii >= len(self.toks):
+			self._refill()
+		self.ii += 1
+		return self.toks[self.ii - 1]
+
+	def expect(self, value: str):
+		tok = self.next()
+		if tok != value:
+			raise self.error(f"expected `{value}`, got `{tok}`")
+
+	def ident(self) -> str:
+		tok = self.next()
+		if tok[:1] not in _id_start:
+			raise self.error(f"expected identifier, got `{tok}`")
+		return tok
+
+	def integer(self) -> int:
+		tok = self.next()
+		if tok[:1] not in _int_start or tok == '-':
+			raise self.error(f"expected integer, got `{tok}`")
+		return int(tok)
+
+	def accept(self, value: str) -> bool:
+		if self.peek() == value:
+			self.ii += 1
+			return True
+		return False
+
+	## Circuit ##
+
+	def circuit(self) -> Circuit:
+		self.expect('circuit')
+		name = self.ident()
+		self.expect(':')
+		modules = []
+		while self.peek() != '':
+			modules.append(self.module())
+		return Circuit(name=name, modules=modules)
+
+	def module(self) -> Module:
+		self.expect('module')
+		name = self.ident()
+		self.expect(':')
+		ports, statements = [], []
+		while self.peek() in {'input', 'output'}:
+			ports.append(self.port())
+		while self.peek() not in {'', 'module'}:
+			stmt = self.statement()
+			if stmt is not None:
+				statements.append(stmt)
+		return Module._trusted(name, ports, statements)
+
+	def port(self) -> Port:
+		direction = PortDir.Input if self.ident() == 'input' else PortDir.Output
+		name = self.ident()
+		self.expect(':')
+		return Port._trusted(name, self.type(), direction)
+
+	def type(self) -> Type:
+		if self.accept('{'):
+			fields = []
+			while not self.accept('}'):
+				if len(fields) > 0:
+					self.expect(',')
+				name = self.ident()
+				if name == 'flip':
+					raise self.error("flipped bundle fields are not supported")
+				self.expect(':')
+				fields.append(Field._trusted(name, self.type()))
+			typ = Bundle._trusted(fields)
+		else:
+			name = self.ident()
+			if name == 'Clock':
+				typ = Clock()
+			elif name in {'UInt', 'SInt'}:
+				typ = self.ground_type(name)
+			else:
+				raise self.error(f"unsupported type `{name}`")
+		while self.accept('['):
+			typ = Vector._trusted(typ, self.integer())
+			self.expect(']')
+		return typ
+
+	def ground_type(self, name: str) -> Type:
+		width = None
+		if self.accept('<'):
+			width = self.integer()
+			self.expect('>')
+		return (UInt if name == 'UInt' else SInt)._trusted(width)
+
+	## Statements ##
+
+	def statement(self):
+		text = self.next()
+		if text[:1] not in _id_start:
+			raise self.error(f"expected statement, got `{text}`")
+		if text == 'skip':
+			return None
+		if text == 'wire' and self.peek() != '<=':
+			name = self.ident()
+			self.expect(':')
+			return WireDeclaration._trusted(name, self.type())
+		if text == 'reg' and self.peek() != '<=':
+			name = self.ident()
+			self.expect(':')
+			typ = self.type()
+			self.expect(',')
+			clock = self.expr()
+			reset = None
+			if self.accept('with'):
+				self.expect(':')
+				self.expect('(')
+				self.expect('reset')
+				self.expect('=>')
+				self.expect('(')
+				enable = self.expr()
+				self.expect(',')
+				value = self.expr()
+				self.expect(')')
+				self.expect(')')
+				reset = Reset._trusted(enable, value)
+			return Register._trusted(name, typ, clock, reset)
+		if text == 'node' and self.peek() != '<=':
+			name = self.ident()
+			self.expect('=')
+			return NodeDeclaration._trusted(name, self.expr())
+		if text == 'printf' and self.peek() == '(':
+			self.next()
+			clock = self.expr()
+			self.expect(',')
+			condition = self.expr()
+			self.expect(',')
+			fmt = self.next()
+			if fmt[:1] != '"':
+				raise self.error(f"expected format string, got `{fmt}`")
+			vargs = []
+			while self.accept(','):
+				vargs.append(self.expr())
+			self.expect(')')
+			return PrintF._trusted(clock, condition, fmt[1:-1], vargs)
+		if text == 'stop' and self.peek() == '(':
+			self.next()
+			clock = self.expr()
+			self.expect(',')
+			condition = self.expr()
+			self.expect(',')
+			exit_code = self.integer()
+			self.expect(')')
+			return Stop._trusted(clock, condition, exit_code)
+		lhs = self.ref(text)
+		if self.peek() in {'.', '['}:
+			lhs = self.access(lhs)
+		self.expect('<=')
+		return Connect._trusted(lhs, self.expr())
+
+	## Expressions ##
+
+	def literal(self, name: str) -> Literal:
+		typ = self.ground_type(name)
+		self.expect('(')
+		text = self.next()
+		if text[:1] not in _int_start and text[:1] != '"':
+			raise self.error(f"expected literal value, got `{text}`")
+		self.expect(')')
+		try:
+			value = _parse_int(text)
+		except ValueError as ee:
+			raise self.error(f"bad literal value {text}: {ee}")
+		return Literal._trusted(value, typ)
+
+	def ref(self, name: str) -> Ref:
+		# references are immutable, so all uses of a name share one node
+		ref = self.refs.get(name)
+		if ref is None:
+			ref = self.refs[name] = Ref._trusted(name)
+		return ref
+
+	def access(self, expr: Expr) -> Expr:
+		""" field and element accesses that follow `expr` """
+		while True:
+			if self.accept('.'):
+				expr = SubField._trusted(expr, self.ident())
+			elif self.accept('['):
+				expr = SubIndex._trusted(expr, self.integer())
+				self.expect(']')
+			else:
+				return expr
+
+	def expr(self) -> Expr:
+		# frames of the operations whose arguments are being parsed: (name, args)
+		stack = []
+		# the token list is read directly, this is the inner loop of the parser
+		toks, ii = self.toks, self.ii
+		while True:
+			if ii >= len(toks):
+				self._refill()
+				toks, ii = self.toks, self.ii
+			text = toks[ii]
+			ii += 1
+			first = text[:1]
+			if first in _id_start:
+				if ii >= len(toks):
+					self.ii = ii
+					self._refill()
+					toks, ii = self.toks, self.ii
+				if text == 'UInt' or text == 'SInt':
+					self.ii = ii
+					value = self.literal(text)
+					toks, ii = self.toks, self.ii
+				elif toks[ii] == '(':
+					ii += 1
+					stack.append((text, []))
+					continue
+				else:
+					value = self.refs.get(text) or self.ref(text)
+					if toks[ii] == '.' or toks[ii] == '[':
+						self.ii = ii
+						value = self.access(value)
+						toks, ii = self.toks, self.ii
+			elif first in _int_start and len(stack) > 0 and text != '-':
+				value = int(text)
+			else:
+				self.ii = ii
+				raise self.error(f"expected expression, got `{text}`")
+			# attach the finished value to its enclosing operations
+			while True:
+				if len(stack) == 0:
+					self.ii = ii
+					if not isinstance(value, Expr):
+						raise self.error("expected expression")
+					return value
+				name, args = stack[-1]
+				args.append(value)
+				if ii >= len(toks):
+					self.ii = ii
+					self._refill()
+					toks, ii = self.toks, self.ii
+				text = toks[ii]
+				ii += 1
+				if text == ',':
+					break
+				self.ii = ii
+				if text != ')':
+					raise self.error(f"expected `,` or `)`, got `{text}`")
+				stack.pop()
+				try:
+					value = _build_op(name, args)
+				except ParseError as ee:
+					raise self.error(str(ee))
+
+def parse(text) -> Circuit:
+	""" parses a FIRRTL circuit from a `str` or bytes-like object """
+	if isinstance(text, str):
+		text = text.encode('UTF-8')
+	return Parser(text).circuit()
+
+def parse_file(filename: str) -> Circuit:
+	""" parses a .fir file, the file is memory mapped instead of read """
+	with open(filename, 'rb') as ff:
+		if os.fstat(ff.fileno()).st_size == 0:
+			return parse(b'')
+		with mmap.mmap(ff.fileno(), 0, access=mmap.ACCESS_READ) as data:
+			return parse(data)
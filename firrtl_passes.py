@@ -0,0 +1,695 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2018, University of California, Berkeley
+# author: Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+# analysis and optimization passes over firrtl.Module
+
+import kast, operator
+from firrtl import *
+
+## Types and Widths ##
+
+_ground_types = {}
+def ground_type(cls, width: Optional[int]) -> Type:
+	""" shared UInt/SInt/Clock node, types are immutable and compared by identity in the passes """
+	key = (cls, width)
+	typ = _ground_types.get(key)
+	if typ is None:
+		typ = _ground_types[key] = Clock._trusted() if cls is Clock else cls._trusted(width)
+	return typ
+
+def _normalize(typ: Type) -> Type:
+	""" ground types are shared, so that passes can compare types by identity """
+	if isinstance(typ, (UInt, SInt)):
+		return ground_type(typ.__class__, typ.n)
+	if isinstance(typ, Clock):
+		return ground_type(Clock, None)
+	return typ
+
+def literal_width(value: int, signed: bool) -> int:
+	""" smallest width that can represent `value` """
+	if signed:
+		return (value if value >= 0 else ~value).bit_length() + 1
+	return max(value.bit_length(), 1)
+
+# Bop -> (type of e1, type of e2) -> (result class, result width)
+_bop_widths = {
+	Bop.Add: lambda t1, t2: (t1.__class__, max(t1.n, t2.n) + 1),
+	Bop.Sub: lambda t1, t2: (t1.__class__, max(t1.n, t2.n) + 1),
+	Bop.Mul: lambda t1, t2: (t1.__class__, t1.n + t2.n),
+	Bop.Div: lambda t1, t2: (t1.__class__, t1.n + 1 if isinstance(t1, SInt) else t1.n),
+	Bop.Rem: lambda t1, t2: (t1.__class__, min(t1.n, t2.n)),
+	Bop.And: lambda t1, t2: (UInt, max(t1.n, t2.n)),
+	Bop.Or:  lambda t1, t2: (UInt, max(t1.n, t2.n)),
+	Bop.Xor: lambda t1, t2: (UInt, max(t1.n, t2.n)),
+	Bop.Cat: lambda t1, t2: (UInt, t1.n + t2.n),
+}
+
+class TypeTable:
+	""" result of `InferTypes`: the type of every expression and signal of a module """
+	def __init__(self, memo: dict, signals: dict):
+		# id(node) -> (node, type), the memo table of the traversal
+		self._memo = memo
+		self.signals = signals
+
+	def __getitem__(self, expr: Expr) -> Type:
+		return self._memo[id(expr)][1]
+
+	def __setitem__(self, expr: Expr, typ: Type):
+		""" records the type of an expression that a pass created """
+		self._memo[id(expr)] = (expr, typ)
+
+	def __contains__(self, expr: Expr) -> bool:
+		entry = self._memo.get(id(expr))
+		return entry is not None and entry[0] is expr and isinstance(entry[1], Type)
+
+	def width(self, expr: Expr) -> int:
+		return self[expr].n if not isinstance(self[expr], Clock) else 1
+
+	def is_signed(self, expr: Expr) -> bool:
+		return isinstance(self[expr], SInt)
+
+class InferTypes(kast.NodeVisitor):
+	""" Computes type and width of every expression following the FIRRTL spec.
+	    Every node is visited once, so the pass is linear in the size of the DAG.
+	    Signals declared without a width get the largest width connected to them. """
+	memoize = True
+
+	def __init__(self):
+		self.env = {}
+
+	def run(self, mod: Module) -> TypeTable:
+		declared = {pp.name: pp.typ for pp in mod.ports}
+		for stmt in mod.statements:
+			if isinstance(stmt, (WireDeclaration, Register)):
+				declared[stmt.name] = stmt.typ
+		unknown = [name for name, typ in declared.items() if isinstance(typ, (UInt, SInt)) and typ.n is None]
+		self.env = {name: ground_type(typ.__class__, 0) if name in unknown else _normalize(typ)
+					for name, typ in declared.items()}
+		# fixed point iteration for the signals without a declared width
+		for _ in range(len(unknown) + 2):
+			self.clear_memo()
+			self.visit(mod)
+			changed = False
+			if len(unknown) > 0:
+				for stmt in mod.statements:
+					if isinstance(stmt, Connect) and isinstance(stmt.lhs, Ref) and stmt.lhs.name in unknown:
+						lhs, rhs = self.env[stmt.lhs.name], self._memo[id(stmt.rhs)][1]
+						if isinstance(rhs, (UInt, SInt)) and rhs.n > lhs.n:
+							self.env[stmt.lhs.name] = ground_type(lhs.__class__, rhs.n)
+							changed = True
+			if not changed:
+				table = TypeTable(self._memo, dict(self.env))
+				self.clear_memo()
+				return table
+		raise TypeError(f"width inference does not converge for {', '.join(unknown)} in {mod.name}")
+
+	def visit_NodeDeclaration(self, node):
+		self.env[node.name] = yield node.value
+
+	def visit_Ref(self, node):
+		typ = self.env.get(node.name)
+		if typ is None:
+			raise TypeError(f"undeclared signal `{node.name}`")
+		return typ
+
+	def visit_SubField(self, node):
+		typ = yield node.e
+		for ff in getattr(typ, 'fields', []):
+			if ff.name == node.name:
+				return _normalize(ff.typ)
+		raise TypeError(f"no field `{node.name}` in {typ}")
+
+	def visit_SubIndex(self, node):
+		typ = yield node.e
+		if not isinstance(typ, Vector) or not 0 <= node.n < typ.count:
+			raise TypeError(f"cannot index {typ} with {node.n}")
+		return _normalize(typ.elementtype)
+
+	def visit_Literal(self, node):
+		typ = node.typ
+		if typ.n is not None:
+			return ground_type(typ.__class__, typ.n)
+		return ground_type(typ.__class__, literal_width(node.value, isinstance(typ, SInt)))
+
+	def visit_BinOp(self, node):
+		t1, t2 = (yield node.e1), (yield node.e2)
+		rule = _bop_widths.get(node.op)
+		if rule is None:
+			raise NotImplementedError(f"width of {node.op}")
+		cls, width = rule(t1, t2)
+		return ground_type(cls, width)
+
+	def visit_Cmp(self, node):
+		yield node.e1
+		yield node.e2
+		return ground_type(UInt, 1)
+
+	def visit_UnOp(self, node):
+		typ = yield node.e
+		width = 1 if isinstance(typ, Clock) else typ.n
+		op = node.op
+		if op == Uop.AsUInt:
+			return ground_type(UInt, width)
+		if op == Uop.AsSInt:
+			return ground_type(SInt, width)
+		if op == Uop.AsClock:
+			return ground_type(Clock, None)
+		if op == Uop.ArithmeticToSigned:
+			return ground_type(SInt, width if isinstance(typ, SInt) else width + 1)
+		if op == Uop.Neg:
+			return ground_type(SInt, width + 1)
+		if op == Uop.Not:
+			return ground_type(UInt, width)
+		raise NotImplementedError(f"width of {op}")
+
+	def visit_Pad(self, node):
+		typ = yield node.e
+		return ground_type(typ.__class__, max(typ.n, node.n))
+
+	def visit_ShiftLeft(self, node):
+		typ = yield node.e
+		if isinstance(node.n, int):
+			return ground_type(typ.__class__, typ.n + node.n)
+		shift = yield node.n
+		return ground_type(typ.__class__, typ.n + (1 << shift.n) - 1)
+
+	def visit_ShiftRight(self, node):
+		typ = yield node.e
+		if isinstance(node.n, int):
+			return ground_type(typ.__class__, max(typ.n - node.n, 1))
+		yield node.n
+		return typ
+
+	def visit_Extract(self, node):
+		yield node.e
+		return ground_type(UInt, node.hi - node.lo + 1)
+
+	def visit_Head(self, node):
+		yield node.e
+		return ground_type(UInt, node.n)
+
+	def visit_Tail(self, node):
+		typ = yield node.e
+		return ground_type(UInt, typ.n - node.n)
+
+	def visit_Mux(self, node):
+		yield node.sel
+		ta, tb = (yield node.a), (yield node.b)
+		if not isinstance(ta, (UInt, SInt)):
+			return ta
+		return ground_type(ta.__class__, max(ta.n, tb.n))
+
+	def visit_ValidIf(self, node):
+		yield node.valid
+		return (yield node.a)
+
+def infer_types(mod: Module) -> TypeTable:
+	return InferTypes().run(mod)
+
+## Constant Folding ##
+
+def to_uint(value: int, width: int) -> int:
+	return value & ((1 << width) - 1)
+
+def to_sint(value: int, width: int) -> int:
+	value = to_uint(value, width)
+	return value - (1 << width) if width > 0 and value >> (width - 1) else value
+
+def literal_value(node: Literal) -> int:
+	""" value of a literal, truncated to its width """
+	typ = node.typ
+	signed = isinstance(typ, SInt)
+	width = typ.n if typ.n is not None else literal_width(node.value, signed)
+	return to_sint(node.value, width) if signed else to_uint(node.value, width)
+
+def _div(a: int, b: int) -> Optional[int]:
+	# FIRRTL rounds towards zero, division by zero is undefined and not folded
+	if b == 0: return None
+	q = abs(a) // abs(b)
+	return q if (a < 0) == (b < 0) else -q
+
+def _rem(a: int, b: int) -> Optional[int]:
+	if b == 0: return None
+	return a - b * _div(a, b)
+
+# Bop -> (a, b, width of a, width of b) -> value, results are truncated by `_literal`
+_bop_folds = {
+	Bop.Add: lambda a, b, w1, w2: a + b,
+	Bop.Sub: lambda a, b, w1, w2: a - b,
+	Bop.Mul: lambda a, b, w1, w2: a * b,
+	Bop.Div: lambda a, b, w1, w2: _div(a, b),
+	Bop.Rem: lambda a, b, w1, w2: _rem(a, b),
+	Bop.And: lambda a, b, w1, w2: a & b,
+	Bop.Or:  lambda a, b, w1, w2: a | b,
+	Bop.Xor: lambda a, b, w1, w2: a ^ b,
+	Bop.Cat: lambda a, b, w1, w2: (to_uint(a, w1) << w2) | to_uint(b, w2),
+}
+
+_commutative = {Bop.And, Bop.Or, Bop.Xor}
+
+_cop_folds = {
+	Cop.EQ: operator.eq, Cop.NE: operator.ne, Cop.LT: operator.lt,
+	Cop.GT: operator.gt, Cop.LE: operator.le, Cop.GE: operator.ge,
+}
+
+# AsClock is not folded, a clock literal does not exist
+_uop_folds = {
+	Uop.AsUInt: lambda a, w: a,
+	Uop.AsSInt: lambda a, w: a,
+	Uop.ArithmeticToSigned: lambda a, w: a,
+	Uop.Neg: lambda a, w: -a,
+	Uop.Not: lambda a, w: ~a,
+}
+
+class ConstantFold(kast.NodeTransformer):
+	""" Folds literals through all primitive operations and removes trivial logic:
+	    `and` with all ones, `or`/`xor` with zero, `not(not(x))`, muxes with a constant
+	    select or equal arms, constant `validif`, printf/stop that can never fire.
+	    A replacement always has the type of the expression it replaces, narrower
+	    operands are padded. """
+	memoize = True
+
+	def run(self, mod: Module) -> Module:
+		self.types = infer_types(mod)
+		self.clear_memo()
+		res = self.visit(mod)
+		self.clear_memo()
+		self.types = None
+		return res
+
+	def _typed(self, expr: Expr, typ: Type) -> Expr:
+		if expr not in self.types:
+			self.types[expr] = typ
+		return expr
+
+	def _literal(self, value: int, typ: Type) -> Literal:
+		value = to_sint(value, typ.n) if isinstance(typ, SInt) else to_uint(value, typ.n)
+		return self._typed(Literal._trusted(value, typ), typ)
+
+	def _fit(self, expr: Expr, typ: Type) -> Optional[Expr]:
+		""" `expr` extended to `typ`, None if that is not a plain extension """
+		tx = self.types[expr]
+		if tx is typ:
+			return expr
+		if tx.__class__ is typ.__class__ and isinstance(typ, (UInt, SInt)) and tx.n < typ.n:
+			return self._typed(Pad._trusted(expr, typ.n), typ)
+		return None
+
+	def _const(self, expr: Expr) -> Optional[int]:
+		return literal_value(expr) if isinstance(expr, Literal) else None
+
+	def visit_BinOp(self, node):
+		new = yield from self._generic_visit_iter(node)
+		typ = self.types[node]
+		t1, t2 = self.types[new.e1], self.types[new.e2]
+		c1, c2 = self._const(new.e1), self._const(new.e2)
+		op = node.op
+		if c1 is not None and c2 is not None:
+			value = _bop_folds[op](c1, c2, t1.n, t2.n)
+			if value is not None:
+				return self._literal(value, typ)
+		elif op in _commutative and (c1 is not None or c2 is not None):
+			x, c = (new.e2, c1) if c1 is not None else (new.e1, c2)
+			tx = self.types[x]
+			if c == 0 and op == Bop.And:
+				return self._literal(0, typ)
+			if c == 0 or (op == Bop.And and isinstance(tx, UInt) and to_uint(c, tx.n) == (1 << tx.n) - 1):
+				simple = self._fit(x, typ)
+				if simple is not None:
+					return simple
+			if op == Bop.Or and to_uint(c, typ.n) == (1 << typ.n) - 1:
+				return self._literal(c, typ)
+		return self._typed(new, typ)
+
+	def visit_Cmp(self, node):
+		new = yield from self._generic_visit_iter(node)
+		c1, c2 = self._const(new.e1), self._const(new.e2)
+		if c1 is not None and c2 is not None:
+			return self._literal(int(_cop_folds[node.op](c1, c2)), self.types[node])
+		return self._typed(new, self.types[node])
+
+	def visit_UnOp(self, node):
+		new = yield from self._generic_visit_iter(node)
+		typ = self.types[node]
+		fold = _uop_folds.get(node.op)
+		c = self._const(new.e)
+		if c is not None and fold is not None:
+			return self._literal(fold(c, self.types[new.e].n), typ)
+		if node.op == Uop.Not and isinstance(new.e, UnOp) and new.e.op == Uop.Not:
+			simple = self._fit(new.e.e, typ)
+			if simple is not None:
+				return simple
+		if node.op in {Uop.AsUInt, Uop.AsSInt} and self.types[new.e] is typ:
+			return new.e
+		return self._typed(new, typ)
+
+	def visit_Pad(self, node):
+		new = yield from self._generic_visit_iter(node)
+		typ = self.types[node]
+		c = self._const(new.e)
+		if c is not None:
+			return self._literal(c, typ)
+		if self.types[new.e] is typ:
+			return new.e
+		return self._typed(new, typ)
+
+	def visit_ShiftLeft(self, node):
+		new = yield from self._generic_visit_iter(node)
+		typ = self.types[node]
+		c = self._const(new.e)
+		n = new.n if isinstance(new.n, int) else self._const(new.n)
+		if c is not None and n is not None:
+			return self._literal(c << n, typ)
+		if n == 0 and self._fit(new.e, typ) is not None:
+			return self._fit(new.e, typ)
+		return self._typed(new, typ)
+
+	def visit_ShiftRight(self, node):
+		new = yield from self._generic_visit_iter(node)
+		typ = self.types[node]
+		c = self._const(new.e)
+		n = new.n if isinstance(new.n, int) else self._const(new.n)
+		if c is not None and n is not None:
+			return self._literal(c >> n, typ)
+		if n == 0 and self.types[new.e] is typ:
+			return new.e
+		return self._typed(new, typ)
+
+	def visit_Extract(self, node):
+		new = yield from self._generic_visit_iter(node)
+		typ = self.types[node]
+		c = self._const(new.e)
+		if c is not None:
+			return self._literal(c >> node.lo, typ)
+		if node.lo == 0 and self.types[new.e] is typ:
+			return new.e
+		return self._typed(new, typ)
+
+	def visit_Head(self, node):
+		new = yield from self._generic_visit_iter(node)
+		typ, te = self.types[node], self.types[new.e]
+		c = self._const(new.e)
+		if c is not None:
+			return self._literal(to_uint(c, te.n) >> (te.n - node.n), typ)
+		if te is typ:
+			return new.e
+		return self._typed(new, typ)
+
+	def visit_Tail(self, node):
+		new = yield from self._generic_visit_iter(node)
+		typ = self.types[node]
+		c = self._const(new.e)
+		if c is not None:
+			return self._literal(c, typ)
+		if self.types[new.e] is typ:
+			return new.e
+		return self._typed(new, typ)
+
+	def visit_Mux(self, node):
+		new = yield from self._generic_visit_iter(node)
+		typ = self.types[node]
+		sel = self._const(new.sel)
+		if sel is not None or new.a is new.b:
+			simple = self._fit(new.a if sel != 0 else new.b, typ)
+			if simple is not None:
+				return simple
+		return self._typed(new, typ)
+
+	def visit_ValidIf(self, node):
+		new = yield from self._generic_visit_iter(node)
+		typ = self.types[node]
+		# the value is undefined when `valid` is false, so the expression can always be used
+		if self._const(new.valid) is not None:
+			return new.a
+		return self._typed(new, typ)
+
+	def visit_Register(self, node):
+		new = yield from self._generic_visit_iter(node)
+		if new.reset is not None and self._const(new.reset.enable) == 0:
+			return new.set(reset=None)
+		return new
+
+	def visit_PrintF(self, node):
+		new = yield from self._generic_visit_iter(node)
+		return None if self._const(new.condition) == 0 else new
+
+	def visit_Stop(self, node):
+		new = yield from self._generic_visit_iter(node)
+		return None if self._const(new.condition) == 0 else new
+
+def constant_fold(mod: Module) -> Module:
+	return ConstantFold().run(mod)
+
+## Cone of Influence ##
+
+class _MarkLive(kast.NodeVisitor):
+	""" adds all signals that an expression reads to the work list, every node is only visited once """
+	memoize = True
+
+	def __init__(self, live: set, todo: list):
+		self.live, self.todo = live, todo
+
+	def visit_Ref(self, node):
+		if node.name not in self.live:
+			self.live.add(node.name)
+			self.todo.append(node.name)
+
+def _root_name(lhs: Expr) -> str:
+	""" the signal that a connect drives, a connect to a field or element drives all of it """
+	while isinstance(lhs, (SubField, SubIndex)):
+		lhs = lhs.e
+	if not isinstance(lhs, Ref):
+		raise TypeError(f"cannot connect to {lhs.__class__.__name__}")
+	return lhs.name
+
+def cone_of_influence(mod: Module, observe, effects: bool = True) -> Module:
+	""" Removes all wires, registers and connects that the signals in `observe`
+	    do not depend on, through combinational logic and register next state logic.
+	    If `effects` is True, printf and stop statements and their inputs are kept as well.
+	    Input ports are always kept, output ports only if they are live. """
+	# signal name -> statements that declare or drive it
+	drivers = {}
+	for stmt in mod.statements:
+		if isinstance(stmt, Connect):
+			name = _root_name(stmt.lhs)
+		elif isinstance(stmt, (Register, WireDeclaration, NodeDeclaration)):
+			name = stmt.name
+		else:
+			continue
+		drivers.setdefault(name, []).append(stmt)
+	ports = {pp.name for pp in mod.ports}
+	live, todo = set(), []
+	for name in observe:
+		if name not in drivers and name not in ports:
+			raise ValueError(f"unknown signal `{name}` in module {mod.name}")
+		if name not in live:
+			live.add(name)
+			todo.append(name)
+	mark = _MarkLive(live, todo)
+	if effects:
+		for stmt in mod.statements:
+			if isinstance(stmt, (PrintF, Stop)):
+				mark.visit(stmt)
+	while len(todo) > 0:
+		for stmt in drivers.get(todo.pop(), []):
+			mark.visit(stmt)
+	statements = []
+	for stmt in mod.statements:
+		if isinstance(stmt, Connect):
+			keep = _root_name(stmt.lhs) in live
+		elif isinstance(stmt, (Register, WireDeclaration, NodeDeclaration)):
+			keep = stmt.name in live
+		else:
+			keep = effects or not isinstance(stmt, (PrintF, Stop))
+		if keep:
+			statements.append(stmt)
+	ports = [pp for pp in mod.ports if pp.dir == PortDir.Input or pp.name in live]
+	return Module._trusted(mod.name, ports, statements)
+
+## Shared Expressions ##
+
+def _count_uses(mod: Module) -> (dict, set):
+	""" id(expr) -> number of references from statements and other expressions,
+	    and all names that the module declares or references """
+	uses, names = {}, {pp.name for pp in mod.ports}
+	todo = []
+	for stmt in mod.statements:
+		if isinstance(stmt, (Register, WireDeclaration, NodeDeclaration)):
+			names.add(stmt.name)
+		todo.append(stmt)
+	while len(todo) > 0:
+		node = todo.pop()
+		count = uses.get(id(node), 0)
+		uses[id(node)] = count + 1
+		if count > 0:
+			continue
+		if isinstance(node, Ref):
+			names.add(node.name)
+			continue
+		for name in node._fields:
+			value = getattr(node, name)
+			if isinstance(value, Node):
+				todo.append(value)
+			elif isinstance(value, list):
+				todo += value
+	return uses, names
+
+class _NameShared(kast.NodeTransformer):
+	""" replaces operations with more than one use by references and collects their declarations """
+	memoize = True
+
+	def __init__(self, uses: dict, taken: set, prefix: str):
+		self.uses, self.taken, self.prefix = uses, taken, prefix
+		self.counter = 0
+		self.declarations = []
+
+	def fresh_name(self) -> str:
+		while f"{self.prefix}{self.counter}" in self.taken:
+			self.counter += 1
+		self.counter += 1
+		return f"{self.prefix}{self.counter - 1}"
+
+	def generic_visit(self, node):
+		new = yield from self._generic_visit_iter(node)
+		if self.uses.get(id(node), 0) < 2 or not isinstance(node, (PrimOp, Mux, ValidIf)):
+			return new
+		name = self.fresh_name()
+		self.declarations.append(NodeDeclaration._trusted(name, new))
+		return Ref._trusted(name)
+
+def share_expressions(mod: Module, prefix: str = "_GEN_") -> Module:
+	""" Declares every operation that is referenced more than once as a `node` right
+	    before the first statement that uses it, all uses refer to the node by name.
+	    The text of a module with shared subexpressions then grows with the size of
+	    the DAG instead of the size of the tree. """
+	uses, taken = _count_uses(mod)
+	rename = _NameShared(uses, taken, prefix)
+	statements = []
+	for stmt in mod.statements:
+		new = rename.visit(stmt)
+		statements += rename.declarations
+		rename.declarations = []
+		statements.append(new)
+	if len(statements) == len(mod.statements):
+		return mod
+	return Module._trusted(mod.name, mod.ports, statements)
+
+## Aggregate Types ##
+
+def leaves(typ: Type) -> list:
+	""" (access steps, ground type) of every ground element of `typ` in declaration order;
+	    a step is a field name or a vector index """
+	out, todo = [], [((), typ)]
+	while len(todo) > 0:
+		steps, typ = todo.pop()
+		if isinstance(typ, Bundle):
+			todo += [(steps + (ff.name,), ff.typ) for ff in reversed(typ.fields)]
+		elif isinstance(typ, Vector):
+			todo += [(steps + (ii,), typ.elementtype) for ii in reversed(range(typ.count))]
+		else:
+			out.append((steps, typ))
+	return out
+
+def _path(root: str, steps) -> str:
+	return root + "".join(f"[{ss}]" if isinstance(ss, int) else f".{ss}" for ss in steps)
+
+def _access(expr: Expr, steps) -> Expr:
+	""" the element of an aggregate expression, field accesses are moved into muxes """
+	if len(steps) == 0:
+		return expr
+	if isinstance(expr, Mux):
+		return Mux._trusted(expr.sel, _access(expr.a, steps), _access(expr.b, steps))
+	if isinstance(expr, ValidIf):
+		return ValidIf._trusted(expr.valid, _access(expr.a, steps))
+	for ss in steps:
+		expr = SubIndex._trusted(expr, ss) if isinstance(ss, int) else SubField._trusted(expr, ss)
+	return expr
+
+class LowerTypes(kast.NodeTransformer):
+	""" Replaces aggregate ports, wires, registers and nodes with one ground signal per element
+	    and expands aggregate connects. `io.req[3].addr` becomes `io_req_3_addr`, a `_` is
+	    appended to the signal name if that collides with another name.
+	    `paths` maps the path of every element to the name of its ground signal. """
+	memoize = True
+
+	def run(self, mod: Module) -> Module:
+		self.types = infer_types(mod)
+		self.paths = {}
+		taken = {pp.name for pp in mod.ports}
+		for stmt in mod.statements:
+			if isinstance(stmt, (WireDeclaration, Register, NodeDeclaration)):
+				taken.add(stmt.name)
+		ports = []
+		for pp in mod.ports:
+			ports += [Port._trusted(name, typ, pp.dir) for name, typ, _ in self.declare(pp.name, pp.typ, taken)]
+		statements = []
+		for stmt in mod.statements:
+			if isinstance(stmt, WireDeclaration):
+				statements += [WireDeclaration._trusted(name, typ) for name, typ, _ in self.declare(stmt.name, stmt.typ, taken)]
+			elif isinstance(stmt, Register):
+				clock = self.visit(stmt.clock)
+				for name, typ, steps in self.declare(stmt.name, stmt.typ, taken):
+					reset = stmt.reset
+					if reset is not None:
+						reset = Reset._trusted(self.visit(reset.enable), self.visit(_access(reset.value, steps)))
+					statements.append(Register._trusted(name, typ, clock, reset))
+			elif isinstance(stmt, NodeDeclaration):
+				for name, _, steps in self.declare(stmt.name, self.types[stmt.value], taken):
+					statements.append(NodeDeclaration._trusted(name, self.visit(_access(stmt.value, steps))))
+			elif isinstance(stmt, Connect):
+				for steps, _ in leaves(self.types[stmt.lhs]):
+					lhs, rhs = _access(stmt.lhs, steps), _access(stmt.rhs, steps)
+					statements.append(Connect._trusted(self.visit(lhs), self.visit(rhs)))
+			else:
+				statements.append(self.visit(stmt))
+		self.clear_memo()
+		return Module._trusted(mod.name, ports, statements)
+
+	def declare(self, root: str, typ: Type, taken: set) -> list:
+		""" (name, ground type, access steps) of the ground signals that replace `root` """
+		elements = leaves(typ)
+		if len(elements) == 1 and len(elements[0][0]) == 0:
+			return [(root, typ, ())]
+		prefix = root
+		names = [prefix + "".join(f"_{ss}" for ss in steps) for steps, _ in elements]
+		while any(name in taken for name in names):
+			prefix += "_"
+			names = [prefix + "".join(f"_{ss}" for ss in steps) for steps, _ in elements]
+		taken.update(names)
+		out = []
+		for name, (steps, ground) in zip(names, elements):
+			self.paths[_path(root, steps)] = name
+			out.append((name, ground, steps))
+		return out
+
+	def _lower_access(self, node):
+		steps = []
+		base = node
+		while isinstance(base, (SubField, SubIndex)):
+			steps.append(base.name if isinstance(base, SubField) else base.n)
+			base = base.e
+		steps.reverse()
+		if isinstance(base, (Mux, ValidIf)):
+			return (yield _access(base, steps))
+		if not isinstance(base, Ref):
+			raise TypeError(f"cannot access elements of {base.__class__.__name__}")
+		name = self.paths.get(_path(base.name, steps))
+		if name is None:
+			raise TypeError(f"`{_path(base.name, steps)}` is not a ground type")
+		return Ref._trusted(name)
+
+	def visit_SubField(self, node):
+		return (yield from self._lower_access(node))
+
+	def visit_SubIndex(self, node):
+		return (yield from self._lower_access(node))
+
+def lower_types(mod: Module) -> (Module, dict):
+	""" returns the module with ground types only and the map from element paths,
+	    e.g. `io.req[3].addr`, to the names of the ground signals """
+	lower = LowerTypes()
+	res = lower.run(mod)
+	return res, lower.paths
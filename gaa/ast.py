@@ -44,11 +44,14 @@ class PrintF(Statement):
 	format_str = str
 	vargs = List[Expr]
 
+# state and wires are identified by object identity, never share them
 class Wire(firrtl.Ref):
+	_hash_cons = False
 	typ = Type
 	name = Optional[str] # optional name **hint**
 
 class Register(firrtl.Ref):
+	_hash_cons = False
 	typ = Type
 	reset = Optional[int]
 	name = Optional[str]  # optional name **hint**
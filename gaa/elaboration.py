@@ -12,11 +12,11 @@ def default(maybe, dd):
 	else: return maybe
 
 def priority_mux(signals):
-	front = signals[0]
-	if len(signals) == 1:
-		return front[1]
-	else:
-		return firrtl.Mux(front[0], front[1], priority_mux(signals[1:]))
+	# built back to front in order to support long chains without recursion
+	out = signals[-1][1]
+	for sel, value in reversed(signals[:-1]):
+		out = firrtl.Mux(sel, value, out)
+	return out
 
 def priority_encoder(inputs):
 	T = UInt(len(inputs))
@@ -156,11 +156,14 @@ def unique_id(prefix, ids):
 	return name
 
 class FindRegistersAndWires(kast.NodeVisitor):
+	memoize = True
 	def __int__(self):
 		self.regs_and_wires = set()
 	def run(self, node):
 		self.regs_and_wires = set()
+		self.clear_memo()
 		self.visit(node)
+		self.clear_memo()
 		return self.regs_and_wires
 	def visit_Wire(self, node):
 		if isinstance(node, Wire):
@@ -172,6 +175,8 @@ class FindRegistersAndWires(kast.NodeVisitor):
 
 class DeclareRegistersAndWires(kast.NodeTransformer):
 	""" declares gaa.Register and gaa.Wire and inserts references for them """
+	# shared subexpressions are only rewritten once and stay shared
+	memoize = True
 	def __init__(self):
 		self.ids = {}
 		self._FindRegistersAndWires = FindRegistersAndWires()
@@ -201,6 +206,7 @@ class DeclareRegistersAndWires(kast.NodeTransformer):
 			regs_and_wires = self._FindRegistersAndWires.run(mod)
 		reserved_ids = { pp.name for pp in mod.ports }
 		decls = []
+		self.clear_memo()
 		for node in regs_and_wires:
 			name = unique_id(self.name(mod, node), reserved_ids)
 			reserved_ids.add(name)
@@ -212,6 +218,7 @@ class DeclareRegistersAndWires(kast.NodeTransformer):
 			else:
 				raise TypeError(f"unexpected type: {type(node)} of {node}")
 		stmts = [self.visit(stmt) for stmt in mod.statements]
+		self.clear_memo()
 		return mod.set(statements=decls + stmts)
 
 	def visit_Wire(self, node):
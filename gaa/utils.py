@@ -17,7 +17,11 @@ def elaborate(module: Module):
 	mm = _DeclareRegistersAndWires.run(circuit.modules[0], "reset", "clk")
 	return circuit.set(modules=[mm])
 
-def get_firrtl(circuit):
+def get_firrtl(circuit, out=None):
+	""" returns the FIRRTL text, or streams it into the binary file-like object `out` """
+	if out is not None:
+		firrtl.emit(circuit, out)
+		return None
 	return firrtl.ToString().visit(circuit)
 
 def simulate(circuit, max_cycles: int):
@@ -8,36 +8,61 @@
 
 # support for typed IR nodes
 
+import typing, os, inspect, struct, sys, enum, array, operator, gc, contextlib
 from typing import Union, Optional, List, Tuple, Iterable
 
-def _isinstance(obj, typ) -> bool:
-	typ_name = str(typ)
-	is_typing = typ_name.startswith('typing.')
-	if not is_typing:
-		return isinstance(obj, typ)
-	name = typ_name.split('.')[1].split('[')[0]
-	if name == 'Union':
-		return any(_isinstance(obj, aa) for aa in typ.__args__)
-	elif name == 'List':
-		(et,) = typ.__args__
-		return isinstance(obj, list) and all(_isinstance(ii, et) for ii in obj)
-	elif name == 'Tuple':
-		return isinstance(obj, tuple) and all(_isinstance(ii, aa) for ii,aa in zip(obj, typ.__args__))
+# when enabled, nodes created through the trusted path (`map`, `set`, `_trusted`) are type checked
+debug = os.environ.get('KAST_DEBUG', '0') not in {'', '0'}
+
+def _compile_check(typ):
+	""" turns a field annotation into a `(types, predicate)` pair
+	    the predicate is None whenever `isinstance(obj, types)` suffices """
+	origin = typing.get_origin(typ)
+	if origin is None:
+		return typ, None
+	args = typing.get_args(typ)
+	if origin is Union:
+		checks = [_compile_check(aa) for aa in args]
+		if all(pred is None for _, pred in checks):
+			return tuple(tt for tt, _ in checks), None
+		def check_union(obj):
+			return any(isinstance(obj, tt) if pred is None else pred(obj) for tt, pred in checks)
+		return None, check_union
+	elif origin is list:
+		(et,) = args
+		et, pred = _compile_check(et)
+		if pred is None:
+			return None, lambda obj: isinstance(obj, list) and all(isinstance(ii, et) for ii in obj)
+		return None, lambda obj: isinstance(obj, list) and all(pred(ii) for ii in obj)
+	elif origin is tuple:
+		checks = [_compile_check(aa) for aa in args]
+		def check_tuple(obj):
+			return isinstance(obj, tuple) and all(
+				isinstance(ii, tt) if pred is None else pred(ii) for ii, (tt, pred) in zip(obj, checks))
+		return None, check_tuple
 	else:
-		raise NotImplementedError(f"_isinstance({obj}, {typ})")
+		raise NotImplementedError(f"_compile_check({typ})")
+
+def _isinstance(obj, typ) -> bool:
+	types, pred = _compile_check(typ)
+	return isinstance(obj, types) if pred is None else pred(obj)
 
 def _is_optional(typ) -> bool:
-	return(str(typ).startswith('typing.Union') and
-		   any(aa is type(None) for aa in typ.__args__))
+	return(typing.get_origin(typ) is Union and
+		   any(aa is type(None) for aa in typing.get_args(typ)))
 
 def get_fields_of_class(cls):
 	""" returns the fields of a single class """
+	if isinstance(cls, NodeMeta):
+		return dict(cls._schema.declared)
 	# this relies on https://www.python.org/dev/peps/pep-0520
 	# and Python 3.6 (see Note in PEP520)
 	return {n:v for n,v in cls.__dict__.items() if not n[0] == '_'}
 
 def get_fields(cls):
 	""" returns fields of the class and all ancestor classes """
+	if isinstance(cls, NodeMeta):
+		return dict(cls._schema.fields)
 	fields = get_fields_of_class(cls)
 	while len(cls.__bases__) > 0 and cls.__bases__[0] not in [Node, object]:
 		new_fields = [get_fields_of_class(b) for b in cls.__bases__]
@@ -68,41 +93,128 @@ def matches_types(types, tt):
 	if isinstance(tt, Optional): return matches_types(types, tt.field_type)
 	return False
 
-class Node:
+class Schema:
+	""" field names, annotations and compiled type checks of a Node class """
+	def __init__(self, fields: dict, declared: dict):
+		self.fields = fields
+		self.declared = declared
+		self.names = tuple(fields.keys())
+		self.checks = tuple((name, *_compile_check(typ), _is_optional(typ))
+							for name, typ in fields.items())
+		self.check_of = {check[0]: check for check in self.checks}
+
+	def check(self, name, value):
+		""" raises a TypeError if `value` is not acceptable for the field `name` """
+		if name not in self.check_of:
+			raise TypeError("Unknown field `{}`".format(name))
+		_, types, pred, _ = self.check_of[name]
+		if not (isinstance(value, types) if pred is None else pred(value)):
+			raise TypeError("Field `{}` requires values of type `{}` not `{}`".format(
+				name, self.fields[name], type(value)))
+
+def _schema_of_bases(bases) -> dict:
+	base_fields = [b._schema.fields for b in bases if isinstance(b, NodeMeta)]
+	base_fields = [ff for ff in base_fields if len(ff) > 0]
+	assert len(base_fields) < 2, "multiple inheritance is not supported ... too lazy"
+	return base_fields[0] if len(base_fields) > 0 else {}
+
+class NodeMeta(type):
+	""" builds the `Schema` of every Node class once, when the class is created,
+	    and stores the fields in `__slots__` instead of a per instance `__dict__` """
+	def __new__(mcs, name, bases, namespace):
+		# the methods of the Node root class are not fields
+		is_root = not any(isinstance(b, NodeMeta) for b in bases)
+		# this relies on https://www.python.org/dev/peps/pep-0520
+		declared = {} if is_root else {n:v for n,v in namespace.items() if not n[0] == '_'}
+		base_fields = _schema_of_bases(bases)
+		# field annotations must not shadow the slot descriptors
+		namespace = {n:v for n,v in namespace.items() if n not in declared}
+		namespace.setdefault('__slots__', tuple(n for n in declared if n not in base_fields))
+		cls = super().__new__(mcs, name, bases, namespace)
+		fields = dict(declared)
+		# only include base class fields if they have not been overwritten
+		for name, value in base_fields.items():
+			if name not in fields:
+				fields[name] = value
+		cls._schema = Schema(fields, declared)
+		cls._fields = cls._schema.names
+		return cls
+
+	def __call__(cls, *args, **kwargs):
+		node = super().__call__(*args, **kwargs)
+		if _hash_consing is None or not cls._hash_cons:
+			return node
+		return _hash_consing.intern(node)
+
+_missing = object()
+
+class Node(metaclass=NodeMeta):
 	""" type checking replacement for ast.AST"""
+	__slots__ = ()
+	# set to False for node classes that are compared by identity
+	_hash_cons = True
 	def __init__(self, *args, **kwargs):
-		fields = get_fields(type(self))
-		field_names = fields.keys()
-		aa = parse_args(field_names, args, kwargs)
-		# check completeness
-		for name, value in fields.items():
-			if not name in aa and not _is_optional(value):
-				raise TypeError("Missing value for field `{}`".format(name))
-		# check types
-		for name, value in aa.items():
-			if not _isinstance(value, fields[name]):
-				raise TypeError("Field `{}` requires values of type `{}` not `{}`".format(
-					name, fields[name], type(value)))
-		# accept field values
-		for name in field_names:
-			object.__setattr__(self, name, aa.get(name, None))
-		# fake _fields
-		object.__setattr__(self, "_fields", field_names)
+		schema = self._schema
+		aa = parse_args(schema.names, args, kwargs) if len(args) > 0 else kwargs
+		found = 0
+		for name, types, pred, optional in schema.checks:
+			value = aa.get(name, _missing)
+			if value is _missing:
+				# check completeness
+				if not optional:
+					raise TypeError("Missing value for field `{}`".format(name))
+				value = None
+			else:
+				# check types
+				found += 1
+				if not (isinstance(value, types) if pred is None else pred(value)):
+					schema.check(name, value)
+			# accept field values
+			object.__setattr__(self, name, value)
+		if found != len(aa):
+			unknown = [name for name in aa if name not in schema.fields]
+			raise TypeError("Unknown field(s) {} for `{}`".format(
+				", ".join(f"`{nn}`" for nn in unknown), self.__class__.__name__))
 	def __setattr__(self, name, value):
 		raise AttributeError("kAST nodes are immutable!")
+	def __delattr__(self, name):
+		raise AttributeError("kAST nodes are immutable!")
+	def __reduce__(self):
+		# the default slot state restore would need __setattr__
+		return self.__class__, tuple(getattr(self, name) for name in self._fields)
+	@classmethod
+	def _trusted(cls, *values):
+		""" builds a node from field values (in `_fields` order) that have already been
+		    validated, e.g. because they were taken from another node; only checked in debug mode """
+		node = object.__new__(cls)
+		for name, value in zip(cls._fields, values):
+			object.__setattr__(node, name, value)
+		if debug:
+			for name, value in zip(cls._fields, values):
+				cls._schema.check(name, value)
+		if _hash_consing is not None and cls._hash_cons:
+			return _hash_consing.intern(node)
+		return node
 	def map(self, fun):
-		new_values = {}
-		for name, old in iter_fields(self):
-			if old is None: continue
-			if isinstance(old, list):
+		""" applies `fun` to all fields, returns `self` if no field value changed """
+		new_values, changed = [], False
+		for name in self._fields:
+			old = getattr(self, name)
+			if old is None:
+				new = None
+			elif isinstance(old, list):
 				new = list(filter_none(fun(o) for o in old))
+				changed = changed or _items_changed(old, new)
 			elif isinstance(old, tuple):
 				new = tuple(filter_none(fun(o) for o in old))
+				changed = changed or _items_changed(old, new)
 			else:
 				new = fun(old)
-			if new is None: continue
-			new_values[name] = new
-		return self.__class__(**new_values)
+				changed = changed or new is not old
+			new_values.append(new)
+		if not changed:
+			return self
+		return self.__class__._trusted(*new_values)
 	def apply(self, fun):
 		for _, val in iter_fields(self):
 			if val is None: continue
@@ -111,11 +223,13 @@ class Node:
 			else:
 				fun(val)
 	def set(self, **kwargs):
+		""" copy of the node with some fields replaced, only the new values are type checked """
 		if len(kwargs) < 1: return self
-		field_names = set(self._fields)
-		assert set(kwargs.keys()).issubset(set(self._fields))
-		new_values = { name: kwargs.get(name, self.__getattribute__(name)) for name in self._fields }
-		return self.__class__(**new_values)
+		schema = self._schema
+		for name, value in kwargs.items():
+			schema.check(name, value)
+		new_values = (kwargs[name] if name in kwargs else getattr(self, name) for name in self._fields)
+		return self.__class__._trusted(*new_values)
 	def __str__(self):
 		desc = self.__class__.__name__ + "("
 		fields = []
@@ -125,6 +239,92 @@ class Node:
 		return self.__class__.__name__ + "(" + ", ".join(fields) + ")"
 	def __repr__(self): return str(self)
 
+def _items_changed(old, new) -> bool:
+	return len(old) != len(new) or any(oo is not nn for oo, nn in zip(old, new))
+
+def validate(root: Node) -> Node:
+	""" type checks every node reachable from `root`, use after trusted rewrites """
+	seen, todo = set(), [root]
+	while len(todo) > 0:
+		node = todo.pop()
+		if id(node) in seen: continue
+		seen.add(id(node))
+		schema = node._schema
+		for name in node._fields:
+			value = getattr(node, name)
+			schema.check(name, value)
+			if isinstance(value, Node):
+				todo.append(value)
+			elif isinstance(value, (list, tuple)):
+				todo += (vv for vv in value if isinstance(vv, Node))
+	return root
+
+## Hash Consing ##
+
+_hash_consing = None
+
+def _typed_key(value):
+	""" `1 == True == 1.0`, so scalars are keyed with their type, nodes in tuples by identity """
+	if isinstance(value, tuple):
+		return (tuple,) + tuple(id(vv) if isinstance(vv, Node) else _typed_key(vv) for vv in value)
+	return (type(value), value)
+
+class HashConsing:
+	""" While active, constructing a node that is structurally identical to a node
+	    that was built earlier in the same context returns the earlier instance.
+	    Nodes built inside one context can thus be compared with `is`.
+	    The table keeps its nodes alive until it is garbage collected.
+	    Nodes with list fields and classes with `_hash_cons = False` are never shared.
+	"""
+	def __init__(self):
+		self._nodes = {}
+		self._hashes = {}
+		self._outer = None
+
+	def __enter__(self):
+		global _hash_consing
+		self._outer, _hash_consing = _hash_consing, self
+		return self
+
+	def __exit__(self, type, value, traceback):
+		global _hash_consing
+		_hash_consing, self._outer = self._outer, None
+
+	def __len__(self):
+		return len(self._nodes)
+
+	def intern(self, node: Node) -> Node:
+		# children are keyed by identity: they are either shared already or
+		# compared by identity; this also keeps Expr.__eq__ overloads out of the lookup
+		key, mask = [node.__class__], 0
+		for ii, name in enumerate(node._fields):
+			value = getattr(node, name)
+			if isinstance(value, Node):
+				key.append(id(value))
+				mask |= 1 << ii
+			elif isinstance(value, list):
+				return node
+			else:
+				key.append(_typed_key(value))
+		key.append(mask)
+		key = tuple(key)
+		try:
+			existing = self._nodes.get(key)
+		except TypeError: # unhashable field value
+			return node
+		if existing is not None:
+			return existing
+		self._nodes[key] = node
+		self._hashes[id(node)] = hash((node.__class__.__name__,) + tuple(
+			self.hash(getattr(node, name)) if mask & (1 << ii) else getattr(node, name)
+			for ii, name in enumerate(node._fields)))
+		return node
+
+	def hash(self, node: Node) -> int:
+		""" structural hash of a node that was built in this context """
+		hh = self._hashes.get(id(node))
+		return hash(node) if hh is None else hh
+
 # code bellow copied + modified from Python3 ast library
 def iter_fields(node: Node):
 	for field in node._fields:
@@ -133,25 +333,465 @@ def iter_fields(node: Node):
 		except AttributeError:
 			pass
 
-class NodeVisitor:
+## Traversal ##
+
+class _DispatchTable(dict):
+	""" caches the visit method of one visitor class for every node class it has seen;
+	    entries are `(function, is_generator_function)` """
+	def __init__(self, visitor_cls, default_generic, generic_iter):
+		super().__init__()
+		self.visitor_cls = visitor_cls
+		self.default_generic = default_generic
+		self.generic_iter = generic_iter
+
+	def __missing__(self, node_cls):
+		method = getattr(self.visitor_cls, 'visit_' + node_cls.__name__, None)
+		if method is None:
+			method = self.visitor_cls.generic_visit
+			# the built in generic traversal is replaced by its iterative version
+			if method is self.default_generic:
+				method = self.generic_iter
+		entry = (method, inspect.isgeneratorfunction(method))
+		self[node_cls] = entry
+		return entry
+
+def _traverse(visitor, node, table: _DispatchTable):
+	""" Calls the visit method for `node`. Visit methods that are generator functions
+	    yield the child nodes they want visited and receive the result of each visit.
+	    Those are driven from an explicit stack, so their depth is not limited by the
+	    Python recursion limit. """
+	method, is_gen = table[node.__class__]
+	if not is_gen:
+		return method(visitor, node)
+	stack = [method(visitor, node)]
+	value = None
+	while True:
+		try:
+			child = stack[-1].send(value)
+		except StopIteration as done:
+			stack.pop()
+			if len(stack) == 0:
+				return done.value
+			value = done.value
+			continue
+		method, is_gen = table[child.__class__]
+		if is_gen:
+			stack.append(method(visitor, child))
+			value = None
+		else:
+			value = method(visitor, child)
+
+def _traverse_memo(visitor, node, table: _DispatchTable, memo: dict):
+	""" like `_traverse`, but every node is only visited once: later visits of the
+	    same node object return the first result. `memo` maps `id(node)` to `(node, result)`. """
+	if isinstance(node, Node) and id(node) in memo:
+		return memo[id(node)][1]
+	method, is_gen = table[node.__class__]
+	if not is_gen:
+		value = method(visitor, node)
+		if isinstance(node, Node): memo[id(node)] = (node, value)
+		return value
+	stack = [(method(visitor, node), node)]
+	value = None
+	while True:
+		try:
+			child = stack[-1][0].send(value)
+		except StopIteration as done:
+			_, done_node = stack.pop()
+			value = done.value
+			if isinstance(done_node, Node): memo[id(done_node)] = (done_node, value)
+			if len(stack) == 0:
+				return value
+			continue
+		if isinstance(child, Node) and id(child) in memo:
+			value = memo[id(child)][1]
+			continue
+		method, is_gen = table[child.__class__]
+		if is_gen:
+			stack.append((method(visitor, child), child))
+			value = None
+		else:
+			value = method(visitor, child)
+			if isinstance(child, Node): memo[id(child)] = (child, value)
+
+class _Traversal:
+	""" shared setup of `NodeVisitor` and `NodeTransformer` """
+	# when True, every node object is only visited once and later visits reuse
+	# the first result, until `clear_memo` is called; only use this if the visit
+	# methods do not depend on state that changes during the traversal
+	memoize = False
+	_memo = None
+	# visitor class -> _DispatchTable
+	_dispatch_tables = {}
+
+	def _visit(self, node, default_generic, generic_iter):
+		table = self._dispatch_tables.get(self.__class__)
+		if table is None:
+			table = self._dispatch_tables[self.__class__] = _DispatchTable(
+				self.__class__, default_generic, generic_iter)
+		if not self.memoize:
+			return _traverse(self, node, table)
+		if self._memo is None:
+			self._memo = {}
+		return _traverse_memo(self, node, table, self._memo)
+
+	def clear_memo(self):
+		self._memo = None
+
+class NodeVisitor(_Traversal):
+	""" Calls `visit_<ClassName>` for every node, falls back to `generic_visit`.
+	    Visit methods may be written as generators: `result = yield child` visits
+	    `child` without recursion and the method's return value is its result. """
 	def visit(self, node):
-		method = 'visit_' + node.__class__.__name__
-		getattr(self, method, self.generic_visit)(node)
+		return self._visit(node, NodeVisitor.generic_visit, NodeVisitor._generic_visit_iter)
 
 	def generic_visit(self, node):
 		if isinstance(node, Node):
 			node.apply(self.visit)
 
+	def _generic_visit_iter(self, node):
+		# field values that are not nodes, e.g. enums and ints, are not visited
+		if isinstance(node, Node):
+			for name in node._fields:
+				val = getattr(node, name)
+				if isinstance(val, Node):
+					yield val
+				elif isinstance(val, list) or isinstance(val, tuple):
+					for vv in val:
+						if isinstance(vv, Node): yield vv
+
 def filter_none(iter: Iterable) -> Iterable:
 	return (ii for ii in iter if ii is not None)
 
-class NodeTransformer:
+class NodeTransformer(_Traversal):
+	""" like `NodeVisitor`, but nodes are replaced by the result of their visit method;
+	    nodes whose children are all unchanged are returned as is """
 	def visit(self, node):
-		method = 'visit_' + node.__class__.__name__
-		return getattr(self, method, self.generic_visit)(node)
+		return self._visit(node, NodeTransformer.generic_visit, NodeTransformer._generic_visit_iter)
 
 	def generic_visit(self, node):
 		if isinstance(node, Node):
 			return node.map(self.visit)
 		else:
-			return node
\ No newline at end of file
+			return node
+
+	def _generic_visit_iter(self, node):
+		if not isinstance(node, Node):
+			return node
+		new_values, changed = [], False
+		for name in node._fields:
+			old = getattr(node, name)
+			if isinstance(old, Node):
+				new = yield old
+				changed = changed or new is not old
+			elif isinstance(old, list) or isinstance(old, tuple):
+				new = []
+				for oo in old:
+					nn = (yield oo) if isinstance(oo, Node) else oo
+					if nn is not None: new.append(nn)
+				if isinstance(old, tuple): new = tuple(new)
+				changed = changed or _items_changed(old, new)
+			else:
+				# None and values that are not nodes are kept as they are
+				new = old
+			new_values.append(new)
+		if not changed:
+			return node
+		return node.__class__._trusted(*new_values)
+
+
+## Serialization ##
+
+# Binary format, all integers little endian:
+#   magic `KAST`, u16 version
+#   u32 number of classes, per class: name and `,` separated fields (enums: no fields)
+#   u32 number of constants, per constant: a tag byte followed by the payload
+#   u64 number of words, followed by that many i32 words which describe the nodes
+#   in post order: class index, then one reference per field. References are
+#   2*node+0 or 2*constant+1, or a negative marker: -1 for None and -2/-3 for a
+#   list/tuple followed by its length and element references.
+#   The nodes are followed by the references of the root, a node or a list/tuple,
+#   and the number of words that these take.
+# Nodes that are shared in memory are written once and shared again after loading.
+
+_magic = b'KAST'
+_version = 2
+_none, _list, _tuple = -1, -2, -3
+_word = 'i' if array.array('i').itemsize == 4 else 'l'
+
+def _write_str(out, value: str):
+	data = value.encode('utf-8')
+	out.append(struct.pack('<I', len(data)))
+	out.append(data)
+
+def _read_str(data, pos):
+	(size,) = struct.unpack_from('<I', data, pos)
+	pos += 4
+	return bytes(data[pos:pos+size]).decode('utf-8'), pos + size
+
+def _class_name(cls) -> str:
+	return f"{cls.__module__}:{cls.__qualname__}"
+
+def _find_class(name: str):
+	""" only node classes and enums of modules that are imported already are loaded,
+	    data cannot import a module or name any other object """
+	module, qualname = name.split(':')
+	obj = sys.modules.get(module)
+	if obj is None:
+		raise ValueError(f"{name} is not in an imported module")
+	for part in qualname.split('.'):
+		obj = getattr(obj, part, None)
+	if not isinstance(obj, NodeMeta) and not (isinstance(obj, type) and issubclass(obj, enum.Enum)):
+		raise ValueError(f"{name} is neither a node class nor an enum")
+	return obj
+
+def _field_getter(cls):
+	""" returns a function that reads all fields of a node into a tuple """
+	if len(cls._fields) == 0:
+		return lambda node: ()
+	if len(cls._fields) == 1:
+		get = operator.attrgetter(cls._fields[0])
+		return lambda node: (get(node),)
+	return operator.attrgetter(*cls._fields)
+
+class _Writer:
+	def __init__(self):
+		self.classes = {}
+		self.constants = {}
+		self.words = array.array(_word)
+
+	def class_id(self, cls) -> int:
+		ii = self.classes.get(cls)
+		if ii is None:
+			ii = self.classes[cls] = len(self.classes)
+		return ii
+
+	def constant_ref(self, value) -> int:
+		# the type is part of the key, as e.g. `1 == True`
+		key = (value.__class__, value)
+		ref = self.constants.get(key)
+		if ref is None:
+			if isinstance(value, enum.Enum):
+				self.class_id(value.__class__)
+			ref = self.constants[key] = 2 * len(self.constants) + 1
+		return ref
+
+	def header(self) -> bytes:
+		out = [_magic, struct.pack('<HI', _version, len(self.classes))]
+		for cls in self.classes:
+			_write_str(out, _class_name(cls))
+			_write_str(out, ",".join(cls._fields) if isinstance(cls, NodeMeta) else "")
+		out.append(struct.pack('<I', len(self.constants)))
+		for cls, value in self.constants:
+			if value is None:
+				out.append(b'n')
+			elif cls is bool:
+				out.append(b'b' + bytes([value]))
+			elif isinstance(value, enum.Enum):
+				out.append(b'e' + struct.pack('<I', self.classes[cls]))
+				_write_str(out, value.name)
+			elif cls is int:
+				data = value.to_bytes((value.bit_length() + 8) // 8, 'little', signed=True)
+				out.append(b'i' + struct.pack('<I', len(data)) + data)
+			elif cls is str:
+				out.append(b's')
+				_write_str(out, value)
+			elif cls is float:
+				out.append(b'f' + struct.pack('<d', value))
+			else:
+				raise TypeError(f"cannot serialize field value {value!r} of type {cls}")
+		return b''.join(out)
+
+	def write(self, root) -> bytes:
+		# nodes are keyed by identity, their hash is never structural
+		index = {}
+		words, classes, constants = self.words, self.classes, self.constants
+		append, _isinstance, _Node, _seq = words.append, isinstance, Node, (list, tuple)
+		getters = {}
+		# stack entries are nodes to visit or `(node, values)` once their children are written
+		stack = list(reversed(_nodes_in(root)))
+		while len(stack) > 0:
+			item = stack.pop()
+			if item.__class__ is tuple:
+				node, values = item
+			else:
+				node = item
+				if node in index: continue
+				cls = node.__class__
+				getter = getters.get(cls)
+				if getter is None:
+					getter = getters[cls] = _field_getter(cls)
+				values = getter(node)
+				# children have to be written first
+				pending = None
+				for value in values:
+					if _isinstance(value, _Node):
+						if value not in index:
+							if pending is None: pending = []
+							pending.append(value)
+					elif _isinstance(value, _seq):
+						for vv in value:
+							if _isinstance(vv, _Node) and vv not in index:
+								if pending is None: pending = []
+								pending.append(vv)
+				if pending is not None:
+					stack.append((node, values))
+					pending.reverse()
+					stack += pending
+					continue
+			if node in index: continue
+			index[node] = len(index)
+			cls_id = classes.get(node.__class__)
+			append(self.class_id(node.__class__) if cls_id is None else cls_id)
+			for value in values:
+				if _isinstance(value, _Node):
+					append(2 * index[value])
+				elif value is None:
+					append(_none)
+				elif _isinstance(value, _seq):
+					words.extend(self._refs(value, index))
+				else:
+					ref = constants.get((value.__class__, value))
+					append(self.constant_ref(value) if ref is None else ref)
+		refs = self._refs(root, index)
+		words.extend(refs)
+		append(len(refs))
+		if sys.byteorder != 'little':
+			words.byteswap()
+		return self.header() + struct.pack('<Q', len(words)) + words.tobytes()
+
+	def _refs(self, value, index):
+		if isinstance(value, Node):
+			return (2 * index[value],)
+		elif value is None:
+			return (_none,)
+		elif isinstance(value, (list, tuple)):
+			refs = [_list if isinstance(value, list) else _tuple, len(value)]
+			for vv in value:
+				refs += self._refs(vv, index)
+			return refs
+		else:
+			return (self.constant_ref(value),)
+
+def _nodes_in(value) -> list:
+	""" the nodes in a root that may be a node or a (nested) list or tuple """
+	if isinstance(value, Node):
+		return [value]
+	if isinstance(value, (list, tuple)):
+		return [node for vv in value for node in _nodes_in(vv)]
+	return []
+
+@contextlib.contextmanager
+def _gc_paused():
+	# the cyclic garbage collector would repeatedly scan all nodes created so far
+	enabled = gc.isenabled()
+	gc.disable()
+	try:
+		yield
+	finally:
+		if enabled: gc.enable()
+
+def dumps(root) -> bytes:
+	""" serializes a tree (or DAG) of nodes into the binary kast format """
+	with _gc_paused():
+		return _Writer().write(root)
+
+def dump(root, fp):
+	fp.write(dumps(root))
+
+def loads(data):
+	""" inverse of `dumps`, node classes are imported by module and name """
+	data = memoryview(data)
+	if bytes(data[:4]) != _magic:
+		raise ValueError("not a serialized kast tree")
+	version, class_count = struct.unpack_from('<HI', data, 4)
+	if version != _version:
+		raise ValueError(f"unsupported kast format version {version}, expected {_version}")
+	pos = 10
+	classes = []
+	for _ in range(class_count):
+		name, pos = _read_str(data, pos)
+		fields, pos = _read_str(data, pos)
+		cls = _find_class(name)
+		if isinstance(cls, NodeMeta) and ",".join(cls._fields) != fields:
+			raise ValueError(f"fields of {name} changed: ({fields}) vs ({','.join(cls._fields)})")
+		classes.append(cls)
+	(constant_count,) = struct.unpack_from('<I', data, pos)
+	pos += 4
+	constants = []
+	for _ in range(constant_count):
+		tag = bytes(data[pos:pos+1])
+		pos += 1
+		if tag == b'n':
+			constants.append(None)
+		elif tag == b'b':
+			constants.append(bool(data[pos]))
+			pos += 1
+		elif tag == b'e':
+			(cls,) = struct.unpack_from('<I', data, pos)
+			name, pos = _read_str(data, pos + 4)
+			constants.append(classes[cls][name])
+		elif tag == b'i':
+			(size,) = struct.unpack_from('<I', data, pos)
+			constants.append(int.from_bytes(data[pos+4:pos+4+size], 'little', signed=True))
+			pos += 4 + size
+		elif tag == b's':
+			value, pos = _read_str(data, pos)
+			constants.append(value)
+		elif tag == b'f':
+			constants.append(struct.unpack_from('<d', data, pos)[0])
+			pos += 8
+		else:
+			raise ValueError(f"unknown constant tag {tag}")
+	(word_count,) = struct.unpack_from('<Q', data, pos)
+	pos += 8
+	words = array.array(_word)
+	words.frombytes(data[pos:pos + 4 * word_count])
+	if sys.byteorder != 'little':
+		words.byteswap()
+	with _gc_paused():
+		return _Reader(classes, constants, words).read()
+
+def load(fp):
+	return loads(fp.read())
+
+class _Reader:
+	def __init__(self, classes, constants, words):
+		self.classes = classes
+		self.constants = constants
+		self.words = words
+		self.nodes = []
+		self.pos = 0
+
+	def read(self):
+		words, nodes, constants, classes = self.words, self.nodes, self.constants, self.classes
+		field_counts = [len(cls._fields) if isinstance(cls, NodeMeta) else 0 for cls in classes]
+		end, pos = len(words) - 1 - words[-1], 0
+		while pos < end:
+			cls_id = words[pos]
+			pos += 1
+			values = []
+			for _ in range(field_counts[cls_id]):
+				ref = words[pos]
+				if ref >= 0:
+					values.append(constants[ref >> 1] if ref & 1 else nodes[ref >> 1])
+					pos += 1
+				else:
+					self.pos = pos
+					values.append(self.value())
+					pos = self.pos
+			nodes.append(classes[cls_id]._trusted(*values))
+		self.pos = pos
+		return self.value()
+
+	def value(self):
+		ref = self.words[self.pos]
+		self.pos += 1
+		if ref >= 0:
+			return self.constants[ref >> 1] if ref & 1 else self.nodes[ref >> 1]
+		elif ref == _none:
+			return None
+		count = self.words[self.pos]
+		self.pos += 1
+		values = [self.value() for _ in range(count)]
+		return values if ref == _list else tuple(values)
@@ -9,6 +9,63 @@
 
 import os
 
+class Snapshot:
+	""" State of a simulation: input and register values by name, the cycle count and the
+	    exit code of the stop statement that fired (None while running).
+	    Snapshots are plain data, they can be pickled and restored in another process. """
+	def __init__(self, inputs: dict, registers: dict, cycle: int, exit_code=None):
+		self.inputs = inputs
+		self.registers = registers
+		self.cycle = cycle
+		self.exit_code = exit_code
+
+	def __repr__(self):
+		return f"Snapshot(cycle={self.cycle}, exit_code={self.exit_code}, {len(self.registers)} registers)"
+
+class CommandError(Exception):
+	""" a command that failed, `lines` is the output it produced instead of its result """
+	def __init__(self, cmd: str, lines: list):
+		super().__init__(f"`{cmd}` failed: {' '.join(lines)}")
+		self.cmd = cmd
+		self.lines = lines
+
+def command_failed(lines: list, count: int) -> bool:
+	""" treadle reports errors instead of the expected output, starting with `Error` """
+	return len(lines) != count or any(line.startswith('Error') for line in lines)
+
+class Batch:
+	""" Queues peek, poke and step commands, `run` sends them all at once and returns one
+	    result per command: the value of a peek, None for poke and step, or the CommandError
+	    of a command that failed. Used as a context manager, the batch runs on exit and the
+	    results are in `results`. """
+	def __init__(self, sim):
+		self.sim = sim
+		self.commands = []
+		self.results = None
+
+	def peek(self, signal: str) -> int:
+		""" returns the index of the result """
+		self.commands.append(('peek', signal))
+		return len(self.commands) - 1
+
+	def poke(self, signal: str, value: int):
+		self.commands.append(('poke', signal, value))
+
+	def step(self, count=1):
+		self.commands.append(('step', count))
+
+	def run(self) -> list:
+		self.results = self.sim._run_batch(self.commands)
+		self.commands = []
+		return self.results
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		if exc_type is None:
+			self.run()
+
 class Simulator:
 	""" Interface to the Treadle Circuit Simulator """
 
@@ -22,12 +79,29 @@ class Simulator:
 		treadle = TreadleClient.start()
 		return Simulator(treadle)
 
+	@staticmethod
+	def start_compiled(out=None, incremental=False):
+		""" in-process simulator without treadle, see compiled_simulator.py,
+		    `incremental` only re-evaluates the logic downstream of changed signals """
+		from compiled_simulator import CompiledSimulator, IncrementalSimulator
+		return IncrementalSimulator(out=out) if incremental else CompiledSimulator(out=out)
+
 	def __init__(self, treadle):
 		self.treadle = treadle
+		self.ir = None
+		self.cycle = 0
+		# ground input and register names, only computed for snapshots
+		self._state_names = None
 
-	def load(self, ir: str):
+	def load(self, ir):
+		""" `ir` is either FIRRTL text or a firrtl.Circuit which is streamed to disk """
+		self.ir, self.cycle, self._state_names = ir, 0, None
 		with tempfile.NamedTemporaryFile(suffix='.fir',delete=False) as ff:
-			ff.write(ir.encode('UTF-8'))
+			if isinstance(ir, str):
+				ff.write(ir.encode('UTF-8'))
+			else:
+				import firrtl
+				firrtl.emit(ir, ff, share=True)
 			fir_file = ff.name
 		_compile, _load = self.treadle.execute(f"load {fir_file}", 2)
 		os.unlink(fir_file)
@@ -40,43 +114,361 @@ class Simulator:
 		self.treadle.execute(f"poke {signal} {value}")
 
 	def step(self, count=1):
+		# counted first, the step ran even if an earlier command failed
+		self.cycle += count
 		_ = self.treadle.execute(f"step {count}", 1)[0]
 
+	def peek_many(self, signals: list) -> list:
+		""" one round trip, the values are sent as binary integers by the framed protocol """
+		return self.treadle.peek_values(signals)
+
+	def poke_many(self, values: dict):
+		self.treadle.poke_values(values)
+
+	def trace(self, signals: list, cycles: int):
+		""" yields the values of `signals` in each cycle, stepping after each one """
+		try:
+			yield from self.treadle.trace(signals, cycles)
+		finally:
+			self.cycle += cycles
+
+	def batch(self) -> Batch:
+		return Batch(self)
+
+	def _run_batch(self, commands: list) -> list:
+		cmds = []
+		for command in commands:
+			if command[0] == 'peek':
+				cmds.append((f"peek {command[1]}", 1))
+			elif command[0] == 'poke':
+				cmds.append((f"poke {command[1]} {command[2]}", 0))
+			else:
+				cmds.append((f"step {command[1]}", 1))
+		results = []
+		for command, res in zip(commands, self.treadle.execute_batch(cmds)):
+			if isinstance(res, CommandError):
+				results.append(res)
+			elif command[0] == 'peek':
+				results.append(int(res[0].split(' ')[-1]))
+			else:
+				if command[0] == 'step':
+					self.cycle += command[1]
+				results.append(None)
+		return results
+
+	def _state(self) -> (list, list):
+		if self._state_names is None:
+			from compiled_simulator import compile_program
+			prog = compile_program(self.ir)
+			self._state_names = (list(prog.inputs), [reg[0] for reg in prog.registers])
+		return self._state_names
+
+	def snapshot(self) -> Snapshot:
+		""" reads every input and register, treadle does not report stops, so the
+		    exit code of the snapshot is always None """
+		inputs, registers = self._state()
+		return Snapshot({name: self.peek(name) for name in inputs},
+			{name: self.peek(name) for name in registers}, self.cycle)
+
+	def restore(self, snap: Snapshot):
+		for values in (snap.inputs, snap.registers):
+			for name, value in values.items():
+				self.poke(name, value)
+		self.cycle = snap.cycle
+
+	def fork(self):
+		""" a new simulator in the current state, this starts and loads another treadle process """
+		if not isinstance(self.treadle, TreadleWrapper):
+			raise NotImplementedError("all clients of a treadle server share one simulation")
+		treadle = self.treadle
+		sim = Simulator(TreadleWrapper(debug=False, cmd=treadle.cmd, cwd=treadle.cwd, engine=treadle.engine).start())
+		sim.load(self.ir)
+		sim._state_names = self._state_names
+		sim.restore(self.snapshot())
+		return sim
+
+	def cache_stats(self):
+		""" compile cache statistics of the backend as a dict, None if it does not cache """
+		line = self.treadle.execute("cache", 1)[0]
+		if not line.startswith("cache "):
+			return None
+		fields = line.split()[1:]
+		return {name: float(value) if '.' in value else int(value) for name, value in zip(fields[::2], fields[1::2])}
+
 	def stop(self):
 		self.treadle.stop()
 
 # server/client infrastructure to help with treadle's long startup times
-import socketserver, socket
+import socketserver, socket, struct, itertools
+from enum import IntEnum
+
+# Framed protocol: a client that sends `hello|<version>` as its first text line and gets
+# `frames|<version>` back switches to frames, any other first line is served with the text
+# protocol. A server that cannot take the session answers `error|<reason>` instead. A frame is the length of the body, a type byte and the body. EXECUTE, the common
+# case, is answered by one LINES frame, every other request by any number of LINES, ERROR
+# or VALUES frames followed by one END frame.
+protocol_version = 1
+
+class Frame(IntEnum):
+	# requests
+	EXECUTE = 1 # count, command
+	BATCH = 2   # [(count, command)]
+	PEEK = 3    # [name]
+	POKE = 4    # [(name, value)]
+	TRACE = 5   # cycles, [name]
+	# responses
+	LINES = 16  # [line]
+	ERROR = 17  # command, [line]
+	VALUES = 18 # [value]
+	END = 19
+
+frame_header = struct.Struct('>IB')
+_u16 = struct.Struct('>H')
+_u32 = struct.Struct('>I')
+# header, count and command length of an EXECUTE frame
+_execute = struct.Struct('>IBII')
+# large results are streamed in frames of at most this many values
+values_per_frame = 4096
+
+class FrameWriter:
+	""" builds the body of a frame, integers are big endian two's complement """
+	def __init__(self):
+		self.buf = bytearray()
+
+	def u32(self, value: int):
+		self.buf += _u32.pack(value)
+		return self
+
+	def str(self, text: str):
+		data = text.encode('UTF-8')
+		self.buf += _u32.pack(len(data))
+		self.buf += data
+		return self
+
+	def int(self, value: int):
+		size = (value.bit_length() + 8) // 8
+		self.buf += _u16.pack(size)
+		self.buf += value.to_bytes(size, 'big', signed=True)
+		return self
+
+	def strs(self, texts: list):
+		self.u32(len(texts))
+		for text in texts:
+			self.str(text)
+		return self
+
+	def ints(self, values: list):
+		self.u32(len(values))
+		for value in values:
+			self.int(value)
+		return self
+
+	def frame(self, kind: Frame) -> bytes:
+		return frame_header.pack(len(self.buf), kind) + self.buf
+
+class FrameReader:
+	def __init__(self, body: bytes):
+		self.body = body
+		self.pos = 0
+
+	def u32(self) -> int:
+		value, = _u32.unpack_from(self.body, self.pos)
+		self.pos += 4
+		return value
+
+	def str(self) -> str:
+		size = self.u32()
+		self.pos += size
+		return self.body[self.pos - size:self.pos].decode('UTF-8')
+
+	def int(self) -> int:
+		size, = _u16.unpack_from(self.body, self.pos)
+		self.pos += 2 + size
+		return int.from_bytes(self.body[self.pos - size:self.pos], 'big', signed=True)
+
+	def strs(self) -> list:
+		return [self.str() for _ in range(self.u32())]
+
+	def ints(self) -> list:
+		return [self.int() for _ in range(self.u32())]
+
+def read_frame(rfile) -> (Frame, FrameReader):
+	header = rfile.read(frame_header.size)
+	if len(header) < frame_header.size:
+		raise EOFError("connection closed")
+	size, kind = frame_header.unpack(header)
+	body = rfile.read(size)
+	if len(body) < size:
+		raise EOFError("connection closed")
+	return kind, FrameReader(body)
+
+_end = FrameWriter().frame(Frame.END)
+
+# peek, poke and trace in terms of `execute_batch`, for simulators without native support
+
+def peek_values(treadle, names: list) -> list:
+	results = treadle.execute_batch([(f"peek {name}", 1) for name in names])
+	for res in results:
+		if isinstance(res, CommandError):
+			raise res
+	return [int(res[0].split(' ')[-1]) for res in results]
+
+def poke_values(treadle, values: dict):
+	for res in treadle.execute_batch([(f"poke {name} {value}", 0) for name, value in values.items()]):
+		if isinstance(res, CommandError):
+			raise res
+
+def trace(treadle, names: list, cycles: int):
+	""" yields the values of `names` in each of the next `cycles` cycles, all cycles
+	    are simulated even if the caller stops early, like with the framed protocol """
+	cmds = [(f"peek {name}", 1) for name in names] + [("step 1", 1)]
+	for done in range(1, cycles + 1):
+		results = treadle.execute_batch(cmds)
+		for res in results:
+			if isinstance(res, CommandError):
+				raise res
+		try:
+			yield [int(res[0].split(' ')[-1]) for res in results[:-1]]
+		except GeneratorExit:
+			if done < cycles:
+				treadle.execute(f"step {cycles - done}", 1)
+			raise
 
 class TreadleClient:
+	""" Talks to a TreadleServer with the framed protocol or, if the server does
+	    not support it or `framed` is False, with the text protocol. """
 	@staticmethod
-	def start(host='127.0.0.1', port=4321):
+	def start(host='127.0.0.1', port=4321, framed=True):
 		sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+		sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
 		sock.connect((host, port))
-		return TreadleClient(sock)
+		return TreadleClient(sock, framed)
 
-	def __init__(self, sock):
+	def __init__(self, sock, framed=True):
 		self.sock = sock
+		self.rfile = sock.makefile('rb')
+		self.version = 0
+		if framed:
+			self.sock.sendall(f"hello|{protocol_version}\n".encode("UTF-8"))
+			resp = self.rfile.readline().decode("UTF-8")
+			if resp.startswith('error|'):
+				sock.close()
+				raise ConnectionRefusedError(resp[6:].strip())
+			if resp.startswith('frames|'):
+				self.version = int(resp[7:])
+
+	@property
+	def framed(self) -> bool:
+		return self.version > 0
+
+	def _request(self, kind: Frame, body: FrameWriter):
+		""" yields the response frames up to END """
+		self.sock.sendall(body.frame(kind))
+		while True:
+			kind, body = read_frame(self.rfile)
+			if kind == Frame.END:
+				return
+			yield kind, body
 
 	def execute(self, cmd: str, count=0):
-		msg = f"{cmd}|{count}\n".encode("UTF-8")
-		self.sock.sendall(msg)
-		resp = self.sock.recv(1024 * 64).decode("UTF-8").split('\n')[:-1]
-		if len(resp) == 1 and len(resp[0]) == 0:
-			resp = []
-		assert len(resp) == count, f"{resp}, {count}"
-		return resp
+		if self.version > 0:
+			data = cmd.encode('UTF-8')
+			self.sock.sendall(_execute.pack(len(data) + 8, Frame.EXECUTE, count, len(data)) + data)
+			kind, body = read_frame(self.rfile)
+			if kind == Frame.ERROR:
+				# an earlier command failed, the error is followed by END
+				read_frame(self.rfile)
+				raise CommandError(body.str(), body.strs())
+			resp = body.strs()
+			assert len(resp) == count, f"{resp}, {count}"
+			return resp
+		self.sock.sendall(f"{cmd}|{count}\n".encode("UTF-8"))
+		# the server answers with at least one line, an empty one for `count == 0`
+		resp = [self.rfile.readline().decode("UTF-8")[:-1] for _ in range(max(count, 1))]
+		if count == 0 and resp[0].startswith('Error'):
+			raise CommandError(cmd, resp)
+		return resp if count > 0 else []
+
+	def execute_batch(self, cmds: list) -> list:
+		""" sends all (command, count) pairs in one message, see TreadleWrapper.execute_batch """
+		if self.framed:
+			body = FrameWriter().u32(len(cmds))
+			for cmd, count in cmds:
+				body.u32(count).str(cmd)
+			results = []
+			for kind, body in self._request(Frame.BATCH, body):
+				if kind == Frame.ERROR:
+					results.append(CommandError(body.str(), body.strs()))
+				else:
+					results.append(body.strs())
+			return results
+		msg = f"batch|{len(cmds)}\n" + "".join(f"{cmd}|{count}\n" for cmd, count in cmds)
+		self.sock.sendall(msg.encode("UTF-8"))
+		results = []
+		for cmd, _ in cmds:
+			status, count = self.rfile.readline().decode("UTF-8")[:-1].split('|')
+			lines = [self.rfile.readline().decode("UTF-8")[:-1] for _ in range(int(count))]
+			results.append(lines if status == 'ok' else CommandError(cmd, lines))
+		return results
+
+	def _values(self, kind: Frame, body: FrameWriter):
+		""" yields the VALUES frames of a request, raises the first error after the END frame """
+		error = None
+		for kind, body in self._request(kind, body):
+			if kind == Frame.ERROR:
+				error = error or CommandError(body.str(), body.strs())
+			else:
+				yield body.ints()
+		if error is not None:
+			raise error
+
+	def peek_values(self, names: list) -> list:
+		if not self.framed:
+			return peek_values(self, names)
+		values = []
+		for part in self._values(Frame.PEEK, FrameWriter().strs(names)):
+			values += part
+		return values
+
+	def poke_values(self, values: dict):
+		if not self.framed:
+			return poke_values(self, values)
+		body = FrameWriter().u32(len(values))
+		for name, value in values.items():
+			body.str(name).int(value)
+		for _ in self._values(Frame.POKE, body):
+			pass
+
+	def trace(self, names: list, cycles: int):
+		""" yields the values of `names` in each of the next `cycles` cycles, the server
+		    streams one frame per cycle """
+		if not self.framed:
+			yield from trace(self, names, cycles)
+			return
+		frames = self._values(Frame.TRACE, FrameWriter().u32(cycles).strs(names))
+		try:
+			# not `yield from`, which would close `frames` when the caller stops
+			for values in frames:
+				yield values
+		finally:
+			# the rest of the stream has to be read even if the caller stops early
+			for _ in frames:
+				pass
 
 	def stop(self):
+		self.rfile.close()
 		self.sock.close()
 
 
 class TreadleServer(socketserver.TCPServer):
 	@staticmethod
-	def run(host='127.0.0.1', port=4321):
-		print("Starting treadle...")
-		treadle = TreadleWrapper(debug=True).start()
-		print("Started treadle...")
+	def run(host='127.0.0.1', port=4321, treadle=None):
+		""" `treadle` is anything with the `execute`, `execute_batch`, `peek_values`,
+		    `poke_values` and `trace` methods of TreadleWrapper """
+		if treadle is None:
+			print("Starting treadle...")
+			treadle = TreadleWrapper(debug=True).start()
+			print("Started treadle...")
 		with TreadleServer(host=host, port=port, treadle=treadle) as server:
 			server.serve_forever()
 	def __init__(self, host, port, treadle):
@@ -85,45 +477,147 @@ class TreadleServer(socketserver.TCPServer):
 
 
 class TreadleHandler(socketserver.StreamRequestHandler):
+	# responses are streamed in several writes, which must not wait for acks
+	disable_nagle_algorithm = True
+
 	def handle(self):
 		addr = self.client_address[0]
 		print(f"Connected to: {addr}")
 		try:
-			for line in self.rfile:
-				cmd, count = line.decode('UTF-8').split('|')
-				ret = self.server.treadle.execute(cmd, count=int(count))
-				resp = '\n'.join(ret) + '\n'
-				self.wfile.write(resp.encode('UTF-8'))
-		except ConnectionResetError:
+			first = self.rfile.readline()
+			if first.startswith(b'hello|'):
+				version = min(int(first[6:]), protocol_version)
+				self.wfile.write(f"frames|{version}\n".encode('UTF-8'))
+				self.handle_frames()
+			else:
+				self.handle_text(itertools.chain([first], self.rfile))
+		except (ConnectionResetError, BrokenPipeError, EOFError):
 			print(f"Disconnected: {addr}")
 
+	def handle_text(self, lines):
+		for line in lines:
+			if len(line) == 0:
+				return
+			cmd, count = line.decode('UTF-8').split('|')
+			if cmd == 'batch':
+				cmds = [parse_text_command(self.rfile.readline()) for _ in range(int(count))]
+				self.wfile.write(text_batch_response(self.server.treadle, cmds))
+			else:
+				self.wfile.write(text_response(self.server.treadle, cmd, int(count)))
+
+	def handle_frames(self):
+		while True:
+			kind, body = read_frame(self.rfile)
+			for data in frame_responses(self.server.treadle, kind, body):
+				self.wfile.write(data)
+
+# server side of both protocols, independent of how the connection is served
+
+def parse_text_command(line: bytes) -> (str, int):
+	cmd, count = line.decode('UTF-8').split('|')
+	return cmd, int(count)
+
+def text_response(treadle, cmd: str, count: int) -> bytes:
+	try:
+		lines = treadle.execute(cmd, count=count)
+	except CommandError as ee:
+		# the text protocol reports errors in place of the expected lines
+		lines = (ee.lines + [''] * count)[:max(count, 1)]
+	return ('\n'.join(lines) + '\n').encode('UTF-8')
+
+def text_batch_response(treadle, cmds: list) -> bytes:
+	""" answers each command with `ok|<lines>` or `error|<lines>` followed by its output """
+	resp = []
+	for res in treadle.execute_batch(cmds):
+		lines = res.lines if isinstance(res, CommandError) else res
+		resp.append(f"{'error' if isinstance(res, CommandError) else 'ok'}|{len(lines)}")
+		resp += lines
+	return ('\n'.join(resp) + '\n').encode('UTF-8')
+
+def frame_responses(treadle, kind: Frame, body: FrameReader):
+	""" yields the response to a request frame in pieces that can be sent right away """
+	try:
+		if kind == Frame.EXECUTE:
+			count = body.u32()
+			yield FrameWriter().strs(treadle.execute(body.str(), count)).frame(Frame.LINES)
+		elif kind == Frame.BATCH:
+			cmds = []
+			for _ in range(body.u32()):
+				count = body.u32()
+				cmds.append((body.str(), count))
+			yield b"".join(_result_frame(res) for res in treadle.execute_batch(cmds)) + _end
+		elif kind == Frame.PEEK:
+			values = treadle.peek_values(body.strs())
+			frames = [FrameWriter().ints(values[ii:ii + values_per_frame]).frame(Frame.VALUES)
+				for ii in range(0, len(values), values_per_frame)]
+			yield from frames[:-1]
+			yield b"".join(frames[-1:]) + _end
+		elif kind == Frame.POKE:
+			treadle.poke_values({body.str(): body.int() for _ in range(body.u32())})
+			yield _end
+		elif kind == Frame.TRACE:
+			cycles = body.u32()
+			for values in treadle.trace(body.strs(), cycles):
+				yield FrameWriter().ints(values).frame(Frame.VALUES)
+			yield _end
+		else:
+			raise CommandError(f"frame {kind}", ["Error: unknown frame type"])
+	except CommandError as ee:
+		yield _result_frame(ee) + _end
+	except (struct.error, UnicodeDecodeError):
+		# the body is read before the simulator is used, a short or garbled one changes nothing
+		yield _result_frame(CommandError(f"frame {kind}", ["Error: malformed frame"])) + _end
+
+def _result_frame(res) -> bytes:
+	if isinstance(res, CommandError):
+		return FrameWriter().str(res.cmd).strs(res.lines).frame(Frame.ERROR)
+	return FrameWriter().strs(res).frame(Frame.LINES)
+
 
 # Treadle subprocess wrapper, similar to code used in a previous project in order to run
 # a SMT solver as a subprocess
 
-import threading, queue, subprocess, tempfile, time
+import threading, queue, subprocess, tempfile, time, contextlib, signal, selectors, collections
 
 treadle_path = os.path.join('/home', 'kevin', 'd', 'treadle')
 treadle_bin = os.path.join(treadle_path, 'treadle.sh')
+# commands whose echo the select engine of TreadleWrapper has not read yet
+max_pending_echoes = 1024
 
 
 class TreadleWrapper:
-	def __init__(self, debug=False):
+	""" `cmd` is a shell command that starts a REPL other than treadle, e.g. treadle_repl.py.
+	    With `engine` 'thread' every output line goes through a SubprocessOutputThread and
+	    each command waits for its echo, with 'select' the output is read without a thread
+	    by a SubprocessOutputReader and the echoes are only skipped before the next read. """
+	def __init__(self, debug=False, cmd=None, cwd=None, engine='thread'):
 		self.is_running = False
 		self._proc = None
 		self._output = None
+		self.engine = engine
+		# commands whose echo was not read yet, the command whose output is read next and
+		# the first failure in output that nobody asked for
+		self._sent = collections.deque()
+		self._last = None
+		self._error = None
 		self.debug_print = print if debug else lambda x: None
+		self.cmd = treadle_bin if cmd is None else cmd
+		self.cwd = treadle_path if cmd is None else cwd
 
 	def start(self):
 		if self.is_running: return
-		cmd = [treadle_bin]
-		cwd = treadle_path
-		self._proc = subprocess.Popen(cmd, cwd=cwd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
-		self._output = SubprocessOutputThread.create(self._proc.stdout)
+		# own process group, so that `kill` also reaches the REPL behind the shell
+		self._proc = subprocess.Popen(self.cmd, cwd=self.cwd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+			start_new_session=True)
+		if self.engine == 'select':
+			self._output = SubprocessOutputReader(self._proc.stdout, self._proc.stdin)
+		else:
+			self._output = SubprocessOutputThread.create(self._proc.stdout)
+		self._sent, self._last, self._error = collections.deque(), None, None
 		if self._proc.poll() is None:
 			self.is_running = True
 		else:
-			raise Exception(f"Failed to start subprocess {self.bin} {self.args}!")
+			raise Exception(f"Failed to start subprocess {self.cmd}!")
 		# wait for repl to load
 		line = self._output.read_blocking()
 		while not 'Running treadle.TreadleRepl' in line:
@@ -134,31 +628,128 @@ class TreadleWrapper:
 		if not self.is_running:
 			return
 		self.send_cmd('quit')
+		try:
+			self._skip_echoes()
+		except EOFError:
+			pass
 		time.sleep(0.00001)
 		self._proc.terminate()
 		time.sleep(0.0001)
 		if self._proc.poll() is not None:
 			self._proc.kill()
+		if isinstance(self._output, SubprocessOutputReader):
+			self._output.close()
+		self._close()
+
+	def _close(self):
 		self.is_running = False
 		self._proc = None
 		self._output = None
 
+	def alive(self) -> bool:
+		return self.is_running and self._proc.poll() is None
+
+	def ping(self, timeout: float) -> bool:
+		""" whether the REPL answers an empty command within `timeout` seconds """
+		try:
+			self._write(b'\n')
+			self._sent.append('')
+			self._skip_echoes(timeout)
+			return True
+		except (queue.Empty, OSError, EOFError):
+			return False
+
+	def kill(self):
+		""" stops a process that may not respond to `quit` anymore """
+		if self.is_running:
+			try:
+				os.killpg(self._proc.pid, signal.SIGKILL)
+			except ProcessLookupError:
+				pass
+			self._proc.wait()
+		# not closing the output, another thread may still wait for it and gets an EOFError
+		self._close()
+
 	def execute(self, cmd: str, count=0):
+		""" returns the `count` output lines of `cmd`, raises the CommandError of an earlier
+		    command that failed without anyone reading its output """
 		self.send_cmd(cmd=cmd)
-		if count > 0:
-			return self.read_blocking(count=count)
-		return []
+		lines = self.read_blocking(count=count) if count > 0 else []
+		self._raise_error()
+		return lines
 
 	def send_cmd(self, cmd: str):
 		assert self.is_running
 		self.debug_print("<- " + cmd)
-		cmd_str = cmd + '\n'
-		self._proc.stdin.write(cmd_str.encode('UTF-8'))
-		self._proc.stdin.flush()
-		# echo
-		assert self._output.read_blocking().startswith('treadle>>')
+		self._write((cmd + '\n').encode('UTF-8'))
+		self._sent.append(cmd)
+		# the select engine skips the echo with the next read, but not too many are kept
+		if self.engine != 'select' or len(self._sent) > max_pending_echoes:
+			self._skip_echoes()
+
+	def _write(self, data: bytes):
+		if self.engine == 'select':
+			self._output.write(data)
+		else:
+			self._proc.stdin.write(data)
+			self._proc.stdin.flush()
+
+	def _skip_echoes(self, timeout=None):
+		""" reads up to the echo of the last command that was sent, the output of commands
+		    before it is not expected by anyone, the first error in it is kept for `_raise_error` """
+		while len(self._sent) > 0:
+			line = self._output.read_blocking(timeout=timeout)
+			if line.startswith('treadle>>'):
+				self._last = self._sent.popleft()
+			elif line.startswith('Error') and self._last is not None and self._error is None:
+				self._error = CommandError(self._last, [line])
+
+	def _raise_error(self):
+		error, self._error = self._error, None
+		if error is not None:
+			raise error
+
+	def detach(self):
+		""" drops the failures of all commands sent so far, before another client takes over """
+		self._sent = collections.deque(None for _ in self._sent)
+		self._last, self._error = None, None
+
+	def execute_batch(self, cmds: list) -> list:
+		""" Writes all (command, expected line count) pairs at once and returns the output
+		    lines of each command, or a CommandError if it failed (see `command_failed`).
+		    The output of a command ends at the echo of the next one, an empty command at the
+		    end delimits the last output, so one failure does not shift the other results.
+		    The CommandError of an earlier command is raised after the batch ran. """
+		assert self.is_running
+		self.debug_print("<- " + "\n   ".join(cmd for cmd, _ in cmds))
+		text = "".join(cmd + '\n' for cmd, _ in cmds) + '\n'
+		self._write(text.encode('UTF-8'))
+		self._sent.append(cmds[0][0] if len(cmds) > 0 else '')
+		self._skip_echoes()
+		results = []
+		for cmd, count in cmds:
+			lines = []
+			line = self._output.read_blocking()
+			while not line.startswith('treadle>>'):
+				lines.append(line)
+				line = self._output.read_blocking()
+			results.append(CommandError(cmd, lines) if command_failed(lines, count) else lines)
+		# the output after the echo of the empty command
+		self._last = ''
+		self._raise_error()
+		return results
+
+	def peek_values(self, names: list) -> list:
+		return peek_values(self, names)
+
+	def poke_values(self, values: dict):
+		poke_values(self, values)
+
+	def trace(self, names: list, cycles: int):
+		return trace(self, names, cycles)
 
 	def read_blocking(self, count=1, timeout=None):
+		self._skip_echoes(timeout)
 		resp = []
 		for _ in range(count):
 			resp.append(self._output.read_blocking(timeout=timeout))
@@ -180,6 +771,8 @@ class SubprocessOutputThread(threading.Thread):
 	def run(self):
 		self._read_line_loop()
 		self.inp.close()
+		# wakes up readers that would otherwise wait forever for a process that is gone
+		self.fifo.put(EOFError("the process closed its output"))
 	def _read_line_loop(self):
 		for line in iter(self.inp.readline, b''):
 			#print(line[:-1].decode('UTF-8'))
@@ -187,6 +780,7 @@ class SubprocessOutputThread(threading.Thread):
 	def read_blocking(self, timeout=None):
 		line = self.fifo.get(block=True, timeout=timeout)
 		if isinstance(line, Exception):
+			self.fifo.put(line)
 			raise line
 		return line
 	def get_lines(self):
@@ -196,6 +790,7 @@ class SubprocessOutputThread(threading.Thread):
 			try:
 				line = self.fifo.get(block=False)
 				if isinstance(line, Exception):
+					self.fifo.put(line)
 					raise line
 				lines.append(line)
 			except queue.Empty:
@@ -208,5 +803,237 @@ class SubprocessOutputThread(threading.Thread):
 		except queue.Empty:
 			return
 
+class SubprocessOutputReader:
+	""" Reads lines from the stdout pipe of a process without a thread: when no complete
+	    line is buffered, everything the pipe holds is read in chunks of `chunk_size` into a
+	    reused buffer and split into lines. `write` sends to stdin and keeps reading while
+	    the pipe to the process is full, so a long command list cannot deadlock both pipes.
+	    A `timeout` raises TimeoutError, EOFError is raised after the process closed stdout. """
+	chunk_size = 1 << 16
+
+	def __init__(self, input_stream, output_stream):
+		self.inp, self.out = input_stream, output_stream
+		self._rfd, self._wfd = input_stream.fileno(), output_stream.fileno()
+		output_stream.flush()
+		os.set_blocking(self._rfd, False)
+		os.set_blocking(self._wfd, False)
+		self._readable = selectors.DefaultSelector()
+		self._readable.register(self._rfd, selectors.EVENT_READ)
+		self._writable = selectors.DefaultSelector()
+		self._writable.register(self._rfd, selectors.EVENT_READ)
+		self._writable.register(self._wfd, selectors.EVENT_WRITE)
+		self._chunk = bytearray(self.chunk_size)
+		# an incomplete last line
+		self._partial = bytearray()
+		self._lines = collections.deque()
+		self._eof = False
+
+	def _read(self):
+		""" reads what the pipe holds without blocking """
+		while not self._eof:
+			try:
+				count = os.readv(self._rfd, [self._chunk])
+			except BlockingIOError:
+				return
+			if count == 0:
+				self._eof = True
+				if len(self._partial) > 0:
+					self._lines.append(self._partial.decode('UTF-8'))
+					self._partial.clear()
+				return
+			data = memoryview(self._chunk)[:count]
+			end = self._chunk.rfind(b'\n', 0, count)
+			if end < 0:
+				self._partial += data
+			else:
+				self._partial += data[:end]
+				self._lines.extend(self._partial.decode('UTF-8').split('\n'))
+				self._partial[:] = data[end + 1:]
+			if count < self.chunk_size:
+				return
+
+	def read_blocking(self, timeout=None):
+		lines = self._lines
+		if len(lines) == 0:
+			self._read()
+		deadline = None if timeout is None else time.monotonic() + timeout
+		while len(lines) == 0:
+			if self._eof:
+				raise EOFError("the process closed its output")
+			remaining = None if deadline is None else deadline - time.monotonic()
+			if remaining is not None and remaining <= 0:
+				raise TimeoutError(f"no output within {timeout} s")
+			if len(self._readable.select(remaining)) > 0:
+				self._read()
+		return lines.popleft()
+
+	def get_lines(self):
+		self._read()
+		lines = list(self._lines)
+		self._lines.clear()
+		return lines
+
+	def clear(self):
+		self.get_lines()
+
+	def write(self, data: bytes):
+		view = memoryview(data)
+		while True:
+			try:
+				view = view[os.write(self._wfd, view):]
+			except BlockingIOError:
+				pass
+			if len(view) == 0:
+				return
+			for key, _ in self._writable.select():
+				if key.fd == self._rfd:
+					self._read()
+
+	def close(self):
+		self._readable.close()
+		self._writable.close()
+		self.inp.close()
+
+class TreadlePool:
+	""" Keeps `size` simulator processes, one per core by default, started in the background,
+	    so that `checkout` hands out a ready Simulator instead of waiting for the JVM.
+	    Returned processes are checked in the background: one that died or does not answer
+	    a ping within `ping_timeout` seconds is replaced, the others load the circuit of the
+	    last session again, so that a later checkout of the same circuit starts from a fresh
+	    state without a load. A process that fails to start is tried again `start_retries`
+	    times with growing delays, once no process is left `checkout` raises. """
+	def __init__(self, size=None, factory=None, ping_timeout=5.0, start_retries=3):
+		self.size = os.cpu_count() if size is None else size
+		self.factory = (lambda: TreadleWrapper(debug=False).start()) if factory is None else factory
+		self.ping_timeout = ping_timeout
+		self.start_retries = start_retries
+		# (process, circuit that is loaded and reset or None)
+		self._ready = []
+		self._cond = threading.Condition()
+		self._closed = False
+		self._threads = []
+		# processes that are running or being started, and why the last start failed
+		self._live = self.size
+		self._start_error = None
+		self.stats = {'checkouts': 0, 'waited': 0, 'warm': 0, 'replaced': 0, 'failed': 0}
+		for _ in range(self.size):
+			self._background(self._spawn)
+
+	def _background(self, fun, *args):
+		thread = threading.Thread(target=fun, args=args, daemon=True)
+		with self._cond:
+			self._threads = [tt for tt in self._threads if tt.is_alive()] + [thread]
+		thread.start()
+
+	def _spawn(self):
+		for attempt in range(self.start_retries + 1):
+			try:
+				backend = self.factory()
+			except Exception as ee:
+				with self._cond:
+					self.stats['failed'] += 1
+					self._start_error = ee
+					if attempt < self.start_retries and not self._closed:
+						self._cond.wait(0.1 * 2 ** attempt)
+					if self._closed:
+						return
+				continue
+			self._add(backend, None)
+			return
+		with self._cond:
+			self._live -= 1
+			# wakes up the checkouts that wait for a process that will never come
+			self._cond.notify_all()
+
+	def _add(self, backend, ir):
+		with self._cond:
+			if not self._closed:
+				self._ready.append((backend, ir))
+				self._cond.notify()
+				return
+		backend.stop()
+
+	def _replace(self, backend):
+		with self._cond:
+			self.stats['replaced'] += 1
+		backend.kill()
+		self._spawn()
+
+	def _recycle(self, backend, ir):
+		backend.detach()
+		if not (backend.alive() and backend.ping(self.ping_timeout)):
+			self._replace(backend)
+			return
+		if ir is not None:
+			try:
+				Simulator(backend).load(ir)
+			except Exception:
+				self._replace(backend)
+				return
+		self._add(backend, ir)
+
+	def _take(self, ir, timeout):
+		deadline = None if timeout is None else time.monotonic() + timeout
+		with self._cond:
+			self.stats['checkouts'] += 1
+			if len(self._ready) == 0:
+				self.stats['waited'] += 1
+			while True:
+				if self._closed:
+					raise RuntimeError("the pool is closed")
+				if len(self._ready) > 0:
+					same = [ii for ii, (_, loaded) in enumerate(self._ready) if _same_ir(loaded, ir)]
+					backend, loaded = self._ready.pop(same[0] if len(same) > 0 else 0)
+					if backend.alive():
+						return backend, loaded
+					self.stats['replaced'] += 1
+					self._background(self._spawn)
+					continue
+				if self._live == 0:
+					raise RuntimeError(f"no simulator process could be started: {self._start_error!r}")
+				remaining = None if deadline is None else deadline - time.monotonic()
+				if remaining is not None and remaining <= 0:
+					raise TimeoutError(f"no simulator became available within {timeout}s")
+				self._cond.wait(remaining)
+
+	@contextlib.contextmanager
+	def checkout(self, ir=None, timeout=None):
+		""" yields a Simulator with `ir` loaded, if given, the process goes back to the pool
+		    when the block ends """
+		backend, loaded = self._take(ir, timeout)
+		sim = Simulator(backend)
+		try:
+			if ir is not None:
+				if _same_ir(loaded, ir):
+					sim.ir = ir
+					with self._cond:
+						self.stats['warm'] += 1
+				else:
+					sim.load(ir)
+			yield sim
+		finally:
+			self._background(self._recycle, backend, sim.ir)
+
+	def close(self):
+		""" stops all processes, including those that are being started or checked """
+		with self._cond:
+			self._closed = True
+			ready, self._ready = self._ready, []
+			self._cond.notify_all()
+		for backend, _ in ready:
+			backend.stop()
+		for thread in list(self._threads):
+			thread.join()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, exc_type, exc_value, traceback):
+		self.close()
+
+def _same_ir(a, b) -> bool:
+	""" circuits are compared by identity, FIRRTL text by value """
+	return a is not None and (a is b or (isinstance(a, str) and a == b))
+
 if __name__ == '__main__':
 	TreadleServer.run()
\ No newline at end of file
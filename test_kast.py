@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2018, University of California, Berkeley
+# author: Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+# round trips of the binary kast format and hash consing, run with `python3 -m unittest test_kast`
+
+import struct, unittest
+from typing import List, Optional, Tuple
+import kast, firrtl
+from firrtl import Ref, BinOp, Bop, Literal, UInt, SInt
+
+class Pair(kast.Node):
+	""" node with tuple and list fields that firrtl does not have """
+	pair = Tuple[firrtl.Expr, int]
+	items = List[firrtl.Expr]
+	label = Optional[str]
+
+class Tagged(kast.Node):
+	""" tuple field without a list field, so it is hash consed """
+	pair = Tuple[firrtl.Expr, int]
+
+def round_trip(root):
+	data = kast.dumps(root)
+	loaded = kast.loads(data)
+	# the format is canonical, loading and dumping again yields the same bytes
+	assert kast.dumps(loaded) == data
+	return loaded
+
+class TestSerialization(unittest.TestCase):
+	def test_gcd(self):
+		import gaa
+		from gcd import Gcd
+		circuit = gaa.elaborate(Gcd(gaa.UInt(32)))
+		loaded = round_trip(circuit)
+		self.assertEqual(firrtl.ToString().visit(loaded), firrtl.ToString().visit(circuit))
+
+	def test_shared_subtrees(self):
+		with kast.HashConsing():
+			a = BinOp(op=Bop.Add, e1=Ref("a"), e2=Ref("b"))
+			b = BinOp(op=Bop.Add, e1=Ref("a"), e2=Ref("b"))
+			root = BinOp(op=Bop.Mul, e1=a, e2=b)
+		self.assertIs(root.e1, root.e2)
+		loaded = round_trip(root)
+		self.assertIs(loaded.e1, loaded.e2)
+		self.assertIs(loaded.e1.e1, loaded.e2.e1)
+
+	def test_enums_and_constants(self):
+		lit = Literal(value=-(1 << 100), typ=SInt(102))
+		loaded = round_trip(BinOp(op=Bop.Xor, e1=lit, e2=Literal(value=3, typ=UInt(2))))
+		self.assertIs(loaded.op, Bop.Xor)
+		self.assertEqual(loaded.e1.value, -(1 << 100))
+		self.assertEqual(loaded.e1.typ.n, 102)
+
+	def test_tuples_and_empty_lists(self):
+		a = Ref("a")
+		loaded = round_trip(Pair(pair=(a, 7), items=[], label=None))
+		self.assertEqual(loaded.items, [])
+		self.assertIsNone(loaded.label)
+		self.assertIsInstance(loaded.pair, tuple)
+		self.assertEqual((loaded.pair[0].name, loaded.pair[1]), ("a", 7))
+		loaded = round_trip(Pair(pair=(a, 0), items=[a, a], label="x"))
+		self.assertIs(loaded.items[0], loaded.items[1])
+		self.assertIs(loaded.items[0], loaded.pair[0])
+
+	def test_sequence_roots(self):
+		a = Ref("a")
+		loaded = round_trip((a, [a, None], []))
+		self.assertIsInstance(loaded, tuple)
+		self.assertIs(loaded[0], loaded[1][0])
+		self.assertEqual(loaded[1][1:], [None])
+		self.assertEqual(loaded[2], [])
+		self.assertEqual(round_trip([]), [])
+
+	def test_version_mismatch(self):
+		data = bytearray(kast.dumps(Ref("a")))
+		struct.pack_into('<H', data, 4, kast._version + 1)
+		with self.assertRaisesRegex(ValueError, "version"):
+			kast.loads(bytes(data))
+
+	def test_only_node_classes_are_loaded(self):
+		data = kast.dumps(Ref("a")).replace(b"firrtl:Ref", b"os:system")
+		with self.assertRaisesRegex(ValueError, "neither a node class nor an enum"):
+			kast.loads(data)
+
+	def test_modules_are_not_imported(self):
+		import sys
+		# `this` prints the zen of python when it is imported, the name has the same length
+		self.assertNotIn("this", sys.modules)
+		data = kast.dumps(Ref("a")).replace(b"firrtl:Ref", b"this:s_xyz")
+		with self.assertRaisesRegex(ValueError, "not in an imported module"):
+			kast.loads(data)
+		self.assertNotIn("this", sys.modules)
+
+class TestHashConsing(unittest.TestCase):
+	def test_equal_scalars_of_other_types_are_not_shared(self):
+		with kast.HashConsing():
+			one, true = Literal(value=1, typ=UInt(1)), Literal(value=True, typ=UInt(1))
+			self.assertIs(Literal(value=1, typ=UInt(1)), one)
+		self.assertIsNot(one, true)
+		self.assertIs(type(true.value), bool)
+
+	def test_tuple_fields(self):
+		a = Ref("a")
+		with kast.HashConsing():
+			self.assertIs(Tagged(pair=(a, 1)), Tagged(pair=(a, 1)))
+			self.assertIsNot(Tagged(pair=(a, 1)), Tagged(pair=(a, True)))
+
+if __name__ == '__main__':
+	unittest.main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2018, University of California, Berkeley
+# author: Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+# stand-in for the treadle REPL that is backed by the compiled simulator, it answers
+# load/peek/poke/step in the format that simulator.py expects, so the client/server
+# infrastructure can be tested and benchmarked without a JVM
+# usage: python3 treadle_repl.py [--cache N]            (reads commands from stdin, like treadle.sh)
+#        python3 treadle_repl.py server PORT [--cache N] (simulator.TreadleServer on PORT)
+#        --cache N keeps up to N compiled circuits, default 32
+
+import os, sys
+from compiled_simulator import CompiledSimulator, CompileCache
+from simulator import CommandError, command_failed
+
+class CompiledRepl:
+	""" has the `execute` and `execute_batch` methods of simulator.TreadleWrapper,
+	    errors are reported as a single `Error: ...` line like in treadle. Compiled circuits
+	    are kept in an LRU of `cache_size` circuits, `cache` prints its statistics. """
+	def __init__(self, cache_size=32):
+		self.sim = None
+		self.cache = CompileCache(cache_size)
+		self._sim = CompiledSimulator(out=open(os.devnull, 'w'), cache=self.cache)
+
+	def respond(self, cmd: str) -> list:
+		""" output lines of one command """
+		args = cmd.split()
+		if len(args) == 0:
+			return []
+		try:
+			if args[0] == 'load':
+				with open(args[1]) as ff:
+					ir = ff.read()
+				self.sim = None
+				self._sim.load(ir)
+				self.sim = self._sim
+				return [f"compiled {self.sim.prog.name}", f"loaded {args[1]}"]
+			if args[0] == 'cache':
+				stats = " ".join(f"{name} {value}" for name, value in self.cache.stats.items())
+				return [f"cache entries {len(self.cache)} {stats}"]
+			if self.sim is None:
+				return ["Error: no circuit loaded"]
+			if args[0] == 'peek':
+				return [f"peek {args[1]} {self.sim.peek(args[1])}"]
+			if args[0] == 'poke':
+				self._poke(args[1], int(args[2]))
+				return []
+			if args[0] == 'step':
+				self.sim.step(int(args[1]) if len(args) > 1 else 1)
+				return [f"step {args[1] if len(args) > 1 else 1} cycle {self.sim.cycle}"]
+			return [f"Error: unknown command `{args[0]}`"]
+		except (KeyError, ValueError, IndexError, OSError) as ee:
+			return [f"Error: {type(ee).__name__} {ee}"]
+
+	def _poke(self, name: str, value: int):
+		""" like treadle, registers can be poked too """
+		if name in self.sim.inputs:
+			self.sim.poke(name, value)
+		else:
+			snap = self.sim.snapshot()
+			if name not in snap.registers:
+				raise KeyError(name)
+			snap.registers[name] = value
+			self.sim.restore(snap)
+
+	def execute(self, cmd: str, count=0):
+		lines = self.respond(cmd)
+		# like TreadleWrapper, a command without expected output raises its failure
+		if count == 0 and command_failed(lines, 0):
+			raise CommandError(cmd, lines)
+		return lines
+
+	def alive(self) -> bool:
+		return True
+
+	def detach(self):
+		""" failures are raised right away, none are left for the next client """
+
+	def execute_batch(self, cmds: list) -> list:
+		results = []
+		for cmd, count in cmds:
+			lines = self.respond(cmd)
+			results.append(CommandError(cmd, lines) if command_failed(lines, count) else lines)
+		return results
+
+	def _loaded(self, cmd: str):
+		if self.sim is None:
+			raise CommandError(cmd, ["Error: no circuit loaded"])
+		return self.sim
+
+	def peek_values(self, names: list) -> list:
+		sim = self._loaded("peek")
+		try:
+			return [sim.peek(name) for name in names]
+		except KeyError as ee:
+			raise CommandError(f"peek {ee.args[0]}", [f"Error: KeyError {ee}"])
+
+	def poke_values(self, values: dict):
+		sim = self._loaded("poke")
+		for name, value in values.items():
+			try:
+				self._poke(name, value)
+			except KeyError as ee:
+				raise CommandError(f"poke {name} {value}", [f"Error: KeyError {ee}"])
+
+	def trace(self, names: list, cycles: int):
+		sim = self._loaded("trace")
+		for _ in range(cycles):
+			values = self.peek_values(names)
+			sim.step()
+			yield values
+
+def main(repl):
+	out = sys.stdout
+	out.write("Running treadle.TreadleRepl (compiled stand-in)\n")
+	out.flush()
+	for line in sys.stdin:
+		cmd = line.rstrip('\n')
+		lines = [] if cmd == 'quit' else repl.respond(cmd)
+		out.write("".join([f"treadle>> {cmd}\n"] + [ll + '\n' for ll in lines]))
+		out.flush()
+		if cmd == 'quit':
+			break
+
+if __name__ == '__main__':
+	args = sys.argv[1:]
+	repl = CompiledRepl()
+	if '--cache' in args:
+		ii = args.index('--cache')
+		repl = CompiledRepl(cache_size=int(args[ii + 1]))
+		del args[ii:ii + 2]
+	if args[:1] == ['server']:
+		from simulator import TreadleServer
+		TreadleServer.run(port=int(args[1]), treadle=repl)
+	else:
+		main(repl)
@@ -0,0 +1,305 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright 2018, University of California, Berkeley
+# author: Kevin Laeufer <laeufer@cs.berkeley.edu>
+
+# asyncio server that gives every connection its own simulator process
+# usage: python3 treadle_server.py [port] [processes] [--compiled]
+#        --compiled runs treadle_repl.py instead of treadle
+
+import asyncio, collections, contextlib, sys
+from concurrent.futures import ThreadPoolExecutor
+from simulator import TreadleWrapper, CommandError, FrameReader, protocol_version
+from simulator import parse_text_command, text_response, text_batch_response, frame_responses, frame_header
+
+class CommandTimeout(Exception):
+	pass
+
+class ProtocolError(Exception):
+	""" client input that does not follow the protocol, its session ends but the process is fine """
+	pass
+
+def _parse_hello(line: bytes) -> int:
+	try:
+		version = int(line[6:])
+	except ValueError:
+		raise ProtocolError(f"malformed hello {line[:80]!r}")
+	if version < 1:
+		raise ProtocolError(f"unsupported protocol version {version}")
+	return version
+
+def _parse_command(line: bytes) -> (str, int):
+	try:
+		cmd, count = parse_text_command(line)
+	except ValueError:
+		raise ProtocolError(f"malformed command {line[:80]!r}")
+	if count < 0:
+		raise ProtocolError(f"negative line count in {line[:80]!r}")
+	return cmd, count
+
+class Session:
+	""" The simulator of one connection. Commands fail until the session loaded a circuit,
+	    so it never sees the state that a previous session left in the process. """
+	def __init__(self, backend):
+		self.backend = backend
+		self.loaded = False
+
+	def _check(self, cmd: str):
+		if not self.loaded:
+			raise CommandError(cmd, ["Error: no circuit loaded"])
+
+	def execute(self, cmd: str, count=0):
+		if cmd.startswith('load '):
+			res = self.backend.execute(cmd, count)
+			self.loaded = True
+			return res
+		self._check(cmd)
+		return self.backend.execute(cmd, count)
+
+	def execute_batch(self, cmds: list) -> list:
+		if not self.loaded:
+			return [CommandError(cmd, ["Error: no circuit loaded"]) for cmd, _ in cmds]
+		return self.backend.execute_batch(cmds)
+
+	def peek_values(self, names: list) -> list:
+		self._check("peek")
+		return self.backend.peek_values(names)
+
+	def poke_values(self, values: dict):
+		self._check("poke")
+		self.backend.poke_values(values)
+
+	def trace(self, names: list, cycles: int):
+		self._check("trace")
+		return self.backend.trace(names, cycles)
+
+class AsyncTreadleServer:
+	""" Serves the text and the framed protocol of simulator.TreadleServer to any number of
+	    clients. Each connection is a session with a simulator process of its own, at most
+	    `processes` are started by `factory`. Sessions that find all processes busy wait in
+	    line for up to `queue_timeout` seconds and are turned away with an error after that,
+	    the first in line gets the next free process. A session ends after `idle_timeout` seconds
+	    without a request. A process that does not answer a command within `command_timeout`
+	    seconds is killed and replaced. Idle processes are reused by later sessions. """
+	def __init__(self, host='127.0.0.1', port=4321, factory=None, processes=4,
+			queue_timeout=60.0, idle_timeout=600.0, command_timeout=60.0):
+		self.host, self.port = host, port
+		self.factory = (lambda: TreadleWrapper(debug=False, engine='select').start()) if factory is None else factory
+		self.processes = processes
+		self.queue_timeout = queue_timeout
+		self.idle_timeout = idle_timeout
+		self.command_timeout = command_timeout
+		# commands block, each process gets a thread while it is used by a session, processes
+		# are started and killed in the default executor so that a hung command cannot hold
+		# up the next session
+		self.executor = ThreadPoolExecutor(max_workers=processes)
+		self.idle = []
+		self.running = 0
+		# futures of the sessions that wait for a process, oldest first
+		self.waiters = collections.deque()
+		self.server = None
+		self.sessions = set()
+		self.stats = {'sessions': 0, 'queued': 0, 'rejected': 0, 'idle_timeouts': 0, 'killed': 0, 'died': 0,
+			'bad_requests': 0}
+
+	async def start(self):
+		self.server = await asyncio.start_server(self._serve, self.host, self.port)
+		self.port = self.server.sockets[0].getsockname()[1]
+		return self
+
+	async def serve_forever(self):
+		if self.server is None:
+			await self.start()
+		try:
+			await self.server.serve_forever()
+		finally:
+			await self.close()
+
+	async def close(self):
+		""" ends all sessions and stops all processes """
+		self.server.close()
+		await self.server.wait_closed()
+		for task in list(self.sessions):
+			task.cancel()
+		await asyncio.gather(*self.sessions, return_exceptions=True)
+		loop = asyncio.get_running_loop()
+		while len(self.idle) > 0:
+			await loop.run_in_executor(self.executor, self.idle.pop().stop)
+		self.running = 0
+		self.executor.shutdown()
+
+	## Processes ##
+
+	async def _call(self, fun, *args):
+		""" runs a blocking call to a process in a thread """
+		loop = asyncio.get_running_loop()
+		try:
+			return await asyncio.wait_for(loop.run_in_executor(self.executor, fun, *args), self.command_timeout)
+		except asyncio.TimeoutError:
+			raise CommandTimeout(f"no answer within {self.command_timeout}s")
+
+	async def _start(self):
+		""" starts a process, one that starts after the timeout is killed """
+		future = asyncio.get_running_loop().run_in_executor(None, self.factory)
+		try:
+			return await asyncio.wait_for(asyncio.shield(future), self.command_timeout)
+		except (asyncio.TimeoutError, asyncio.CancelledError) as ee:
+			future.add_done_callback(self._kill_late)
+			if isinstance(ee, asyncio.TimeoutError):
+				raise CommandTimeout(f"no process within {self.command_timeout}s")
+			raise
+
+	def _kill_late(self, future):
+		if not future.cancelled() and future.exception() is None:
+			self.stats['killed'] += 1
+			asyncio.get_running_loop().run_in_executor(None, future.result().kill)
+
+	async def _acquire(self):
+		while len(self.waiters) == 0 and len(self.idle) > 0:
+			backend = self.idle.pop()
+			if backend.alive():
+				return backend
+			# died while idle, its slot is free again
+			self.stats['died'] += 1
+			self.running -= 1
+			asyncio.get_running_loop().run_in_executor(None, backend.kill)
+		if len(self.waiters) == 0 and self.running < self.processes:
+			self.running += 1
+		else:
+			self.stats['queued'] += 1
+			waiter = asyncio.get_running_loop().create_future()
+			self.waiters.append(waiter)
+			try:
+				backend = await asyncio.wait_for(waiter, self.queue_timeout)
+			except BaseException:
+				if waiter.done() and not waiter.cancelled():
+					# handed a process just as the wait ended
+					self._hand_over(waiter.result())
+				elif waiter in self.waiters:
+					self.waiters.remove(waiter)
+				raise
+			if backend is not None:
+				return backend
+		try:
+			return await self._start()
+		except BaseException:
+			self._hand_over(None)
+			raise
+
+	def _hand_over(self, backend):
+		""" gives a free process, or with None the slot of a process that is gone, to the
+		    session that waited longest """
+		while len(self.waiters) > 0:
+			waiter = self.waiters.popleft()
+			if not waiter.done():
+				waiter.set_result(backend)
+				return
+		if backend is None:
+			self.running -= 1
+		else:
+			self.idle.append(backend)
+
+	async def _release(self, backend, broken: bool):
+		if broken:
+			self.stats['killed'] += 1
+			await asyncio.get_running_loop().run_in_executor(None, backend.kill)
+		else:
+			backend.detach()
+		self._hand_over(None if broken else backend)
+
+	## Connections ##
+
+	async def _serve(self, reader, writer):
+		self.sessions.add(asyncio.current_task())
+		backend, broken, framed = None, False, False
+		try:
+			first = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+			if len(first) == 0:
+				return
+			# bad input is turned away before it gets a process
+			framed = first.startswith(b'hello|')
+			if framed:
+				version = min(_parse_hello(first), protocol_version)
+			else:
+				_parse_command(first)
+			try:
+				backend = await self._acquire()
+			except asyncio.TimeoutError:
+				self.stats['rejected'] += 1
+				reason = f"all {self.processes} processes are busy"
+				writer.write((f"error|{reason}\n" if framed else f"Error: {reason}\n").encode('UTF-8'))
+				await writer.drain()
+				return
+			self.stats['sessions'] += 1
+			session = Session(backend)
+			if framed:
+				writer.write(f"frames|{version}\n".encode('UTF-8'))
+				await self._serve_frames(session, reader, writer)
+			else:
+				await self._serve_text(session, first, reader, writer)
+		except asyncio.TimeoutError:
+			self.stats['idle_timeouts'] += 1
+		except ProtocolError as ee:
+			self.stats['bad_requests'] += 1
+			writer.write((f"error|{ee}\n" if framed else f"Error: {ee}\n").encode('UTF-8'))
+			with contextlib.suppress(ConnectionError):
+				await writer.drain()
+		except CommandTimeout:
+			# the process is in an unknown state
+			broken = True
+		except asyncio.CancelledError:
+			broken = True
+			raise
+		except (ConnectionError, asyncio.IncompleteReadError):
+			pass
+		except Exception as ee:
+			print(f"session failed: {ee!r}", file=sys.stderr)
+			broken = True
+		finally:
+			self.sessions.discard(asyncio.current_task())
+			writer.close()
+			if backend is not None:
+				await asyncio.shield(self._release(backend, broken))
+
+	async def _serve_text(self, session, line: bytes, reader, writer):
+		while len(line) > 0:
+			cmd, count = _parse_command(line)
+			if cmd == 'batch':
+				cmds = [_parse_command(await reader.readline()) for _ in range(count)]
+				writer.write(await self._call(text_batch_response, session, cmds))
+			else:
+				writer.write(await self._call(text_response, session, cmd, count))
+			await writer.drain()
+			line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+
+	async def _serve_frames(self, session, reader, writer):
+		while True:
+			header = await asyncio.wait_for(reader.readexactly(frame_header.size), self.idle_timeout)
+			size, kind = frame_header.unpack(header)
+			body = FrameReader(await reader.readexactly(size))
+			responses = frame_responses(session, kind, body)
+			while True:
+				data = await self._call(next, responses, None)
+				if data is None:
+					break
+				writer.write(data)
+				await writer.drain()
+
+def main():
+	args = [arg for arg in sys.argv[1:] if not arg.startswith('--')]
+	port = int(args[0]) if len(args) > 0 else 4321
+	processes = int(args[1]) if len(args) > 1 else 4
+	factory = None
+	if '--compiled' in sys.argv:
+		import os
+		repl = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'treadle_repl.py')
+		factory = lambda: TreadleWrapper(cmd=f"{sys.executable} {repl}", engine='select').start()
+	server = AsyncTreadleServer(port=port, factory=factory, processes=processes)
+	try:
+		asyncio.run(server.serve_forever())
+	except KeyboardInterrupt:
+		pass
+
+if __name__ == '__main__':
+	main()